@@ -0,0 +1,613 @@
+"""
+Бенчмарк этапов обработки на синтетических данных.
+
+Генерирует YML-фид заданного размера и синтетические изображения,
+раздает их локальным HTTP-сервером с настраиваемыми задержками и
+ошибками, подменяет PhotoRoom локальной заглушкой и замеряет
+FeedSaver.save_xml, FeedImage.get_images, FeedImage.add_background
+(движками Pillow и NumPy со сверкой результата), конвейер
+FeedImage.process_images (get_images и add_background вместе) и каждое
+преобразование FeedHandler и публикацию. Результат сохраняется в JSON,
+чтобы сравнивать прогоны между собой (--compare).
+
+Пример: python -m handler.cli bench --offers 100000 --images 200
+
+Бэкенды XML сравниваются двумя прогонами с XML_BACKEND=etree и
+XML_BACKEND=lxml и ключом --compare.
+"""
+import json
+import logging
+import platform
+import random
+import tempfile
+import threading
+import time
+import tracemalloc
+from datetime import datetime as dt
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from io import BytesIO
+from pathlib import Path
+
+from handler import xml_backend
+from handler.metrics import REGISTRY
+from handler.profiling import peak_rss_bytes
+
+BENCH_FOLDER = 'bench_results'
+"""Директория для JSON-результатов бенчмарков."""
+
+LATENCY_METRICS = (
+    'feed_download_seconds',
+    'image_download_seconds',
+    'photoroom_seconds',
+    'composite_seconds',
+    'encode_seconds',
+    'pipeline_stage_seconds',
+)
+"""Гистограммы задержек на элемент, попадающие в отчет."""
+
+BYTES_METRICS = (
+    'image_download_bytes_total',
+    'photoroom_upload_bytes_total',
+    'publish_bytes_total',
+    'output_bytes',
+    'output_compressed_bytes',
+)
+"""Счетчики переданных и записанных байт, попадающие в отчет."""
+
+FEED_NAME = 'pdsfeed.yml'
+IMAGES_FEED_NAME = 'images.yml'
+
+LOOKUPS = 1000
+"""Число случайных офферов, которые этап lookup читает по id."""
+
+
+def write_synthetic_feed(
+    path: Path,
+    offers: int,
+    base_url: str,
+    distinct_images: int | None = None,
+    duplicate_ratio: float = 0.1,
+    categories: int = 50,
+    seed: int = 42
+) -> None:
+    """
+    Функция, потоково пишет YML-фид с offers офферами.
+
+    У части офферов categoryId == 0 (их удаляет delete_offers), у части
+    нет <picture>, доля duplicate_ratio ссылается на уже использованные
+    картинки, как в реальном фиде с общими фото у вариантов товара.
+    У каждого 20-го оффера categoryId и <picture> обернуты в CDATA.
+    """
+    rnd = random.Random(seed)
+    distinct_images = distinct_images or offers
+    chunk = []
+    with open(path, 'w', encoding='utf-8') as f:
+        f.write(
+            '<?xml version="1.0" encoding="utf-8"?>\n'
+            f'<yml_catalog date="{dt.now():%Y-%m-%d %H:%M}">'
+            '<shop><name>Yves Rocher</name><company>Yves Rocher</company>'
+            '<currencies><currency id="RUR" rate="1"/></currencies>'
+            '<categories>'
+        )
+        f.write(''.join(
+            f'<category id="{number}">Категория {number}</category>'
+            for number in range(1, categories + 1)
+        ))
+        f.write('</categories><offers>')
+        for number in range(1, offers + 1):
+            offer_id = 100000 + number
+            category_id = 0 if rnd.random() < 0.02 else rnd.randint(
+                1, categories
+            )
+            if rnd.random() < duplicate_ratio and number > 1:
+                image_index = rnd.randint(0, min(number, distinct_images) - 1)
+            else:
+                image_index = number % distinct_images
+            picture = (
+                '' if rnd.random() < 0.01 else
+                f'<picture>{base_url}/images/{image_index}.jpg</picture>'
+            )
+            category = f'<categoryId>{category_id}</categoryId>'
+            if number % 20 == 0:
+                picture = picture.replace(
+                    '<picture>', '<picture><![CDATA['
+                ).replace('</picture>', ']]></picture>')
+                category = (
+                    f'<categoryId><![CDATA[{category_id}]]></categoryId>'
+                )
+            chunk.append(
+                f'<offer id="{offer_id}" available="true">'
+                f'<url>https://www.yves-rocher.ru/p/{offer_id}</url>'
+                f'<price>{rnd.randint(199, 4999)}</price>'
+                '<currencyId>RUR</currencyId>'
+                f'{category}{picture}'
+                f'<name>Крем для лица №{offer_id} &amp; уход</name>'
+                '<vendor>Yves Rocher</vendor>'
+                '<description>Питательный крем с экстрактами растений '
+                '— 50 мл.</description>'
+                '</offer>'
+            )
+            if len(chunk) >= 10000:
+                f.write(''.join(chunk))
+                chunk.clear()
+        f.write(''.join(chunk))
+        f.write('</offers></shop></yml_catalog>\n')
+
+
+def render_product_image(index: int, size: int = 800) -> bytes:
+    """
+    Функция, рисует синтетическое фото товара: цветной флакон на
+    светлом фоне, JPEG. Картинка детерминирована по index.
+    """
+    from PIL import Image, ImageDraw
+
+    rnd = random.Random(index)
+    image = Image.new('RGB', (size, size), (245, 245, 240))
+    draw = ImageDraw.Draw(image)
+    color = (rnd.randint(0, 200), rnd.randint(60, 200), rnd.randint(0, 200))
+    width = rnd.randint(size // 5, size // 3)
+    top = rnd.randint(size // 10, size // 4)
+    draw.rounded_rectangle(
+        (size // 2 - width // 2, top, size // 2 + width // 2, size - top),
+        radius=width // 4,
+        fill=color
+    )
+    draw.rectangle(
+        (size // 2 - width // 6, top - size // 12, size // 2 + width // 6,
+         top),
+        fill=(40, 40, 40)
+    )
+    buffer = BytesIO()
+    image.save(buffer, 'JPEG', quality=90)
+    return buffer.getvalue()
+
+
+def fake_remove_background(image_data: bytes) -> bytes:
+    """
+    Функция, заменяет PhotoRoom: делает светлый фон прозрачным
+    и возвращает PNG, как настоящий API.
+    """
+    from PIL import Image
+
+    with Image.open(BytesIO(image_data)) as image:
+        rgba = image.convert('RGBA')
+    alpha = rgba.convert('L').point(lambda value: 0 if value > 235 else 255)
+    rgba.putalpha(alpha)
+    buffer = BytesIO()
+    rgba.save(buffer, 'PNG')
+    return buffer.getvalue()
+
+
+def _extract_multipart_file(body: bytes, content_type: str) -> bytes:
+    """Защищенная функция, достает первый файл из multipart-тела."""
+    boundary = content_type.split('boundary=')[-1].strip('"').encode()
+    for part in body.split(b'--' + boundary):
+        if b'filename=' not in part:
+            continue
+        _, _, payload = part.partition(b'\r\n\r\n')
+        return payload[:-2] if payload.endswith(b'\r\n') else payload
+    return b''
+
+
+class StandInServer:
+    """
+    Локальный HTTP-сервер, заменяющий внешние сервисы.
+
+    - GET /feeds/<имя> - файл фида из директории root;
+    - GET /images/<n>.jpg - синтетическое фото товара (кэшируется);
+    - POST /v2/edit - заглушка PhotoRoom.
+
+    latency и photoroom_latency добавляют задержку в секундах,
+    error_rate - доля ответов 503 (для картинок чередуются 403 и 503).
+    """
+
+    def __init__(
+        self,
+        root: Path,
+        latency: float = 0.0,
+        photoroom_latency: float = 0.0,
+        error_rate: float = 0.0,
+        image_size: int = 800,
+        seed: int = 42
+    ) -> None:
+        self.root = root
+        self.latency = latency
+        self.photoroom_latency = photoroom_latency
+        self.error_rate = error_rate
+        self.image_size = image_size
+        self._random = random.Random(seed)
+        self._images: dict[int, bytes] = {}
+        self._lock = threading.Lock()
+        self._server = ThreadingHTTPServer(
+            ('127.0.0.1', 0),
+            self._make_handler()
+        )
+        self._thread = threading.Thread(
+            target=self._server.serve_forever,
+            name='bench-server',
+            daemon=True
+        )
+
+    @property
+    def url(self) -> str:
+        host, port = self._server.server_address[:2]
+        return f'http://{host}:{port}'
+
+    def _should_fail(self) -> bool:
+        with self._lock:
+            return self._random.random() < self.error_rate
+
+    def _image(self, index: int) -> bytes:
+        with self._lock:
+            cached = self._images.get(index)
+        if cached is None:
+            cached = render_product_image(index, self.image_size)
+            with self._lock:
+                self._images[index] = cached
+        return cached
+
+    def _make_handler(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def log_message(self, format, *args):
+                pass
+
+            def _reply(self, status: int, body: bytes, content_type: str):
+                self.send_response(status)
+                self.send_header('Content-Type', content_type)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def do_GET(self):  # noqa: N802
+                time.sleep(server.latency)
+                if self.path.startswith('/feeds/'):
+                    path = server.root / self.path.rsplit('/', 1)[-1]
+                    if not path.exists():
+                        return self._reply(404, b'', 'text/plain')
+                    return self._reply(
+                        200, path.read_bytes(), 'application/xml'
+                    )
+                if self.path.startswith('/images/'):
+                    if server._should_fail():
+                        status = self._choose_status()
+                        return self._reply(
+                            status, b'<html>error</html>', 'text/html'
+                        )
+                    index = int(self.path.rsplit('/', 1)[-1].split('.')[0])
+                    return self._reply(
+                        200, server._image(index), 'image/jpeg'
+                    )
+                return self._reply(404, b'', 'text/plain')
+
+            def _choose_status(self) -> int:
+                return 403 if server._random.random() < 0.5 else 503
+
+            def do_POST(self):  # noqa: N802
+                body = self.rfile.read(int(self.headers['Content-Length']))
+                time.sleep(server.photoroom_latency)
+                if server._should_fail():
+                    return self._reply(503, b'busy', 'text/plain')
+                image_data = _extract_multipart_file(
+                    body,
+                    self.headers.get('Content-Type', '')
+                )
+                try:
+                    result = fake_remove_background(image_data)
+                except Exception:
+                    return self._reply(400, b'bad image', 'text/plain')
+                return self._reply(200, result, 'image/png')
+
+        return Handler
+
+    def __enter__(self) -> 'StandInServer':
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self._server.shutdown()
+        self._server.server_close()
+
+
+class BenchSuite:
+    """
+    Класс, прогоняющий этапы на синтетических данных.
+
+    Все директории создаются во временной папке, внешние адреса
+    подменяются на StandInServer, поэтому бенчмарк не трогает рабочие
+    данные и не ходит в сеть.
+    """
+
+    STAGES = (
+        'save_xml',
+        'get_images',
+        'add_background',
+        'add_background_numpy',
+        'pipeline',
+        'index',
+        'lookup',
+        'parse',
+        'delete_offers',
+        'replace_images',
+        'add_custom_label',
+        'save',
+        'publish',
+    )
+
+    def __init__(
+        self,
+        offers: int = 10000,
+        images: int = 100,
+        latency: float = 0.0,
+        photoroom_latency: float = 0.0,
+        error_rate: float = 0.0,
+        duplicate_ratio: float = 0.1,
+        trace_memory: bool = False,
+        stages: tuple[str, ...] = STAGES
+    ) -> None:
+        self.offers = offers
+        self.images = images
+        self.latency = latency
+        self.photoroom_latency = photoroom_latency
+        self.error_rate = error_rate
+        self.duplicate_ratio = duplicate_ratio
+        self.trace_memory = trace_memory
+        self.stages = stages
+        self.results: dict = {}
+
+    def _measure(self, stage: str, items: int, func) -> None:
+        """Защищенный метод, замеряет этап и сохраняет результат."""
+        if stage not in self.stages:
+            return
+        REGISTRY.reset()
+        if self.trace_memory:
+            tracemalloc.start()
+        start = time.perf_counter()
+        try:
+            func()
+        finally:
+            elapsed = time.perf_counter() - start
+            peak = None
+            if self.trace_memory:
+                _, peak = tracemalloc.get_traced_memory()
+                tracemalloc.stop()
+        metrics = REGISTRY.to_dict()
+        self.results['stages'][stage] = {
+            'seconds': round(elapsed, 4),
+            'items': items,
+            'items_per_sec': round(items / elapsed, 1) if elapsed else None,
+            'peak_traced_mb': (
+                round(peak / 1024 / 1024, 1) if peak is not None else None
+            ),
+            'peak_rss_mb': round(peak_rss_bytes() / 1024 / 1024, 1),
+            'latency': {
+                name if labels == '_' else f'{name}{{{labels}}}': summary
+                for name in LATENCY_METRICS
+                for labels, summary in metrics.get(name, {}).items()
+                if summary['count']
+            },
+            'bytes': {
+                name if labels == '_' else f'{name}{{{labels}}}': value
+                for name in BYTES_METRICS
+                for labels, value in metrics.get(name, {}).items()
+                if value
+            },
+        }
+        logging.info('Бенчмарк %s: %.3f сек', stage, elapsed)
+        print(
+            f'{stage:<18} {elapsed:9.3f} сек  '
+            f'{self.results["stages"][stage]["items_per_sec"] or 0:>12} эл/с'
+        )
+
+    def _check_identical(
+        self,
+        stage: str,
+        expected: Path,
+        actual: Path
+    ) -> None:
+        """
+        Защищенный метод, сверяет файлы двух директорий байт в байт
+        и записывает результат сверки в отчет этапа.
+        """
+        result = self.results['stages'].get(stage)
+        if result is None or not expected.exists():
+            return
+        names = sorted(
+            file.name for file in expected.iterdir()
+            if file.is_file() and not file.name.startswith('.')
+        )
+        mismatched = []
+        for name in names:
+            is_present = (actual / name).exists()
+            if not is_present or (
+                (actual / name).read_bytes() != (expected / name).read_bytes()
+            ):
+                mismatched.append(name)
+        result['identical'] = not mismatched
+        result['mismatched'] = mismatched[:10]
+        print(f'{stage:<18} совпадает с эталоном: {not mismatched}')
+
+    def run(self) -> dict:
+        """Метод выполняет все выбранные этапы и возвращает результаты."""
+        from handler.feeds_handler import FeedHandler
+        from handler.feeds_save import FeedSaver
+        from handler.image_handler import FeedImage
+        from handler.publish import Publisher
+
+        self.results = {
+            'date': dt.now().isoformat(timespec='seconds'),
+            'python': platform.python_version(),
+            'xml_backend': xml_backend.BACKEND_NAME,
+            'params': {
+                'offers': self.offers,
+                'images': self.images,
+                'latency': self.latency,
+                'photoroom_latency': self.photoroom_latency,
+                'error_rate': self.error_rate,
+                'duplicate_ratio': self.duplicate_ratio,
+            },
+            'stages': {},
+        }
+        with tempfile.TemporaryDirectory(prefix='feed_bench_') as temp_dir:
+            root = Path(temp_dir)
+            source = root / 'source'
+            source.mkdir()
+            folders = {
+                name: str(root / name) for name in (
+                    'temp_feeds', 'new_feeds', 'old_images', 'new_images'
+                )
+            }
+            with StandInServer(
+                source,
+                latency=self.latency,
+                photoroom_latency=self.photoroom_latency,
+                error_rate=self.error_rate
+            ) as server:
+                write_synthetic_feed(
+                    source / FEED_NAME,
+                    self.offers,
+                    server.url,
+                    duplicate_ratio=self.duplicate_ratio
+                )
+                images_feed = root / 'images_feed'
+                images_feed.mkdir()
+                write_synthetic_feed(
+                    images_feed / IMAGES_FEED_NAME,
+                    self.images,
+                    server.url,
+                    duplicate_ratio=0
+                )
+                saver = FeedSaver(
+                    feeds_list=(f'{server.url}/feeds/{FEED_NAME}',),
+                    feeds_folder=folders['temp_feeds'],
+                    snapshots=False
+                )
+                self._measure('save_xml', self.offers, saver.save_xml)
+
+                image_client = FeedImage(
+                    [IMAGES_FEED_NAME],
+                    images=[],
+                    feeds_folder=str(images_feed),
+                    image_folder=folders['old_images'],
+                    new_image_folder=folders['new_images'],
+                    photoroom_url=f'{server.url}/v2/edit'
+                )
+                self._measure(
+                    'get_images',
+                    self.images,
+                    image_client.get_images
+                )
+                old_images = Path(folders['old_images'])
+                old_images.mkdir(exist_ok=True)
+                image_client.images = sorted(
+                    file.name
+                    for file in old_images.iterdir()
+                    if file.is_file() and not file.name.startswith('.')
+                )
+                self._measure(
+                    'add_background',
+                    len(image_client.images),
+                    image_client.add_background
+                )
+                Publisher(folders['new_images']).publish()
+                numpy_client = FeedImage(
+                    [IMAGES_FEED_NAME],
+                    images=image_client.images,
+                    image_folder=folders['old_images'],
+                    new_image_folder=str(root / 'new_images_numpy'),
+                    composite_engine='numpy'
+                )
+                self._measure(
+                    'add_background_numpy',
+                    len(image_client.images),
+                    numpy_client.add_background
+                )
+                Publisher(str(root / 'new_images_numpy')).publish()
+                self._check_identical(
+                    'add_background_numpy',
+                    Path(folders['new_images']),
+                    root / 'new_images_numpy'
+                )
+                pipeline_client = FeedImage(
+                    [IMAGES_FEED_NAME],
+                    images=[],
+                    feeds_folder=str(images_feed),
+                    image_folder=str(root / 'old_images_pipeline'),
+                    new_image_folder=str(root / 'new_images_pipeline'),
+                    photoroom_url=f'{server.url}/v2/edit'
+                )
+                self._measure(
+                    'pipeline',
+                    self.images,
+                    pipeline_client.process_images
+                )
+                self._check_identical(
+                    'pipeline',
+                    Path(folders['new_images']),
+                    root / 'new_images_pipeline'
+                )
+
+            Path(folders['new_images']).mkdir(exist_ok=True)
+            handler = FeedHandler(
+                FEED_NAME,
+                feeds_folder=folders['temp_feeds'],
+                new_feeds_folder=folders['new_feeds'],
+                new_image_folder=folders['new_images']
+            )
+            self._measure('index', self.offers, lambda: handler.index)
+            lookup_ids = random.Random(42).sample(
+                handler.index.ids.tolist(),
+                min(LOOKUPS, len(handler.index))
+            )
+            self._measure(
+                'lookup',
+                len(lookup_ids),
+                lambda: [handler.get_offer(value) for value in lookup_ids]
+            )
+            self._measure('parse', self.offers, lambda: handler.root)
+            self._measure('delete_offers', self.offers, handler.delete_offers)
+            self._measure(
+                'replace_images',
+                self.offers,
+                handler.replace_images
+            )
+            self._measure(
+                'add_custom_label',
+                self.offers,
+                handler.add_custom_label
+            )
+            self._measure('save', self.offers, handler.save)
+            self._measure(
+                'publish',
+                self.offers,
+                Publisher(folders['new_feeds']).publish
+            )
+        return self.results
+
+    def save(self, folder: str = BENCH_FOLDER) -> Path:
+        """Метод сохраняет результаты в JSON и возвращает путь."""
+        folder_path = Path(__file__).parent.parent / folder
+        folder_path.mkdir(parents=True, exist_ok=True)
+        stamp = dt.now().strftime('%Y%m%d-%H%M%S')
+        result_path = folder_path / f'bench-{stamp}.json'
+        with open(result_path, 'w', encoding='utf-8') as f:
+            json.dump(self.results, f, ensure_ascii=False, indent=2)
+        return result_path
+
+
+def compare(current: dict, previous: dict) -> list[str]:
+    """Функция, сравнивает длительность этапов двух прогонов."""
+    lines = []
+    for stage, result in current.get('stages', {}).items():
+        before = previous.get('stages', {}).get(stage)
+        if not before or not before.get('seconds'):
+            continue
+        ratio = result['seconds'] / before['seconds']
+        lines.append(
+            f'{stage:<18} {before["seconds"]:9.3f} -> '
+            f'{result["seconds"]:9.3f} сек ({(ratio - 1) * 100:+.1f}%)'
+        )
+    return lines
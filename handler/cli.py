@@ -0,0 +1,633 @@
+"""
+Командная строка для запуска этапов обработки по отдельности.
+
+Пример: python -m handler.cli images
+
+Модули этапов импортируются внутри команд, поэтому быстрые команды
+(status) не тянут PIL, requests и не создают директорию логов.
+"""
+import argparse
+import json
+import sys
+import time
+from pathlib import Path
+
+from handler.constants import (FEEDS_FOLDER, FRAME_FOLDER, IMAGE_FOLDER,
+                               JOURNAL_FOLDER, NEW_FEEDS_FOLDER,
+                               NEW_IMAGE_FOLDER, PICTURE_VERSIONS_FOLDER,
+                               PICTURE_VERSIONS_RETENTION_DAYS, QUEUE_BATCH,
+                               RENDER_PLAN)
+
+BASE_DIR = Path(__file__).parent.parent
+"""Корневая директория проекта."""
+
+
+def _count_files(folder_name: str) -> int:
+    """Защищенная функция, считает готовые файлы в директории."""
+    folder_path = BASE_DIR / folder_name
+    if not folder_path.exists():
+        return 0
+    return sum(
+        1 for file in folder_path.iterdir()
+        if file.is_file() and not file.name.startswith('.')
+    )
+
+
+def _feed_filenames() -> list[str]:
+    """Защищенная функция, возвращает список скачанных фидов."""
+    from handler.utils import get_filenames_list
+
+    return get_filenames_list(FEEDS_FOLDER)
+
+
+def _publish(folder_name: str) -> None:
+    """Защищенная функция, публикует staging директории и печатает итог."""
+    from handler.publish import Publisher
+
+    result = Publisher(folder_name).publish()
+    print(
+        f"{folder_name}: опубликовано {len(result['published'])}, "
+        f"без изменений {len(result['skipped'])}"
+    )
+
+
+def cmd_status(args) -> int:
+    """Команда выводит состояние журналов прогона и директорий."""
+    state_paths = sorted(
+        (BASE_DIR / JOURNAL_FOLDER).glob('pipeline*.json')
+    )
+    if not state_paths:
+        print('Прогон: - (-)')
+    for state_path in state_paths:
+        with open(state_path, encoding='utf-8') as f:
+            state = json.load(f)
+        print(
+            f"{state_path.stem}: {state.get('run_id', '-')} "
+            f"({state.get('status', '-')}), этапы: "
+            f"{', '.join(state.get('stages', {})) or '-'}"
+        )
+    for folder_name in (
+        FEEDS_FOLDER, NEW_FEEDS_FOLDER, IMAGE_FOLDER, NEW_IMAGE_FOLDER
+    ):
+        print(f'{folder_name}: {_count_files(folder_name)} файлов')
+    return 0
+
+
+def cmd_run(args) -> int:
+    """Команда запускает конвейеры всех фидов, как handler.main."""
+    from handler.main import main
+
+    main()
+    return 0
+
+
+def cmd_fetch(args) -> int:
+    """Команда скачивает фиды из FEEDS_CONFIG."""
+    from handler.feed_config import load_feed_configs
+    from handler.feeds_save import FeedSaver
+
+    configs, _ = load_feed_configs()
+    FeedSaver(
+        feeds_list=tuple(config.url for config in configs),
+        filenames={config.url: config.filename for config in configs}
+    ).save_xml()
+    return 0
+
+
+def cmd_images(args) -> int:
+    """Команда скачивает изображения и удаляет фон."""
+    from handler.image_handler import FeedImage
+
+    FeedImage(_feed_filenames(), images=[]).process_images(frame=False)
+    return 0
+
+
+def cmd_pipeline(args) -> int:
+    """Команда скачивает и обрамляет изображения одним конвейером."""
+    from handler.image_handler import FeedImage
+
+    FeedImage(_feed_filenames(), images=[]).process_images()
+    return 0
+
+
+def cmd_frame(args) -> int:
+    """Команда накладывает изображения на подложку."""
+    from handler.image_handler import FeedImage
+    from handler.utils import get_filenames_list
+
+    FeedImage(
+        _feed_filenames(),
+        images=get_filenames_list(IMAGE_FOLDER)
+    ).add_background()
+    if not args.no_publish:
+        _publish(NEW_IMAGE_FOLDER)
+    return 0
+
+
+def cmd_rewrite(args) -> int:
+    """Команда применяет преобразования к фидам и сохраняет их."""
+    from handler.feeds_handler import FeedHandler
+
+    for filename in _feed_filenames():
+        handler_client = FeedHandler(filename)
+        if args.delete_offers:
+            handler_client.delete_offers()
+        if not args.keep_images:
+            handler_client.replace_images()
+        if args.custom_label:
+            handler_client.add_custom_label()
+        handler_client.save()
+    if not args.no_publish:
+        _publish(NEW_FEEDS_FOLDER)
+    return 0
+
+
+def cmd_publish(args) -> int:
+    """Команда публикует измененные файлы из staging в раздачу."""
+    folders = {
+        'feeds': (NEW_FEEDS_FOLDER,),
+        'images': (NEW_IMAGE_FOLDER,),
+        'all': (NEW_IMAGE_FOLDER, NEW_FEEDS_FOLDER),
+    }[args.target]
+    for folder_name in folders:
+        _publish(folder_name)
+    return 0
+
+
+def cmd_index(args) -> int:
+    """Команда строит индексы фидов и выводит статистику по ним."""
+    from handler.feeds_handler import FeedHandler
+
+    for filename in _feed_filenames():
+        stats = FeedHandler(filename).stats()
+        print(f'{filename}: {json.dumps(stats, ensure_ascii=False)}')
+    return 0
+
+
+def cmd_quality(args) -> int:
+    """
+    Команда выводит отчет о качестве скачанных фидов. Если отчета нет
+    (фид скачан до появления проверки), офферы проверяются на месте.
+    """
+    from handler.feed_quality import RULES, FeedValidator, read_quality_report
+    from handler.offer_index import OfferIndex
+
+    invalid_offers = 0
+    for filename in [args.feed] if args.feed else _feed_filenames():
+        feed_path = BASE_DIR / FEEDS_FOLDER / filename
+        report = read_quality_report(feed_path)
+        if report is None:
+            validator = FeedValidator(filename)
+            OfferIndex.for_feed(feed_path, validator)
+            report = validator.report()
+        invalid_offers += report['invalid_offers']
+        if args.json:
+            print(json.dumps(report, ensure_ascii=False, indent=2))
+            continue
+        print(
+            f"{filename}: офферов {report['offers']}, "
+            f"с ошибками {report['invalid_offers']} ({report['created']})"
+        )
+        for rule, violations in report['rules'].items():
+            print(
+                f"  {violations['severity']:<7} {RULES[rule][1]}: "
+                f"{violations['count']}, например "
+                f"{', '.join(violations['samples'][:5])}"
+            )
+    return 1 if invalid_offers else 0
+
+
+def cmd_offer(args) -> int:
+    """
+    Команда выводит исходный XML оффера по id из скачанных фидов.
+
+    Оффер читается по байтовому смещению из индекса, без разбора фида.
+    """
+    from handler.offer_index import OfferIndex
+
+    found = False
+    for filename in [args.feed] if args.feed else _feed_filenames():
+        feed_path = BASE_DIR / FEEDS_FOLDER / filename
+        start = time.perf_counter()
+        text = OfferIndex.for_feed(feed_path).offer_text(
+            feed_path,
+            args.offer_id
+        )
+        if text is None:
+            continue
+        found = True
+        elapsed = (time.perf_counter() - start) * 1000
+        print(f'<!-- {filename}, {elapsed:.2f} мс -->')
+        print(text)
+    if not found:
+        print(f'Оффер {args.offer_id} не найден', file=sys.stderr)
+        return 1
+    return 0
+
+
+def cmd_reprocess(args) -> int:
+    """Команда заново обрабатывает изображения выбранных офферов."""
+    from handler.image_handler import FeedImage
+
+    processed = FeedImage(_feed_filenames(), images=[]).reprocess_offers(
+        args.offer_ids,
+        frame=not args.no_frame
+    )
+    print(f'Обработано офферов: {processed} из {len(args.offer_ids)}')
+    return 0 if processed else 1
+
+
+def cmd_plan(args) -> int:
+    """
+    Команда выводит план прогона изображений без сетевых запросов:
+    новые, измененные и готовые офферы, вызовы API и длительность.
+    """
+    from handler.feed_config import load_feed_configs
+    from handler.planner import RunPlanner
+
+    configs, _ = load_feed_configs()
+    plan = RunPlanner(configs).plan()
+    if args.json:
+        print(json.dumps(plan, ensure_ascii=False, indent=2))
+        return 0
+    for name, offers in plan['feeds'].items():
+        print(f'{name}: {"не скачан" if offers is None else offers}')
+    print(
+        f"Офферов с картинками: {plan['offers_with_pictures']}, "
+        f"новых {plan['new']}, измененных {plan['changed']}, "
+        f"только кадры {plan['frame_only']}, готовых {plan['skipped']}"
+    )
+    print(f"Осиротевшие файлы: {plan['orphaned']}")
+    print(
+        f"Скачиваний {plan['downloads']}, вызовов PhotoRoom "
+        f"{plan['photoroom_calls']}, кадров {plan['frames']}"
+    )
+    estimate = plan['estimate']
+    print(
+        f"Оценка: конвейер ~{estimate['pipeline_seconds']} сек, "
+        f"последовательно ~{estimate['sequential_seconds']} сек"
+    )
+    if estimate['unknown']:
+        print(f"Нет истории задержек: {', '.join(estimate['unknown'])}")
+    return 0
+
+
+def cmd_snapshots(args) -> int:
+    """
+    Команда работает с историей фидов: add, list, diff, history, show
+    и restore (см. handler.snapshots).
+    """
+    from handler.snapshots import SnapshotStore
+
+    with SnapshotStore() as store:
+        if args.action == 'add':
+            for filename in [args.feed] if args.feed else _feed_filenames():
+                seq = store.add(BASE_DIR / FEEDS_FOLDER / filename)
+                print(f'{filename}: снимок {seq}')
+        elif args.action == 'list':
+            for run in store.runs(args.feed):
+                print(
+                    f"{run['seq']:>5}  {run['created']}  {run['feed']}  "
+                    f"офферов {run['offers']}, изменений {run['changes']}"
+                )
+        elif args.action == 'diff':
+            diff = store.diff(int(args.args[0]), int(args.args[1]))
+            if args.json:
+                print(json.dumps(diff, ensure_ascii=False, indent=2))
+            else:
+                for kind, keys in diff.items():
+                    print(f"{kind}: {len(keys)} {' '.join(keys[:20])}")
+        elif args.action == 'history':
+            for change in store.history(args.args[0], args.feed):
+                print(
+                    f"{change['seq']:>5}  {change['created']}  "
+                    f"{change['feed']}  {change['sha256'] or 'удален'}"
+                )
+        elif args.action == 'show':
+            offer = store.offer(int(args.args[0]), args.args[1])
+            if offer is None:
+                print('Оффера нет в снимке', file=sys.stderr)
+                return 1
+            sys.stdout.buffer.write(offer + b'\n')
+        elif args.action == 'restore':
+            path = store.restore(int(args.args[0]), Path(args.args[1]))
+            print(f'Снимок {args.args[0]} восстановлен в {path}')
+    return 0
+
+
+def cmd_queue(args) -> int:
+    """
+    Команда работает с очередью заданий изображений: fill - добавить
+    офферы скачанных фидов, work - обрабатывать задания, status,
+    retry - вернуть проваленные задания (см. handler.job_queue).
+    """
+    from handler.job_queue import JobQueue
+
+    with JobQueue() as job_queue:
+        if args.action == 'fill':
+            from handler.offer_index import OfferIndex
+
+            for filename in [args.feed] if args.feed else _feed_filenames():
+                index = OfferIndex.for_feed(BASE_DIR / FEEDS_FOLDER / filename)
+                changed = job_queue.fill(index.offer_pictures())
+                print(f'{filename}: новых и измененных заданий {changed}')
+        elif args.action == 'work':
+            from handler.image_handler import FeedImage
+            from handler.job_queue import QueueWorker
+
+            totals = QueueWorker(
+                job_queue,
+                FeedImage(_feed_filenames(), images=[]),
+                frame=not args.no_frame,
+                batch=args.batch
+            ).run(once=args.once)
+            print(f'Обработано: {json.dumps(totals, ensure_ascii=False)}')
+        elif args.action == 'retry':
+            print(f'Возвращено в очередь: {job_queue.retry_failed()}')
+        print(f'Очередь: {json.dumps(job_queue.stats(), ensure_ascii=False)}')
+    return 0
+
+
+def _variant_folders() -> list[str]:
+    """
+    Защищенная функция, возвращает директории кадров всех вариантов
+    планов рендеринга: общего RENDER_PLAN и планов фидов из
+    FEEDS_CONFIG.
+    """
+    from handler.feed_config import load_feed_configs
+    from handler.render import load_render_plan
+
+    configs, _ = load_feed_configs()
+    plan_names = {RENDER_PLAN} | {
+        config.render_plan for config in configs if config.render_plan
+    }
+    folders = {
+        variant.folder
+        for plan_name in sorted(plan_names)
+        for variant in load_render_plan(BASE_DIR / FRAME_FOLDER / plan_name)
+    }
+    return [
+        str(Path(NEW_IMAGE_FOLDER) / folder)
+        for folder in sorted(folders) if folder
+    ]
+
+
+def cmd_gc(args) -> int:
+    """
+    Команда удаляет изображения офферов, которых нет в фидах:
+    исходники, кадры всех вариантов и версии изображений.
+    """
+    from handler.utils import (get_offer_ids, remove_orphan_files,
+                               remove_stale_versions)
+
+    offer_ids = get_offer_ids(FEEDS_FOLDER)
+    if not offer_ids:
+        print('В фидах не найдено офферов, очистка отменена')
+        return 1
+    versions_folder = str(Path(NEW_IMAGE_FOLDER) / PICTURE_VERSIONS_FOLDER)
+    for folder_name in (
+        IMAGE_FOLDER,
+        NEW_IMAGE_FOLDER,
+        *_variant_folders(),
+        versions_folder
+    ):
+        removed = remove_orphan_files(folder_name, offer_ids, args.dry_run)
+        print(f'{folder_name}: удалено {len(removed)} файлов')
+    removed = remove_stale_versions(
+        versions_folder,
+        args.retention_days,
+        args.dry_run
+    )
+    print(f'{versions_folder}: удалено {len(removed)} устаревших версий')
+    return 0
+
+
+def cmd_bench(args) -> int:
+    """Команда прогоняет бенчмарк этапов на синтетических данных."""
+    from handler.bench import BenchSuite, compare
+
+    suite = BenchSuite(
+        offers=args.offers,
+        images=args.images,
+        latency=args.latency,
+        photoroom_latency=args.photoroom_latency,
+        error_rate=args.error_rate,
+        duplicate_ratio=args.duplicate_ratio,
+        trace_memory=args.memory,
+        stages=tuple(args.stages.split(',')) if args.stages else (
+            BenchSuite.STAGES
+        )
+    )
+    results = suite.run()
+    print(f'Результаты сохранены в {suite.save(args.output)}')
+    if args.compare:
+        with open(args.compare, encoding='utf-8') as f:
+            previous = json.load(f)
+        print('\n'.join(compare(results, previous)))
+    return 0
+
+
+def cmd_daemon(args) -> int:
+    """Команда запускает долгоживущий режим."""
+    from handler.daemon import FeedDaemon
+
+    FeedDaemon().run_forever()
+    return 0
+
+
+def build_parser() -> argparse.ArgumentParser:
+    """Функция, собирает парсер аргументов командной строки."""
+    parser = argparse.ArgumentParser(
+        prog='handler',
+        description='Обработка фидов Yves Rocher по этапам.'
+    )
+    parser.add_argument(
+        '--profile',
+        metavar='STAGES',
+        help='профилировать этапы: save_xml,get_images,FeedHandler.*,all'
+    )
+    parser.add_argument(
+        '--profile-mode',
+        default=None,
+        help='cpu (cProfile), mem (tracemalloc) или cpu,mem'
+    )
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    commands.add_parser('status', help='состояние прогона').set_defaults(
+        func=cmd_status, quiet=True
+    )
+    commands.add_parser('run', help='все этапы').set_defaults(func=cmd_run)
+    commands.add_parser('fetch', help='скачать фиды').set_defaults(
+        func=cmd_fetch
+    )
+    commands.add_parser('images', help='скачать изображения').set_defaults(
+        func=cmd_images
+    )
+    commands.add_parser(
+        'pipeline',
+        help='скачать и обрамить изображения конвейером'
+    ).set_defaults(func=cmd_pipeline)
+    frame = commands.add_parser('frame', help='наложить подложку')
+    frame.add_argument(
+        '--no-publish',
+        action='store_true',
+        help='оставить результат в staging'
+    )
+    frame.set_defaults(func=cmd_frame)
+
+    rewrite = commands.add_parser('rewrite', help='преобразовать фиды')
+    rewrite.add_argument(
+        '--keep-images',
+        action='store_true',
+        help='не подменять изображения'
+    )
+    rewrite.add_argument(
+        '--custom-label',
+        action='store_true',
+        help='добавить custom_label'
+    )
+    rewrite.add_argument(
+        '--delete-offers',
+        action='store_true',
+        help='удалить офферы с categoryId == 0'
+    )
+    rewrite.add_argument(
+        '--no-publish',
+        action='store_true',
+        help='оставить результат в staging'
+    )
+    rewrite.set_defaults(func=cmd_rewrite)
+
+    publish = commands.add_parser(
+        'publish',
+        help='опубликовать измененные файлы'
+    )
+    publish.add_argument(
+        'target',
+        nargs='?',
+        choices=('feeds', 'images', 'all'),
+        default='all'
+    )
+    publish.set_defaults(func=cmd_publish)
+
+    commands.add_parser(
+        'index',
+        help='индекс и статистика фидов'
+    ).set_defaults(func=cmd_index)
+
+    quality = commands.add_parser(
+        'quality',
+        help='отчет о качестве фидов'
+    )
+    quality.add_argument('--feed', help='имя файла фида')
+    quality.add_argument('--json', action='store_true', help='вывод в JSON')
+    quality.set_defaults(func=cmd_quality, quiet=True)
+
+    offer = commands.add_parser('offer', help='XML оффера по id')
+    offer.add_argument('offer_id')
+    offer.add_argument('--feed', help='имя файла фида')
+    offer.set_defaults(func=cmd_offer, quiet=True)
+
+    reprocess = commands.add_parser(
+        'reprocess',
+        help='заново обработать изображения офферов'
+    )
+    reprocess.add_argument('offer_ids', nargs='+', metavar='offer_id')
+    reprocess.add_argument(
+        '--no-frame',
+        action='store_true',
+        help='только скачать и удалить фон'
+    )
+    reprocess.set_defaults(func=cmd_reprocess)
+
+    plan = commands.add_parser(
+        'plan',
+        help='план прогона без сетевых запросов'
+    )
+    plan.add_argument('--json', action='store_true', help='вывод в JSON')
+    plan.set_defaults(func=cmd_plan, quiet=True)
+
+    snapshots = commands.add_parser(
+        'snapshots',
+        help='история фидов',
+        description=(
+            'add - снять скачанные фиды; list; diff A B; history ID; '
+            'show SEQ ID; restore SEQ FILE'
+        )
+    )
+    snapshots.add_argument(
+        'action',
+        choices=('add', 'list', 'diff', 'history', 'show', 'restore')
+    )
+    snapshots.add_argument('args', nargs='*')
+    snapshots.add_argument('--feed', help='имя файла фида')
+    snapshots.add_argument('--json', action='store_true')
+    snapshots.set_defaults(func=cmd_snapshots, quiet=True)
+
+    queue = commands.add_parser(
+        'queue',
+        help='очередь заданий изображений для нескольких обработчиков'
+    )
+    queue.add_argument('action', choices=('fill', 'work', 'status', 'retry'))
+    queue.add_argument('--feed', help='имя файла фида для fill')
+    queue.add_argument(
+        '--no-frame',
+        action='store_true',
+        help='только скачать и удалить фон'
+    )
+    queue.add_argument('--batch', type=int, default=QUEUE_BATCH)
+    queue.add_argument(
+        '--once',
+        action='store_true',
+        help='обработать одну пачку и выйти'
+    )
+    queue.set_defaults(func=cmd_queue)
+
+    gc = commands.add_parser('gc', help='удалить осиротевшие изображения')
+    gc.add_argument('--dry-run', action='store_true')
+    gc.add_argument(
+        '--retention-days',
+        type=int,
+        default=PICTURE_VERSIONS_RETENTION_DAYS,
+        help='сколько дней хранить устаревшие версии изображений'
+    )
+    gc.set_defaults(func=cmd_gc)
+
+    bench = commands.add_parser('bench', help='бенчмарк на синтетике')
+    bench.add_argument('--offers', type=int, default=10000)
+    bench.add_argument('--images', type=int, default=100)
+    bench.add_argument('--latency', type=float, default=0.0)
+    bench.add_argument('--photoroom-latency', type=float, default=0.0)
+    bench.add_argument('--error-rate', type=float, default=0.0)
+    bench.add_argument('--duplicate-ratio', type=float, default=0.1)
+    bench.add_argument(
+        '--memory',
+        action='store_true',
+        help='замерять пик памяти через tracemalloc (замедляет этапы)'
+    )
+    bench.add_argument('--stages', help='этапы через запятую')
+    bench.add_argument('--output', default='bench_results')
+    bench.add_argument('--compare', help='JSON прошлого прогона')
+    bench.set_defaults(func=cmd_bench)
+
+    commands.add_parser('daemon', help='долгоживущий режим').set_defaults(
+        func=cmd_daemon
+    )
+    return parser
+
+
+def main(argv: list[str] | None = None) -> int:
+    args = build_parser().parse_args(argv)
+    if not getattr(args, 'quiet', False):
+        from handler.logging_config import setup_logging
+
+        setup_logging()
+    if args.profile or args.profile_mode:
+        from handler.profiling import configure
+
+        configure(args.profile, args.profile_mode)
+    return args.func(args)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,194 @@
+"""
+Наложение товаров на подложку средствами NumPy.
+
+Повторяет Image.paste(product, box, product) из Pillow байт в байт:
+каждый канал, включая альфу, смешивается по маске из альфы товара
+по формуле Pillow DIV255(canvas * (255 - mask) + product * mask).
+В отличие от Pillow, подложка не копируется на каждый оффер: кадры
+пишутся в заранее выделенные буферы и между пачками восстанавливаются
+только в области товара. Товары одного размера смешиваются пачкой
+одной векторной операцией, арифметика считается только для
+полупрозрачных пикселей.
+"""
+from collections.abc import Iterator
+
+import numpy as np
+from PIL import Image
+
+from handler.constants import COMPOSITE_BATCH
+
+OPAQUE = 0xFF000000
+"""Пиксель RGBA как little-endian uint32 с альфой 255 и выше."""
+
+VISIBLE = 0x01000000
+"""Пиксель RGBA как little-endian uint32 с ненулевой альфой."""
+
+MAX_SOURCE_BUFFERS = 32
+"""Сколько буферов товаров разных размеров держать в памяти."""
+
+
+class NumpyCompositor:
+    """
+    Класс, накладывающий пачки товаров на подложку.
+
+    Изображения, которые отдает composite(), ссылаются на внутренний
+    буфер и действительны только до следующего шага итератора: их нужно
+    сразу закодировать (save) или скопировать.
+    """
+
+    def __init__(self, batch_size: int = COMPOSITE_BATCH) -> None:
+        self.batch_size = max(1, batch_size)
+        self._canvases: dict[int, tuple] = {}
+        self._frames: dict[tuple, np.ndarray] = {}
+        self._sources: dict[tuple, np.ndarray] = {}
+        self._frame_state: dict[tuple, tuple] = {}
+
+    def _canvas_array(self, canvas: Image.Image) -> np.ndarray:
+        """Защищенный метод, возвращает подложку как массив (с кэшем)."""
+        cached = self._canvases.get(id(canvas))
+        if cached is None or cached[0] is not canvas:
+            cached = (canvas, np.asarray(canvas.convert('RGBA')))
+            self._canvases[id(canvas)] = cached
+        return cached[1]
+
+    def _frame_buffer(self, shape: tuple) -> np.ndarray:
+        """Защищенный метод, возвращает буфер кадров пачки."""
+        key = (self.batch_size,) + shape
+        frames = self._frames.get(key)
+        if frames is None:
+            frames = np.empty(key, dtype=np.uint8)
+            self._frames[key] = frames
+        return frames
+
+    def _source_buffer(self, shape: tuple) -> np.ndarray:
+        """Защищенный метод, возвращает буфер товаров пачки под размер."""
+        sources = self._sources.get(shape)
+        if sources is None:
+            if len(self._sources) >= MAX_SOURCE_BUFFERS:
+                self._sources.clear()
+            sources = np.empty((self.batch_size,) + shape, np.uint8)
+            self._sources[shape] = sources
+        return sources
+
+    @staticmethod
+    def _blend(region: np.ndarray, product: np.ndarray) -> None:
+        """
+        Защищенный метод, смешивает товары пачки с областью кадров.
+
+        Формула Pillow: v = canvas * (255 - m) + product * m + 128,
+        результат ((v >> 8) + v) >> 8. При m == 255 она дает пиксель
+        товара, при m == 0 - пиксель подложки, поэтому непрозрачные
+        пиксели копируются целиком (как uint32), прозрачные
+        пропускаются, а арифметика считается только для полупрозрачных
+        (обычно это контур товара).
+        """
+        region_pixels = region.view('<u4')[..., 0]
+        product_pixels = product.view('<u4')[..., 0]
+        opaque = product_pixels >= OPAQUE
+        np.copyto(region_pixels, product_pixels, where=opaque)
+        partial = product_pixels >= VISIBLE
+        partial &= ~opaque
+        index = np.unravel_index(np.flatnonzero(partial), partial.shape)
+        if not index[0].size:
+            return
+        canvas = region_pixels[index].view(np.uint8).reshape(-1, 4)
+        pixels = product_pixels[index].view(np.uint8).reshape(-1, 4)
+        mask = pixels[:, 3:4].astype(np.uint16)
+        value = canvas * (255 - mask)
+        value += pixels * mask
+        value += 128
+        value += value >> 8
+        value >>= 8
+        region_pixels[index] = value.astype(np.uint8).view('<u4')[:, 0]
+
+    def _reset_frames(
+        self,
+        frames: np.ndarray,
+        canvas: Image.Image,
+        canvas_array: np.ndarray,
+        count: int
+    ) -> list:
+        """
+        Защищенный метод, возвращает кадры пачки к чистой подложке.
+
+        Если буфер уже заполнен этой же подложкой, восстанавливаются
+        только области, куда накладывались товары прошлой пачки, а не
+        весь кадр. Возвращает список "грязных" областей по слотам.
+        """
+        key = frames.shape
+        state = self._frame_state.get(key)
+        if state is None or state[0] is not canvas:
+            np.copyto(frames, canvas_array)
+            state = (canvas, [None] * self.batch_size)
+            self._frame_state[key] = state
+            return state[1]
+        dirty = state[1]
+        for slot in range(count):
+            if dirty[slot] is not None:
+                rows, columns = dirty[slot]
+                np.copyto(
+                    frames[slot, rows, columns],
+                    canvas_array[rows, columns]
+                )
+                dirty[slot] = None
+        return dirty
+
+    def composite(
+        self,
+        canvas: Image.Image,
+        placements: list[tuple[Image.Image, tuple[int, int]]]
+    ) -> Iterator[tuple[int, Image.Image]]:
+        """
+        Метод накладывает товары (RGBA, координата левого верхнего
+        угла) на подложку и отдает пары (индекс в placements, кадр).
+
+        Товары группируются по размеру и положению, каждая группа
+        смешивается пачками по batch_size. Части товара за границами
+        подложки отбрасываются, как в Pillow.
+        """
+        canvas_array = self._canvas_array(canvas)
+        canvas_height, canvas_width = canvas_array.shape[:2]
+        frames = self._frame_buffer(canvas_array.shape)
+        groups: dict[tuple, list[int]] = {}
+        for index, (product, box) in enumerate(placements):
+            groups.setdefault((product.size, tuple(box)), []).append(index)
+
+        for ((width, height), (x, y)), indexes in groups.items():
+            left, top = max(x, 0), max(y, 0)
+            right = min(x + width, canvas_width)
+            bottom = min(y + height, canvas_height)
+            sources = self._source_buffer((height, width, 4))
+            for start in range(0, len(indexes), self.batch_size):
+                batch = indexes[start:start + self.batch_size]
+                count = len(batch)
+                dirty = self._reset_frames(
+                    frames,
+                    canvas,
+                    canvas_array,
+                    count
+                )
+                if left < right and top < bottom:
+                    for position, index in enumerate(batch):
+                        product = placements[index][0]
+                        if product.mode != 'RGBA':
+                            product = product.convert('RGBA')
+                        np.copyto(sources[position], np.asarray(product))
+                    self._blend(
+                        frames[:count, top:bottom, left:right],
+                        sources[
+                            :count, top - y:bottom - y, left - x:right - x
+                        ]
+                    )
+                    dirty[:count] = [
+                        (slice(top, bottom), slice(left, right))
+                    ] * count
+                for position, index in enumerate(batch):
+                    yield index, Image.frombuffer(
+                        'RGBA',
+                        (canvas_width, canvas_height),
+                        frames[position],
+                        'raw',
+                        'RGBA',
+                        0,
+                        1
+                    )
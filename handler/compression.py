@@ -0,0 +1,142 @@
+"""
+Сжатые копии выходных файлов, которые пишутся вместе с оригиналом.
+
+CompressingWriter оборачивает файл: каждый записанный блок уходит в
+файл как есть и в потоковые компрессоры, результат которых пишется в
+соседние файлы {имя}.gz и {имя}.zst. Второго прохода по файлу нет.
+
+gzip собирается через zlib без имени файла и времени в заголовке,
+поэтому одинаковый XML дает одинаковые байты архива и публикация
+(handler.publish) не перевыкладывает неизменившиеся копии. zstd
+доступен, если установлен пакет zstandard.
+"""
+import io
+import logging
+import time
+import zlib
+
+from handler.constants import GZIP_LEVEL, ZSTD_LEVEL
+from handler.metrics import REGISTRY
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+COMPRESSION_EXTENSIONS = {'gzip': 'gz', 'zstd': 'zst'}
+"""Поддерживаемые форматы сжатия и расширения файлов."""
+
+
+def parse_formats(spec: str) -> tuple[str, ...]:
+    """
+    Функция, разбирает список форматов из строки вида 'gzip,zstd'.
+
+    Неизвестные форматы и zstd без пакета zstandard пропускаются с
+    предупреждением.
+    """
+    formats = []
+    for name in spec.split(','):
+        name = name.strip().lower()
+        if not name or name == 'none':
+            continue
+        if name not in COMPRESSION_EXTENSIONS:
+            logging.warning('Неизвестный формат сжатия %s', name)
+            continue
+        if name == 'zstd' and zstandard is None:
+            logging.warning('Сжатие zstd пропущено: zstandard не установлен')
+            continue
+        formats.append(name)
+    return tuple(formats)
+
+
+def _make_compressor(name: str):
+    """Защищенная функция, создает потоковый компрессор формата."""
+    if name == 'gzip':
+        return zlib.compressobj(GZIP_LEVEL, zlib.DEFLATED, 31)
+    return zstandard.ZstdCompressor(level=ZSTD_LEVEL).compressobj()
+
+
+class CompressingWriter(io.RawIOBase):
+    """
+    Файл, который дублирует запись в сжатые копии.
+
+    siblings - словарь {формат: открытый бинарный файл копии}.
+    Поддерживается перезапись с начала (seek(0) и truncate()), которая
+    нужна откату write_xml на сериализатор ElementTree.
+    """
+
+    def __init__(self, file, siblings: dict) -> None:
+        super().__init__()
+        self.file = file
+        self.siblings = siblings
+        self.seconds = 0.0
+        self._compressors = {}
+        self._reset()
+
+    def _reset(self) -> None:
+        """Защищенный метод, начинает сжатые копии заново."""
+        for sibling in self.siblings.values():
+            sibling.seek(0)
+            sibling.truncate()
+        self._compressors = {
+            name: _make_compressor(name) for name in self.siblings
+        }
+
+    def writable(self) -> bool:
+        return True
+
+    def seekable(self) -> bool:
+        return True
+
+    def write(self, data) -> int:
+        written = self.file.write(data)
+        start = time.perf_counter()
+        for name, compressor in self._compressors.items():
+            self.siblings[name].write(compressor.compress(data))
+        self.seconds += time.perf_counter() - start
+        return written
+
+    def tell(self) -> int:
+        return self.file.tell()
+
+    def seek(self, offset: int, whence: int = io.SEEK_SET) -> int:
+        if offset or whence != io.SEEK_SET:
+            raise io.UnsupportedOperation('Допустим только seek(0)')
+        self._reset()
+        return self.file.seek(0)
+
+    def truncate(self, size: int | None = None) -> int:
+        return self.file.truncate(size)
+
+    def finish(self, label: str) -> dict:
+        """
+        Метод дописывает хвосты компрессоров, пишет метрики и
+        возвращает размеры сжатых копий по форматам.
+        """
+        start = time.perf_counter()
+        for name, compressor in self._compressors.items():
+            self.siblings[name].write(compressor.flush())
+        self.seconds += time.perf_counter() - start
+        sizes = {
+            name: sibling.tell() for name, sibling in self.siblings.items()
+        }
+        for name, size in sizes.items():
+            REGISTRY.gauge(
+                'output_compressed_bytes',
+                'Размер сжатой копии выходного файла',
+                file=label,
+                format=name
+            ).set(size)
+        if sizes:
+            REGISTRY.counter(
+                'output_compress_seconds_total',
+                'Время сжатия выходных файлов'
+            ).inc(self.seconds)
+            REGISTRY.gauge('output_bytes', file=label).set(self.file.tell())
+            logging.info(
+                'Сжатые копии %s: %s байт, сжатие %.2f сек',
+                label,
+                sizes,
+                self.seconds
+            )
+        return sizes
@@ -7,12 +7,44 @@ load_dotenv()
 ADDRESS_FTP_IMAGES = 'https://feeds.i-media.ru/projects/yvesrocher/new_images'
 """Адрес директории на ftp для изображений."""
 
+PICTURE_VERSIONING = os.getenv('PICTURE_VERSIONING', 'query')
+"""
+Версия изображения в адресе <picture>: 'query' - {id}.png?v={hash},
+'filename' - {PICTURE_VERSIONS_FOLDER}/{id}.{hash}.png, 'off' - без версии.
+"""
+
+PICTURE_HASH_LENGTH = 8
+"""Число символов sha256 изображения в версии адреса."""
+
+PICTURE_VERSIONS_FOLDER = 'v'
+"""Поддиректория изображений с версией в имени файла."""
+
+PICTURE_VERSIONS_RETENTION_DAYS = int(
+    os.getenv('PICTURE_VERSIONS_RETENTION_DAYS', '7')
+)
+"""Сколько дней хранить устаревшие версии изображений."""
+
+PHOTOROOM_URL = os.getenv(
+    'PHOTOROOM_URL',
+    'https://image-api.photoroom.com/v2/edit'
+)
+"""Адрес PhotoRoom API для удаления фона."""
+
 ATTEMPTION_LOAD_FEED = 3
 """Попытки для скачивания фида."""
 
 DELAY_FOR_RETRY = (5, 15, 30)
 """Задержки между переподключениями."""
 
+RETRY_HTTP_CODES = frozenset({429, 500, 502, 503, 504})
+"""HTTP-коды, при которых запрос повторяется."""
+
+RETRY_BUDGET = int(os.getenv('RETRY_BUDGET', '500'))
+"""Максимум повторов запросов за прогон по всем сервисам."""
+
+RETRY_BUDGET_SECONDS = float(os.getenv('RETRY_BUDGET_SECONDS', '900'))
+"""Максимум суммарного ожидания между повторами за прогон, в секундах."""
+
 DATE_FORMAT = '%Y-%m-%d'
 """Формат даты по умолчанию."""
 
@@ -33,9 +65,70 @@ NUMBER_PIXELS_IMAGE = 200
 
 NAME_OF_CANVAS = 'canvas.png'
 
+MAX_IMAGE_BYTES = int(os.getenv('MAX_IMAGE_BYTES', str(20 * 1024 * 1024)))
+"""Максимальный размер скачиваемого изображения, в байтах."""
+
+IMAGE_CHUNK_SIZE = 64 * 1024
+"""Размер блока при потоковом скачивании изображения, в байтах."""
+
+IMAGE_SIGNATURES = (
+    (b'\xff\xd8\xff', 'jpeg'),
+    (b'\x89PNG\r\n\x1a\n', 'png'),
+    (b'GIF87a', 'gif'),
+    (b'GIF89a', 'gif'),
+    (b'RIFF', 'webp'),
+    (b'BM', 'bmp'),
+)
+"""Сигнатуры (magic bytes) допустимых форматов изображений."""
+
+UPLOAD_DOWNSCALE = os.getenv('UPLOAD_DOWNSCALE', '1') == '1'
+"""
+Уменьшать изображение перед отправкой в PhotoRoom до размера,
+нужного самому большому варианту плана рендеринга.
+"""
+
+UPLOAD_QUALITY = int(os.getenv('UPLOAD_QUALITY', '90'))
+"""Качество JPEG при перекодировании изображения перед отправкой."""
+
 FRAME_FOLDER = os.getenv('FRAME_FOLDER', 'frame')
 """Константа стокового названия директории c рамкой"""
 
+RENDER_PLAN = os.getenv('RENDER_PLAN', 'render_plan.json')
+"""
+Файл плана рендеринга в директории рамки. Если файла нет,
+рендерится один вариант 1000x1000 PNG на canvas.png.
+"""
+
+XML_BACKEND = os.getenv('XML_BACKEND', 'auto')
+"""Библиотека разбора XML: 'auto' (lxml, если установлен), 'lxml', 'etree'."""
+
+COMPOSITE_ENGINE = os.getenv('COMPOSITE_ENGINE', 'pillow')
+"""Движок наложения товара на подложку: 'pillow' или 'numpy'."""
+
+COMPOSITE_BATCH = int(os.getenv('COMPOSITE_BATCH', '8'))
+"""Размер пачки изображений для движка 'numpy'."""
+
+PIPELINE_WORKERS = os.getenv(
+    'PIPELINE_WORKERS',
+    'fetch=8,validate=2,remove_bg=4,composite=2,encode=2,publish=1'
+)
+"""Число рабочих потоков этапов конвейера изображений."""
+
+PIPELINE_QUEUE_SIZE = int(os.getenv('PIPELINE_QUEUE_SIZE', '16'))
+"""Емкость очереди между этапами конвейера."""
+
+FEEDS_CONFIG = os.getenv('FEEDS_CONFIG', 'feeds.json')
+"""Файл конфигурации фидов (см. handler.feed_config)."""
+
+FEED_CONCURRENCY = int(os.getenv('FEED_CONCURRENCY', '4'))
+"""Сколько фидов обрабатывается одновременно."""
+
+CPU_BUDGET = int(os.getenv('CPU_BUDGET', str(os.cpu_count() or 1)))
+"""Общий лимит одновременных вычислительных операций всех фидов."""
+
+NETWORK_BUDGET = int(os.getenv('NETWORK_BUDGET', '8'))
+"""Общий лимит одновременных сетевых запросов всех фидов."""
+
 FEEDS_FOLDER = os.getenv('FEEDS_FOLDER', 'temp_feeds')
 """Константа стокового названия директории с фидами."""
 
@@ -48,9 +141,109 @@ IMAGE_FOLDER = os.getenv('IMAGE_FOLDER', 'old_images')
 NEW_IMAGE_FOLDER = os.getenv('NEW_IMAGE_FOLDER', 'new_images')
 """Константа стокового названия директории измененных изображений."""
 
+JOURNAL_FOLDER = os.getenv('JOURNAL_FOLDER', 'state')
+"""Константа стокового названия директории с журналом прогонов."""
+
+JOURNAL_MAX_RESUMES = int(os.getenv('JOURNAL_MAX_RESUMES', 3))
+"""
+Сколько раз прерванный прогон продолжается после падения процесса;
+дальше начинается новый прогон со скачиванием свежего фида.
+"""
+
+QUEUE_DB = os.getenv('QUEUE_DB', 'state/image_jobs.sqlite3')
+"""
+Файл SQLite очереди заданий изображений. Для нескольких контейнеров
+должен лежать на общем томе, как и директории изображений.
+"""
+
+QUEUE_LEASE_SECONDS = int(os.getenv('QUEUE_LEASE_SECONDS', 300))
+"""Срок аренды задания; без продления задание снова выдается другим."""
+
+QUEUE_BATCH = int(os.getenv('QUEUE_BATCH', 16))
+"""Сколько заданий обработчик берет за раз."""
+
+QUEUE_MAX_ATTEMPTS = int(os.getenv('QUEUE_MAX_ATTEMPTS', 5))
+"""Число попыток задания, после которого оно считается проваленным."""
+
+QUEUE_RETRY_DELAY = int(os.getenv('QUEUE_RETRY_DELAY', 60))
+"""Задержка перед повтором задания, сек; удваивается с каждой попыткой."""
+
+QUEUE_POLL_SECONDS = int(os.getenv('QUEUE_POLL_SECONDS', 10))
+"""Пауза обработчика, когда свободных заданий нет, а арендованные есть."""
+
+QUALITY_SAMPLES = int(os.getenv('QUALITY_SAMPLES', 10))
+"""Сколько примеров id на правило хранит отчет о качестве фида."""
+
+TEMP_FILE_MAX_AGE = int(os.getenv('TEMP_FILE_MAX_AGE', 600))
+"""
+Возраст временного файла, сек, после которого он считается брошенным
+прерванным прогоном. Более свежие файлы могут дописываться другим
+обработчиком очереди или конвейером соседнего фида.
+"""
+
+SNAPSHOTS = os.getenv('SNAPSHOTS', '1') == '1'
+"""Сохранять ли каждый скачанный фид в хранилище снимков."""
+
+SNAPSHOT_DB = os.getenv('SNAPSHOT_DB', 'snapshots.sqlite3')
+"""Файл SQLite хранилища снимков фидов в директории журнала."""
+
+SNAPSHOT_DELTA_DEPTH = int(os.getenv('SNAPSHOT_DELTA_DEPTH', 16))
+"""
+Наибольшая длина цепочки дельт оффера; следующая версия сжимается
+целиком, чтобы чтение не распаковывало длинную цепочку.
+"""
+
+STAGING_FOLDER = '.staging'
+"""
+Скрытая поддиректория раздаваемой директории, куда этапы пишут
+результаты до публикации.
+"""
+
+PUBLISH_MANIFEST = '.publish_manifest.json'
+"""Манифест опубликованных файлов (sha256, размер, время публикации)."""
+
+PICTURES_STATE = '.pictures.json'
+"""
+Файл в директории исходников со ссылками на картинки, из которых они
+получены ({offer_id: url}); по нему видно, что картинка оффера сменилась.
+"""
+
+METRICS_FOLDER = os.getenv('METRICS_FOLDER', 'metrics')
+"""Директория для сводки метрик и файла Prometheus."""
+
+PROFILE_STAGES = os.getenv('PROFILE_STAGES', '')
+"""
+Этапы для профилирования через запятую, например
+'save_xml,get_images,FeedHandler.*' (пусто - профилирование выключено).
+"""
+
+PROFILE_MODE = os.getenv('PROFILE_MODE', 'cpu')
+"""Режимы профилирования через запятую: cpu (cProfile), mem (tracemalloc)."""
+
+DAEMON_INTERVAL = int(os.getenv('DAEMON_INTERVAL', '3600'))
+"""Интервал между обновлениями в режиме демона, в секундах."""
+
+DAEMON_SOCKET = os.getenv('DAEMON_SOCKET', '')
+"""Путь к Unix-сокету для управления демоном (пусто - без сокета)."""
+
 ENCODING = 'utf-8'
 """Кодировка по умолчанию."""
 
+OUTPUT_ENCODING = os.getenv('OUTPUT_ENCODING', 'windows-1251')
+"""Кодировка обработанных фидов."""
+
+OUTPUT_COMPRESSION = os.getenv('OUTPUT_COMPRESSION', 'gzip')
+"""
+Сжатые копии обработанных фидов через запятую: gzip, zstd
+(нужен пакет zstandard); пусто или 'none' - без копий.
+"""
+
+GZIP_LEVEL = int(os.getenv('GZIP_LEVEL', '6'))
+"""Уровень сжатия gzip (1-9)."""
+
+ZSTD_LEVEL = int(os.getenv('ZSTD_LEVEL', '3'))
+"""Уровень сжатия zstd (1-22)."""
+
 HEADERS = {
     'accept': 'text/html,application/xhtml+xml,application/xml;q=0.9,image/'
     'avif,image/webp,image/apng,*/*;q=0.8,application/'
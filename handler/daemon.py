@@ -0,0 +1,171 @@
+import logging
+import os
+import signal
+import socket
+import threading
+
+import requests
+
+from handler.constants import DAEMON_INTERVAL, DAEMON_SOCKET
+from handler.decorators import export_metrics, time_of_function, time_of_script
+from handler.logging_config import setup_logging
+from handler.main import run_pipeline
+from handler.scheduler import FeedScheduler
+
+
+class FeedDaemon:
+    """
+    Класс, предоставляющий долгоживущий режим обработки фидов.
+
+    Между циклами в памяти остаются:
+    - HTTP-сессия с пулом соединений;
+    - планировщик фидов с экземплярами FeedImage по фидам: множества
+    готовых офферов, индекс ссылок на картинки прошлого фида и
+    подготовленная подложка.
+
+    Очередной цикл запускается по интервалу, по сигналу SIGHUP/SIGUSR1
+    или по команде 'refresh' в Unix-сокет. Команда 'status' возвращает
+    состояние, 'stop' (или SIGTERM/SIGINT) завершает демон после
+    текущего цикла.
+    """
+
+    def __init__(
+        self,
+        interval: int = DAEMON_INTERVAL,
+        socket_path: str = DAEMON_SOCKET
+    ) -> None:
+        self.interval = interval
+        self.socket_path = socket_path
+        self.session = requests.Session()
+        self.scheduler: FeedScheduler | None = None
+        self.cycles = 0
+        self.last_error: str | None = None
+        self._trigger = threading.Event()
+        self._stop = threading.Event()
+        self._busy = threading.Lock()
+
+    def refresh(self) -> None:
+        """Метод запрашивает внеочередной цикл обновления."""
+        self._trigger.set()
+
+    def stop(self) -> None:
+        """Метод останавливает демон после текущего цикла."""
+        self._stop.set()
+        self._trigger.set()
+
+    def status(self) -> str:
+        """Метод возвращает краткое состояние демона."""
+        state = 'busy' if self._busy.locked() else 'idle'
+        offers = 0
+        if self.scheduler is not None:
+            offers = sum(
+                len(image_client.offer_pictures)
+                for image_client in self.scheduler.image_clients.values()
+            )
+        return (
+            f'{state} cycles={self.cycles} offers={offers} '
+            f'last_error={self.last_error or "-"}'
+        )
+
+    @time_of_function
+    def run_cycle(self) -> None:
+        """Метод выполняет один цикл обработки на теплом состоянии."""
+        with self._busy:
+            try:
+                if self.scheduler is None:
+                    self.scheduler = FeedScheduler.from_config(
+                        session=self.session
+                    )
+                run_pipeline(self.scheduler)
+                self.last_error = None
+            except Exception as error:
+                self.last_error = f'{type(error).__name__}: {error}'
+                logging.error('Цикл обновления завершился ошибкой: %s', error)
+            finally:
+                self.cycles += 1
+                export_metrics({
+                    'CYCLE': self.cycles,
+                    'ERROR_MESSAGE': self.last_error,
+                })
+
+    def _handle_signal(self, signum, frame) -> None:
+        """Защищенный метод, обрабатывает управляющие сигналы."""
+        if signum in (signal.SIGTERM, signal.SIGINT):
+            logging.info('Получен сигнал %s, остановка демона', signum)
+            self.stop()
+        else:
+            logging.info('Получен сигнал %s, внеочередное обновление', signum)
+            self.refresh()
+
+    def _serve_socket(self, server: socket.socket) -> None:
+        """Защищенный метод, принимает команды из Unix-сокета."""
+        commands = {
+            'refresh': self.refresh,
+            'stop': self.stop,
+        }
+        while not self._stop.is_set():
+            try:
+                connection, _ = server.accept()
+            except OSError:
+                break
+            with connection:
+                command = connection.recv(64).decode().strip()
+                if command in commands:
+                    commands[command]()
+                    connection.sendall(b'ok\n')
+                elif command == 'status':
+                    connection.sendall(f'{self.status()}\n'.encode())
+                else:
+                    connection.sendall(b'unknown command\n')
+
+    def _open_socket(self) -> socket.socket | None:
+        """Защищенный метод, открывает управляющий Unix-сокет."""
+        if not self.socket_path:
+            return None
+        if os.path.exists(self.socket_path):
+            os.unlink(self.socket_path)
+        server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        server.bind(self.socket_path)
+        server.listen()
+        threading.Thread(
+            target=self._serve_socket,
+            args=(server,),
+            name='daemon-socket',
+            daemon=True
+        ).start()
+        logging.info('Управляющий сокет открыт: %s', self.socket_path)
+        return server
+
+    def run_forever(self) -> None:
+        """Метод запускает бесконечный цикл обновлений."""
+        for signum in (
+            signal.SIGHUP, signal.SIGUSR1, signal.SIGTERM, signal.SIGINT
+        ):
+            signal.signal(signum, self._handle_signal)
+        server = self._open_socket()
+        logging.info(
+            'Демон запущен, интервал обновления %s сек',
+            self.interval
+        )
+        try:
+            while not self._stop.is_set():
+                self.run_cycle()
+                self._trigger.wait(self.interval)
+                self._trigger.clear()
+        finally:
+            if server is not None:
+                server.close()
+                if os.path.exists(self.socket_path):
+                    os.unlink(self.socket_path)
+            self.session.close()
+            logging.info('Демон остановлен после %s циклов', self.cycles)
+
+
+@time_of_script
+def main():
+    FeedDaemon().run_forever()
+
+
+if __name__ == '__main__':
+    setup_logging()
+    main()
@@ -1,27 +1,34 @@
+import asyncio
 import functools
 import json
 import logging
 import random
+import threading
 import time
 from datetime import datetime as dt
 from http.client import IncompleteRead
-
-import requests
+from pathlib import Path
 
 from handler.constants import (ATTEMPTION_LOAD_FEED, DATE_FORMAT,
-                               DELAY_FOR_RETRY, TIME_FORMAT)
+                               DELAY_FOR_RETRY, METRICS_FOLDER, RETRY_BUDGET,
+                               RETRY_BUDGET_SECONDS, RETRY_HTTP_CODES,
+                               TIME_FORMAT)
 from handler.exceptions import (DirectoryCreationError, EmptyFeedsListError,
                                 GetTreeError, StructureXMLError)
-from handler.logging_config import setup_logging
-
-setup_logging()
+from handler.metrics import REGISTRY
+from handler.profiling import STAGE_PEAK_RSS, peak_rss_bytes, profile_stage
 
 
 def time_of_script(func):
-    """Универсальный декоратор для логирования выполнения."""
+    """
+    Универсальный декоратор для логирования выполнения.
+
+    По завершении выгружает реестр метрик в METRICS_FOLDER:
+    JSON-сводку прогона и текстовый файл Prometheus.
+    """
     @functools.wraps(func)
     def wrapper(*args, **kwargs):
-        start_ts = time.time()
+        start_ts = time.perf_counter()
         date_str = dt.now().strftime(DATE_FORMAT)
 
         print(
@@ -42,7 +49,7 @@ def time_of_script(func):
             raise
 
         finally:
-            exec_time_sec = round(time.time() - start_ts, 3)
+            exec_time_sec = round(time.perf_counter() - start_ts, 3)
 
             print(
                 f'Функция {func.__name__} завершила работу '
@@ -57,21 +64,43 @@ def time_of_script(func):
                 "EXECUTION_TIME": exec_time_sec,
                 "ERROR_TYPE": error_type,
                 "ERROR_MESSAGE": error_message,
+                "PEAK_RSS_MB": round(peak_rss_bytes() / 1024 / 1024, 1),
+                "STAGE_PEAK_RSS_MB": {
+                    stage: round(peak / 1024 / 1024, 1)
+                    for stage, peak in STAGE_PEAK_RSS.items()
+                },
                 "ENDLOGGING": 1
             }
 
             logging.info(json.dumps(log_record, ensure_ascii=False))
+            export_metrics(log_record)
 
     return wrapper
 
 
+def export_metrics(extra: dict | None = None) -> None:
+    """Функция выгружает реестр метрик, не прерывая работу при ошибке."""
+    REGISTRY.gauge(
+        'last_run_timestamp_seconds',
+        'Время окончания последнего прогона'
+    ).set(round(time.time()))
+    try:
+        REGISTRY.export(Path(__file__).parent.parent / METRICS_FOLDER, extra)
+    except OSError as error:
+        logging.error('Не удалось выгрузить метрики: %s', error)
+
+
 def time_of_function(func):
     """
     Декоратор для измерения времени выполнения функции.
 
-    Замеряет время выполнения декорируемой функции и логирует результат
-    в секундах и минутах. Время округляется до 3 знаков после запятой
-    для секунд и до 2 знаков для минут.
+    Замеряет время выполнения декорируемой функции по монотонным часам
+    и логирует результат в секундах и минутах. Время округляется до
+    3 знаков после запятой для секунд и до 2 знаков для минут.
+    Длительность также попадает в гистограмму stage_duration_seconds
+    с меткой stage, а ошибки - в счетчик stage_errors_total.
+    Выполнение обернуто в profile_stage, поэтому этап можно
+    профилировать через PROFILE_STAGES без правки кода.
 
     Args:
         func (callable): Декорируемая функция, время выполнения которой
@@ -81,10 +110,34 @@ def time_of_function(func):
         callable: Обёрнутая функция с добавленной функциональностью
         замера времени.
     """
+    histogram = REGISTRY.histogram(
+        'stage_duration_seconds',
+        'Длительность этапов обработки',
+        stage=func.__name__
+    )
+
+    @functools.wraps(func)
     def wrapper(*args, **kwargs):
-        start_time = time.time()
-        result = func(*args, **kwargs)
-        execution_time = round(time.time() - start_time, 3)
+        start_time = time.perf_counter()
+        try:
+            with profile_stage(func.__qualname__):
+                result = func(*args, **kwargs)
+        except Exception:
+            REGISTRY.counter(
+                'stage_errors_total',
+                'Этапы, завершившиеся исключением',
+                stage=func.__name__
+            ).inc()
+            raise
+        finally:
+            elapsed = time.perf_counter() - start_time
+            histogram.observe(elapsed)
+            REGISTRY.gauge(
+                'stage_peak_rss_bytes',
+                'Пиковый RSS процесса на момент окончания этапа',
+                stage=func.__name__
+            ).set(STAGE_PEAK_RSS[func.__qualname__])
+        execution_time = round(elapsed, 3)
         logging.info(
             f'Функция {func.__name__} завершила работу. '
             f'Время выполнения - {execution_time} сек. '
@@ -94,52 +147,259 @@ def time_of_function(func):
     return wrapper
 
 
-def retry_on_network_error(
-    max_attempts=ATTEMPTION_LOAD_FEED,
-    delays=DELAY_FOR_RETRY
-):
-    """Декоратор для повторных попыток скачивания при сетевых ошибках."""
+class RetryPolicy:
+    """
+    Политика повторов для одного внешнего сервиса.
+
+    - max_attempts - максимум попыток (включая первую);
+    - delays - явные задержки по попыткам, иначе экспонента от
+    base_delay до max_delay с jitter;
+    - retry_http_codes - HTTP-коды, при которых запрос повторяется;
+    - deadline - предел общего времени вызова с учетом ожидания,
+    повтор, который не укладывается в него, не выполняется.
+    """
+
+    def __init__(
+        self,
+        name: str,
+        max_attempts: int = 3,
+        base_delay: float = 1.0,
+        max_delay: float = 30.0,
+        delays: tuple | None = None,
+        retry_http_codes: frozenset = RETRY_HTTP_CODES,
+        deadline: float | None = None
+    ) -> None:
+        self.name = name
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.delays = delays
+        self.retry_http_codes = retry_http_codes
+        self.deadline = deadline
+
+    def retry_reason(self, error: Exception) -> str | None:
+        """Метод возвращает причину повтора или None, если не повторять."""
+        import requests
+
+        if isinstance(error, requests.exceptions.HTTPError):
+            response = error.response
+            status = response.status_code if response is not None else None
+            if status in self.retry_http_codes:
+                return f'HTTP {status}'
+            return None
+        if isinstance(error, (
+            IncompleteRead,
+            ConnectionError,
+            TimeoutError,
+            requests.exceptions.ConnectionError,
+            requests.exceptions.ChunkedEncodingError,
+            requests.exceptions.Timeout,
+        )):
+            return type(error).__name__
+        return None
+
+    def delay(self, attempt: int, error: Exception) -> float:
+        """
+        Метод считает задержку перед попыткой attempt + 1.
+
+        Заголовок Retry-After ответа (429/503) имеет приоритет,
+        но не превышает max_delay.
+        """
+        response = getattr(error, 'response', None)
+        retry_after = None
+        if response is not None:
+            retry_after = response.headers.get('Retry-After')
+        if retry_after and retry_after.isdigit():
+            return min(float(retry_after), self.max_delay)
+        if self.delays:
+            return self.delays[min(attempt - 1, len(self.delays) - 1)]
+        delay = min(self.base_delay * (2 ** (attempt - 1)), self.max_delay)
+        return delay * random.uniform(0.5, 1.5)
+
+
+class RetryBudget:
+    """
+    Общий бюджет повторов на прогон.
+
+    Ограничивает суммарное число повторов и суммарное время ожидания
+    между ними по всем потокам и сервисам, чтобы нестабильный источник
+    не умножал длительность прогона на тысячи изображений.
+    Сбрасывается в начале каждого прогона (reset).
+    """
+
+    def __init__(
+        self,
+        max_retries: int = RETRY_BUDGET,
+        max_sleep: float = RETRY_BUDGET_SECONDS
+    ) -> None:
+        self.max_retries = max_retries
+        self.max_sleep = max_sleep
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self) -> None:
+        with self._lock:
+            self.retries = 0
+            self.slept = 0.0
+            self._exhausted_logged = False
+
+    def acquire(self, delay: float) -> bool:
+        """Метод резервирует один повтор с ожиданием delay секунд."""
+        with self._lock:
+            over_sleep = self.slept + delay > self.max_sleep
+            if self.retries >= self.max_retries or over_sleep:
+                if not self._exhausted_logged:
+                    logging.error(
+                        'Бюджет повторов исчерпан: %s повторов, %.0f сек '
+                        'ожидания. Дальнейшие ошибки не повторяются',
+                        self.retries,
+                        self.slept
+                    )
+                    self._exhausted_logged = True
+                REGISTRY.counter('retry_budget_exhausted_total').inc()
+                return False
+            self.retries += 1
+            self.slept += delay
+            return True
+
+
+RUN_RETRY_BUDGET = RetryBudget()
+"""Бюджет повторов текущего прогона."""
+
+RETRY_POLICIES = {
+    'feed': RetryPolicy(
+        'feed',
+        max_attempts=ATTEMPTION_LOAD_FEED,
+        delays=DELAY_FOR_RETRY,
+        deadline=600
+    ),
+    'image': RetryPolicy(
+        'image',
+        max_attempts=3,
+        base_delay=0.5,
+        max_delay=5.0,
+        deadline=30
+    ),
+    'photoroom': RetryPolicy(
+        'photoroom',
+        max_attempts=5,
+        base_delay=2.0,
+        max_delay=30.0,
+        deadline=180
+    ),
+}
+"""Политики повторов по сервисам."""
+
+
+def _plan_retry(
+    policy: RetryPolicy,
+    budget: RetryBudget,
+    attempt: int,
+    started: float,
+    error: Exception
+) -> float | None:
+    """
+    Защищенная функция, решает, повторять ли вызов после ошибки.
+
+    Возвращает задержку перед следующей попыткой или None, если
+    ошибку нужно пробросить.
+    """
+    reason = policy.retry_reason(error)
+    if reason is None:
+        return None
+    if attempt >= policy.max_attempts:
+        logging.error(
+            '%s: все %s попыток неудачны (%s)',
+            policy.name,
+            policy.max_attempts,
+            reason
+        )
+        return None
+    delay = policy.delay(attempt, error)
+    elapsed = time.monotonic() - started
+    if policy.deadline is not None and elapsed + delay > policy.deadline:
+        logging.error(
+            '%s: повтор не укладывается в дедлайн %s сек (%s)',
+            policy.name,
+            policy.deadline,
+            reason
+        )
+        return None
+    if not budget.acquire(delay):
+        return None
+    REGISTRY.counter(
+        'retries_total',
+        'Повторы запросов к внешним сервисам',
+        policy=policy.name,
+        reason=reason
+    ).inc()
+    logging.warning(
+        '%s: ошибка (%s). Попытка %s/%s, повтор через %.1f сек',
+        policy.name,
+        reason,
+        attempt,
+        policy.max_attempts,
+        delay
+    )
+    return delay
+
+
+def retry(policy: RetryPolicy, budget: RetryBudget = RUN_RETRY_BUDGET):
+    """Декоратор повторов по политике policy для синхронных функций."""
     def decorator(func):
         @functools.wraps(func)
         def wrapper(*args, **kwargs):
+            started = time.monotonic()
             attempt = 0
-            last_exception = None
-
-            while attempt < max_attempts:
+            while True:
                 attempt += 1
                 try:
                     return func(*args, **kwargs)
-                except (
-                    IncompleteRead,
-                    ConnectionResetError,
-                    ConnectionError,
-                    ConnectionAbortedError,
-                    ConnectionRefusedError,
-                    requests.exceptions.ConnectionError,
-                    requests.exceptions.ChunkedEncodingError,
-                    requests.exceptions.ReadTimeout,
-                    requests.exceptions.RequestException
-                ) as error:
-                    last_exception = error
-                    if attempt < max_attempts:
-                        delay = delays[attempt - 1] if attempt - \
-                            1 < len(delays) else delays[-1]
-                        logging.warning(
-                            'Попытка %s/%s неудачна, повтор через %s сек: %s',
-                            attempt,
-                            max_attempts,
-                            delay,
-                            error
-                        )
-                        time.sleep(delay)
-                    else:
-                        logging.error('Все %s попыток неудачны', max_attempts)
-                        raise last_exception
-            return None
+                except Exception as error:
+                    delay = _plan_retry(
+                        policy, budget, attempt, started, error
+                    )
+                    if delay is None:
+                        raise
+                time.sleep(delay)
         return wrapper
     return decorator
 
 
+def retry_async(policy: RetryPolicy, budget: RetryBudget = RUN_RETRY_BUDGET):
+    """Декоратор повторов по политике policy для корутин."""
+    def decorator(func):
+        @functools.wraps(func)
+        async def wrapper(*args, **kwargs):
+            started = time.monotonic()
+            attempt = 0
+            while True:
+                attempt += 1
+                try:
+                    return await func(*args, **kwargs)
+                except Exception as error:
+                    delay = _plan_retry(
+                        policy, budget, attempt, started, error
+                    )
+                    if delay is None:
+                        raise
+                await asyncio.sleep(delay)
+        return wrapper
+    return decorator
+
+
+def retry_on_network_error(
+    max_attempts=ATTEMPTION_LOAD_FEED,
+    delays=DELAY_FOR_RETRY
+):
+    """Декоратор для повторных попыток скачивания при сетевых ошибках."""
+    return retry(RetryPolicy(
+        'network',
+        max_attempts=max_attempts,
+        delays=delays
+    ))
+
+
 def try_except(func):
     """Декоратор для обработки исключений."""
     @functools.wraps(func)
@@ -175,55 +435,9 @@ def retry_photoroom(
     - retry при HTTP 429 и 5xx
     - exponential backoff + jitter
     """
-
-    retry_http_codes = {429, 500, 502, 503, 504}
-
-    def decorator(func):
-        @functools.wraps(func)
-        def wrapper(*args, **kwargs):
-
-            for attempt in range(1, max_attempts + 1):
-                try:
-                    return func(*args, **kwargs)
-
-                except requests.exceptions.HTTPError as error:
-                    status = error.response.status_code
-
-                    if status not in retry_http_codes:
-                        raise
-
-                    reason = f'HTTP {status}'
-
-                except (
-                    requests.exceptions.ConnectionError,
-                    requests.exceptions.Timeout,
-                    requests.exceptions.ChunkedEncodingError,
-                    ConnectionResetError,
-                    ConnectionAbortedError,
-                ) as error:
-                    reason = type(error).__name__
-
-                if attempt == max_attempts:
-                    logging.error(
-                        'PhotoRoom так и не ответил после %s попыток',
-                        max_attempts,
-                    )
-                    raise
-
-                delay = min(base_delay * (2 ** (attempt - 1)), max_delay)
-                jitter = random.uniform(0.5, 1.5)
-                delay *= jitter
-
-                logging.warning(
-                    'PhotoRoom ошибка (%s). '
-                    'Попытка %s/%s с задержкой %.1f сек',
-                    reason,
-                    attempt,
-                    max_attempts,
-                    delay,
-                )
-
-                time.sleep(delay)
-
-        return wrapper
-    return decorator
+    return retry(RetryPolicy(
+        'photoroom',
+        max_attempts=max_attempts,
+        base_delay=base_delay,
+        max_delay=max_delay
+    ))
@@ -36,3 +36,27 @@ class StructureXMLError(ValueError):
 
 class MissingFolderError(Exception):
     """Ошибка отсутствующей директории."""
+
+
+class InvalidImageError(ValueError):
+    """Ошибка невалидного изображения."""
+
+
+class ImageTooLargeError(ValueError):
+    """Ошибка превышения допустимого размера изображения."""
+
+
+class InvalidRenderPlanError(ValueError):
+    """Ошибка в плане рендеринга изображений."""
+
+
+class InvalidFeedConfigError(ValueError):
+    """Ошибка в конфигурации фидов."""
+
+
+class FeedsRunError(Exception):
+    """Ошибка обработки одного или нескольких фидов прогона."""
+
+
+class SnapshotNotFoundError(ValueError):
+    """Снимок фида или версия оффера не найдены в хранилище."""
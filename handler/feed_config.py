@@ -0,0 +1,145 @@
+"""
+Декларативная конфигурация фидов.
+
+Файл FEEDS_CONFIG (JSON) описывает каждый фид и общий бюджет:
+
+{
+  "budget": {"feeds": 4, "cpu": 2, "network": 8},
+  "feeds": [
+    {
+      "name": "main",
+      "url": "https://.../pdsfeed.yml",
+      "filename": "main.yml",
+      "transforms": ["category_filter", "replace_images", "custom_label"],
+      "exclude_categories": [0],
+      "image_profile": "frame",
+      "render_plan": "render_plan.json",
+      "encoding": "windows-1251",
+      "compression": "gzip"
+    }
+  ]
+}
+
+Обязательны только name и url. Если файла нет, каждый адрес из
+handler.feeds.FEEDS становится фидом с настройками по умолчанию:
+скачивание изображений без преобразований фида, как в handler.main.
+"""
+import json
+import logging
+from pathlib import Path
+
+from handler.constants import FEEDS_CONFIG, OUTPUT_COMPRESSION, OUTPUT_ENCODING
+from handler.exceptions import InvalidFeedConfigError
+from handler.feeds import FEEDS
+
+TRANSFORMS = ('category_filter', 'replace_images', 'custom_label')
+"""Преобразования фида в порядке, в котором их можно указывать."""
+
+IMAGE_PROFILES = ('none', 'download', 'frame')
+"""
+Профили изображений: без обработки, скачивание с удалением фона,
+скачивание с обрамлением и публикацией.
+"""
+
+
+class FeedConfig:
+    """
+    Настройки обработки одного фида.
+
+    - name - имя фида, уникальное, используется в журнале прогона;
+    - url - адрес фида, filename - имя скачанного файла (по умолчанию
+    последняя часть url);
+    - transforms - преобразования FeedHandler по порядку (TRANSFORMS);
+    пустой список - обработанный фид не сохраняется;
+    - exclude_categories - categoryId, удаляемые category_filter;
+    - image_profile - профиль изображений (IMAGE_PROFILES), render_plan -
+    файл плана рендеринга в директории рамки;
+    - encoding, compression - кодировка и сжатые копии выходного фида.
+    """
+
+    def __init__(
+        self,
+        name: str,
+        url: str,
+        filename: str | None = None,
+        transforms: tuple[str, ...] = (),
+        exclude_categories: tuple[int, ...] = (0,),
+        image_profile: str = 'download',
+        render_plan: str | None = None,
+        encoding: str = OUTPUT_ENCODING,
+        compression: str = OUTPUT_COMPRESSION
+    ) -> None:
+        if not name or not url:
+            raise InvalidFeedConfigError('У фида должны быть name и url')
+        unknown = set(transforms) - set(TRANSFORMS)
+        if unknown:
+            raise InvalidFeedConfigError(
+                f'Неизвестные преобразования фида {name}: {sorted(unknown)}'
+            )
+        if image_profile not in IMAGE_PROFILES:
+            raise InvalidFeedConfigError(
+                f'Неизвестный профиль изображений фида {name}: '
+                f'{image_profile}'
+            )
+        try:
+            'test'.encode(encoding)
+        except LookupError:
+            raise InvalidFeedConfigError(
+                f'Неизвестная кодировка фида {name}: {encoding}'
+            )
+        self.name = name
+        self.url = url
+        self.filename = filename or url.split('/')[-1]
+        self.transforms = tuple(transforms)
+        self.exclude_categories = tuple(
+            int(category) for category in exclude_categories
+        )
+        self.image_profile = image_profile
+        self.render_plan = render_plan
+        self.encoding = encoding
+        self.compression = compression
+
+    def __repr__(self) -> str:
+        return f'FeedConfig({self.name!r}, {self.filename!r})'
+
+    @classmethod
+    def from_dict(cls, data: dict) -> 'FeedConfig':
+        """Метод создает настройки фида из словаря конфигурации."""
+        try:
+            return cls(**data)
+        except TypeError as error:
+            raise InvalidFeedConfigError(f'Неверные поля фида: {error}')
+
+
+def load_feed_configs(
+    config_path: str = FEEDS_CONFIG
+) -> tuple[list[FeedConfig], dict]:
+    """
+    Функция, читает конфигурацию фидов.
+
+    Возвращает список FeedConfig и словарь бюджета (может быть пустым).
+    Путь считается от корня проекта, если он не абсолютный.
+    """
+    path = Path(__file__).parent.parent / config_path
+    if not path.exists():
+        logging.info('Файл %s не найден, используется список FEEDS', path)
+        return [
+            FeedConfig(name=url.split('/')[-1].split('.')[0], url=url)
+            for url in FEEDS
+        ], {}
+    try:
+        with open(path, encoding='utf-8') as f:
+            data = json.load(f)
+    except ValueError as error:
+        raise InvalidFeedConfigError(f'Файл {path} не разобран: {error}')
+    configs = [FeedConfig.from_dict(item) for item in data.get('feeds', [])]
+    if not configs:
+        raise InvalidFeedConfigError(f'В файле {path} нет фидов')
+    for field in ('name', 'filename'):
+        values = [getattr(config, field) for config in configs]
+        duplicates = {value for value in values if values.count(value) > 1}
+        if duplicates:
+            raise InvalidFeedConfigError(
+                f'Повторяющиеся значения {field}: {sorted(duplicates)}'
+            )
+    return configs, data.get('budget', {})
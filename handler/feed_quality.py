@@ -0,0 +1,142 @@
+"""
+Структурная проверка офферов фида и отчет о качестве.
+
+FeedValidator получает поля каждого оффера из потокового прохода
+OfferIndex.build, который FeedSaver выполняет сразу после сохранения
+фида, поэтому отдельного разбора XML нет. Нарушения считаются по
+правилам RULES с примерами id, отчет пишется в скрытый файл
+.<фид>.quality.json рядом с фидом.
+
+Офферы с ошибками (severity 'error') этапы обработки пропускают по
+маске OfferIndex.invalid(), которая считается по тем же колонкам
+индекса, поэтому отчет для этого читать не нужно.
+"""
+import json
+import logging
+from datetime import datetime as dt
+from pathlib import Path
+
+from handler.constants import QUALITY_SAMPLES
+
+RULES = {
+    'missing_id': ('error', 'нет атрибута id'),
+    'invalid_id': ('error', 'id не целое число'),
+    'duplicate_id': ('error', 'id уже встречался в фиде'),
+    'missing_category': ('error', 'нет categoryId'),
+    'invalid_category': ('error', 'categoryId не целое число'),
+    'missing_picture': ('warning', 'нет <picture> или он пуст'),
+}
+"""Правила проверки: имя -> (важность, описание)."""
+
+
+def _parse_int(value: bytes | None) -> int | None:
+    """Защищенная функция, приводит значение поля к числу или None."""
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def quality_path(feed_path: Path) -> Path:
+    """Функция, возвращает путь отчета о качестве фида."""
+    return feed_path.with_name(f'.{feed_path.name}.quality.json')
+
+
+def read_quality_report(feed_path: Path) -> dict | None:
+    """Функция, читает отчет о качестве фида или возвращает None."""
+    report_path = quality_path(feed_path)
+    if not report_path.exists():
+        return None
+    try:
+        with open(report_path, encoding='utf-8') as f:
+            return json.load(f)
+    except (OSError, ValueError) as error:
+        logging.warning('Отчет %s не прочитан: %s', report_path, error)
+        return None
+
+
+class FeedValidator:
+    """
+    Класс, проверяющий офферы фида по одному.
+
+    check вызывается для каждого оффера по порядку; память уходит
+    только на множество встреченных id и примеры нарушений.
+    """
+
+    def __init__(
+        self,
+        feed_name: str,
+        samples: int = QUALITY_SAMPLES
+    ) -> None:
+        self.feed_name = feed_name
+        self.samples = samples
+        self.offers = 0
+        self.invalid_offers = 0
+        self.counts = {rule: 0 for rule in RULES}
+        self.examples: dict[str, list[str]] = {rule: [] for rule in RULES}
+        self._seen_ids: set[int] = set()
+
+    def _add(self, rule: str, sample: str) -> None:
+        """Защищенный метод, учитывает нарушение правила."""
+        self.counts[rule] += 1
+        if len(self.examples[rule]) < self.samples:
+            self.examples[rule].append(sample)
+
+    def check(
+        self,
+        position: int,
+        offer_id: bytes | None,
+        category_id: bytes | None,
+        picture: bytes | None
+    ) -> bool:
+        """
+        Метод проверяет поля оффера и возвращает True, если у него
+        нет ошибок. position - номер оффера в фиде, он попадает в
+        примеры вместо id, если id нет.
+        """
+        self.offers += 1
+        violations = []
+        sample = f'#{position}'
+        if offer_id is None or not offer_id.strip():
+            violations.append('missing_id')
+        else:
+            sample = offer_id.decode('utf-8', 'replace')
+            number = _parse_int(offer_id)
+            if number is None:
+                violations.append('invalid_id')
+            elif number in self._seen_ids:
+                violations.append('duplicate_id')
+            else:
+                self._seen_ids.add(number)
+        if category_id is None:
+            violations.append('missing_category')
+        elif _parse_int(category_id) is None:
+            violations.append('invalid_category')
+        if not picture:
+            violations.append('missing_picture')
+        for rule in violations:
+            self._add(rule, sample)
+        is_valid = all(RULES[rule][0] != 'error' for rule in violations)
+        if not is_valid:
+            self.invalid_offers += 1
+        return is_valid
+
+    def report(self) -> dict:
+        """
+        Метод возвращает отчет: число офферов и офферов с ошибками,
+        по нарушенным правилам - важность, число и примеры id.
+        """
+        return {
+            'feed': self.feed_name,
+            'created': dt.now().isoformat(timespec='seconds'),
+            'offers': self.offers,
+            'invalid_offers': self.invalid_offers,
+            'rules': {
+                rule: {
+                    'severity': RULES[rule][0],
+                    'count': count,
+                    'samples': self.examples[rule],
+                }
+                for rule, count in self.counts.items() if count
+            },
+        }
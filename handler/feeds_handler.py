@@ -1,14 +1,20 @@
 import logging
-import xml.etree.ElementTree as ET
+from pathlib import Path
 
+import numpy as np
+
+from handler import xml_backend
+from handler.compression import parse_formats
 from handler.constants import (ADDRESS_FTP_IMAGES, CUSTOM_LABEL, FEEDS_FOLDER,
-                               NEW_FEEDS_FOLDER, NEW_IMAGE_FOLDER)
+                               NEW_FEEDS_FOLDER, NEW_IMAGE_FOLDER,
+                               OUTPUT_COMPRESSION, OUTPUT_ENCODING,
+                               PICTURE_HASH_LENGTH, PICTURE_VERSIONING)
 from handler.decorators import time_of_function
 from handler.feeds import FEEDS
-from handler.logging_config import setup_logging
 from handler.mixins import FileMixin
+from handler.offer_index import OfferIndex
+from handler.publish import Publisher, staging_folder
 
-setup_logging()
 logger = logging.getLogger(__name__)
 
 
@@ -24,7 +30,9 @@ class FeedHandler(FileMixin):
         feeds_folder: str = FEEDS_FOLDER,
         new_feeds_folder: str = NEW_FEEDS_FOLDER,
         new_image_folder: str = NEW_IMAGE_FOLDER,
-        feeds_list: tuple[str, ...] = FEEDS
+        feeds_list: tuple[str, ...] = FEEDS,
+        picture_versioning: str = PICTURE_VERSIONING,
+        compression: str = OUTPUT_COMPRESSION
     ) -> None:
         self.filename = filename
         self.feeds_folder = feeds_folder
@@ -33,6 +41,11 @@ class FeedHandler(FileMixin):
         self.new_image_folder = new_image_folder
         self._root = None
         self._is_modified = False
+        self._index = None
+        self._rows = None
+        self.picture_versioning = picture_versioning
+        self._publisher = None
+        self.compression = parse_formats(compression)
 
     @property
     def root(self):
@@ -41,39 +54,133 @@ class FeedHandler(FileMixin):
             self._root = self._get_root(self.filename, self.feeds_folder)
         return self._root
 
+    @property
+    def index(self) -> OfferIndex:
+        """Ленивая загрузка колоночного индекса офферов фида."""
+        if self._index is None:
+            feeds_path = Path(__file__).parent.parent / self.feeds_folder
+            self._index = OfferIndex.for_feed(feeds_path / self.filename)
+        return self._index
+
+    def _current_rows(self) -> np.ndarray:
+        """
+        Защищенный метод, возвращает строки индекса для офферов,
+        оставшихся в дереве после удалений.
+        """
+        if self._rows is None:
+            self._rows = np.arange(len(self.index))
+        return self._rows
+
+    def _columns(self, offers: list) -> OfferIndex:
+        """
+        Защищенный метод, возвращает колонки, выровненные по списку
+        элементов offers. Если дерево разошлось с индексом, колонки
+        строятся по элементам.
+        """
+        rows = self._current_rows()
+        if len(rows) == len(offers):
+            index = self.index
+            return OfferIndex(
+                index.ids[rows],
+                index.category_ids[rows],
+                index.picture_ids[rows],
+                index.pictures,
+                index.starts[rows],
+                index.ends[rows]
+            )
+        logging.warning(
+            'Индекс %s не совпадает с деревом, колонки строятся '
+            'по элементам',
+            self.filename
+        )
+        return OfferIndex.from_elements(offers)
+
+    def get_offer(self, offer_id: int | str):
+        """
+        Метод возвращает элемент <offer> по id или None.
+
+        Пока дерево не загружено, разбирается только срез файла с
+        оффером (см. OfferIndex.offer_text); после загрузки оффер
+        ищется в дереве, где уже видны изменения.
+        """
+        if self._root is not None:
+            return self._root.find(f".//offer[@id='{offer_id}']")
+        feeds_path = Path(__file__).parent.parent / self.feeds_folder
+        text = self.index.offer_text(feeds_path / self.filename, offer_id)
+        if text is None:
+            return None
+        return xml_backend.fromstring(text)
+
+    def stats(self) -> dict:
+        """Метод возвращает статистику фида по индексу, без разбора XML."""
+        return self.index.stats()
+
     @staticmethod
     def check_parity(offer_id: int) -> int:
         return int(offer_id) % 2
 
+    def _picture_url(self, image_filename: str) -> str:
+        """
+        Защищенный метод, возвращает адрес изображения с версией.
+
+        Версия - первые PICTURE_HASH_LENGTH символов sha256 файла из
+        манифеста публикации (или посчитанного на лету), поэтому адрес
+        меняется только вместе с содержимым изображения.
+        """
+        url = f'{ADDRESS_FTP_IMAGES}/{image_filename}'
+        if self.picture_versioning == 'off':
+            return url
+        if self._publisher is None:
+            self._publisher = Publisher(self.new_image_folder)
+        version = self._publisher.digest(image_filename)[:PICTURE_HASH_LENGTH]
+        if not version:
+            return url
+        if self.picture_versioning == 'filename':
+            versioned = self._publisher.version_file(image_filename, version)
+            return f'{ADDRESS_FTP_IMAGES}/{versioned}'
+        return f'{url}?v={version}'
+
     @time_of_function
     def replace_images(self):
-        """Метод, подставляющий в фиды новые изображения."""
+        """
+        Метод, подставляющий в фиды новые изображения.
+
+        Адрес изображения содержит версию по хешу содержимого (см.
+        PICTURE_VERSIONING), поэтому краулеры перекачивают только
+        изменившиеся изображения.
+        """
         deleted_images = 0
         input_images = 0
         try:
             image_dict = self._get_files_dict(self.new_image_folder)
+            image_ids = np.fromiter(
+                (int(key) for key in image_dict if key.isdigit()),
+                dtype=np.int64
+            )
+            if self._root is None:
+                ids = self.index.ids[self._current_rows()]
+                if not (np.isin(ids, image_ids) & (ids % 2 == 1)).any():
+                    logging.info('Нет офферов для замены изображений')
+                    return self
 
             offers = self.root.findall('.//offer')
-            for offer in offers:
+            columns = self._columns(offers)
+            to_replace = np.isin(columns.ids, image_ids)
+            to_replace &= columns.ids % 2 == 1
+            for position in np.flatnonzero(to_replace):
+                offer = offers[position]
                 offer_id = offer.get('id')
-
-                if not offer_id:
+                if offer_id not in image_dict:
                     continue
+                pictures = offer.findall('picture')
+                for picture in pictures:
+                    offer.remove(picture)
+                deleted_images += len(pictures)
 
-                if offer_id in image_dict:
-                    pictures = offer.findall('picture')
-
-                    if self.check_parity(int(offer_id)):
-                        for picture in pictures:
-                            offer.remove(picture)
-                        deleted_images += len(pictures)
-
-                        picture_tag = ET.SubElement(offer, 'picture')
-                        picture_tag.text = (
-                            f'{ADDRESS_FTP_IMAGES}/{image_dict[offer_id]}'
-                        )
-                        input_images += 1
-                        self._is_modified = True
+                picture_tag = xml_backend.sub_element(offer, 'picture')
+                picture_tag.text = self._picture_url(image_dict[offer_id])
+                input_images += 1
+                self._is_modified = True
             logging.info(
                 '\nКоличество удаленных изображений - %s'
                 '\nКоличество добавленных изображений - %s',
@@ -85,25 +192,25 @@ class FeedHandler(FileMixin):
             logging.error('Ошибка в image_replacement: %s', error)
             raise
 
+    @time_of_function
     def add_custom_label(self):
         even_custom_label = 0
         odd_custom_label = 0
         count_custom_label = 0
         try:
             offers = self.root.findall('.//offer')
-            for offer in offers:
-                offer_id = offer.get('id')
-                if offer_id:
-                    int_offer_id = int(offer_id)
-                custom_label = ET.SubElement(offer, 'custom_label')
-                parity = self.check_parity(int_offer_id)
-                if parity:
-                    even_custom_label += 1
-                else:
-                    odd_custom_label += 1
-                custom_label.text = CUSTOM_LABEL[parity]
+            parities = self._columns(offers).parity()
+            labels = [CUSTOM_LABEL[0], CUSTOM_LABEL[1]]
+            for offer, parity in zip(offers, parities.tolist()):
+                xml_backend.sub_element(
+                    offer,
+                    'custom_label'
+                ).text = labels[parity]
+            even_custom_label = int(parities.sum())
+            count_custom_label = len(offers)
+            odd_custom_label = count_custom_label - even_custom_label
+            if offers:
                 self._is_modified = True
-                count_custom_label += 1
             logging.info(
                 'Всего добавлено custom_label - %s',
                 count_custom_label
@@ -124,25 +231,57 @@ class FeedHandler(FileMixin):
             )
             raise
 
-    def delete_offers(self):
+    @time_of_function
+    def delete_offers(self, categories: tuple[int, ...] = (0,)):
+        """
+        Метод удаляет офферы, у которых categoryId из categories.
+
+        Оффер без целого categoryId не удаляется (он отмечен в отчете
+        о качестве фида, см. handler.feed_quality).
+        """
         deleted_offers = 0
         to_remove = []
         try:
+            rows = self._current_rows()
+            is_zero = np.isin(self.index.category_ids[rows], categories)
+            if self._root is None and not is_zero.any():
+                logging.info('Офферов с categoryId из %s нет', categories)
+                return self
             offers_parent = self.root.find('.//offers')
             if offers_parent is None:
                 logging.error('Не найден родительский элемент offers')
                 return self
             offers = offers_parent.findall('offer')
-            for offer in offers:
-                category_id = int(offer.findtext('categoryId'))
-                if category_id == 0:
-                    to_remove.append(offer)
-                    deleted_offers += 1
-            for offer in to_remove:
-                offers_parent.remove(offer)
+            is_aligned = len(offers) == len(rows)
+            if is_aligned:
+                to_remove = [offers[row] for row in np.flatnonzero(is_zero)]
+            else:
+                is_listed = np.isin(
+                    OfferIndex.from_elements(offers).category_ids,
+                    categories
+                )
+                to_remove = [offers[row] for row in np.flatnonzero(is_listed)]
+            if is_aligned and len(offers_parent) == len(offers):
+                offers_parent[:] = [
+                    offer for offer, is_deleted in zip(
+                        offers, is_zero.tolist()
+                    ) if not is_deleted
+                ]
+            else:
+                for offer in to_remove:
+                    offers_parent.remove(offer)
+            deleted_offers = len(to_remove)
+            if is_aligned:
+                self._rows = rows[~is_zero]
+            else:
+                self._index = OfferIndex.from_elements(
+                    self.root.findall('.//offer')
+                )
+                self._rows = None
             logging.info(
-                'Удалено %s офферов с categoryId == 0',
-                deleted_offers
+                'Удалено %s офферов с categoryId из %s',
+                deleted_offers,
+                categories
             )
             self._is_modified = True
             return self
@@ -150,17 +289,37 @@ class FeedHandler(FileMixin):
             logging.error('Неизвестная ошибка в delete_offers: %s', error)
             raise
 
-    def save(self, prefix: str = 'new'):
-        """Метод сохраняет файл, если были изменения."""
+    @time_of_function
+    def save(self, prefix: str = 'new', encoding: str = OUTPUT_ENCODING):
+        """
+        Метод сохраняет файл в кодировке encoding.
+
+        Файл пишется в staging директории обработанных фидов и попадает
+        в раздачу после публикации (см. handler.publish). Сжатые копии
+        (OUTPUT_COMPRESSION) пишутся в том же проходе.
+        """
         try:
             new_filename = f'{prefix}_{self.filename}'
+            new_feeds_folder = staging_folder(self.new_feeds_folder)
 
             if not self._is_modified:
-                self._save_xml(self.root, self.new_feeds_folder, new_filename)
+                self._save_xml(
+                    self.root,
+                    new_feeds_folder,
+                    new_filename,
+                    encoding,
+                    self.compression
+                )
                 logger.info('Файл обновлен без изменений')
                 return self
 
-            self._save_xml(self.root, self.new_feeds_folder, new_filename)
+            self._save_xml(
+                self.root,
+                new_feeds_folder,
+                new_filename,
+                encoding,
+                self.compression
+            )
             logger.info('Файл сохранён как %s', new_filename)
 
             self._is_modified = False
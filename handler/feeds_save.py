@@ -1,18 +1,24 @@
+import json
 import logging
-import xml.etree.ElementTree as ET
+import sqlite3
+from pathlib import Path
 
 import requests
 from dotenv import load_dotenv
 
-from handler.constants import ENCODING, FEEDS_FOLDER
-from handler.decorators import retry_on_network_error, time_of_function
+from handler import xml_backend
+from handler.compression import parse_formats
+from handler.constants import (ENCODING, FEEDS_FOLDER, RETRY_HTTP_CODES,
+                               SNAPSHOTS)
+from handler.decorators import RETRY_POLICIES, retry, time_of_function
 from handler.exceptions import (EmptyFeedsListError, EmptyXMLError,
                                 InvalidXMLError)
+from handler.feed_quality import RULES, FeedValidator, quality_path
 from handler.feeds import FEEDS
-from handler.logging_config import setup_logging
+from handler.metrics import REGISTRY
 from handler.mixins import FileMixin
-
-setup_logging()
+from handler.offer_index import OfferIndex
+from handler.snapshots import SnapshotStore
 
 
 class FeedSaver(FileMixin):
@@ -25,7 +31,11 @@ class FeedSaver(FileMixin):
     def __init__(
         self,
         feeds_list: tuple[str, ...] = FEEDS,
-        feeds_folder: str = FEEDS_FOLDER
+        feeds_folder: str = FEEDS_FOLDER,
+        session: requests.Session | None = None,
+        compression: str = '',
+        filenames: dict[str, str] | None = None,
+        snapshots: bool = SNAPSHOTS
     ) -> None:
         if not feeds_list:
             logging.error('Не передан список фидов.')
@@ -33,35 +43,53 @@ class FeedSaver(FileMixin):
 
         self.feeds_list = feeds_list
         self.feeds_folder = feeds_folder
+        self.session = session or requests.Session()
+        self.compression = parse_formats(compression)
+        self.filenames = filenames or {}
+        self.snapshots = snapshots
+
+    @retry(RETRY_POLICIES['feed'])
+    def _fetch_file(self, feed: str):
+        """
+        Защищенный метод, запрашивает фид по ссылке.
+
+        Сетевые ошибки и HTTP-коды из RETRY_HTTP_CODES пробрасываются
+        наружу, чтобы их повторила политика 'feed'.
+        """
+        response = self.session.get(feed, stream=True, timeout=(10, 60))
+        if response.status_code in RETRY_HTTP_CODES:
+            response.raise_for_status()
+        return response
 
-    @retry_on_network_error(max_attempts=3, delays=(2, 5, 10))
     def _get_file(self, feed: str):
         """Защищенный метод, получает фид по ссылке."""
         try:
-            response = requests.get(feed, stream=True, timeout=(10, 60))
-
-            if response.status_code == requests.codes.ok:
-                return response
-            else:
-                logging.error(
-                    'HTTP ошибка %s при загрузке %s',
-                    response.status_code,
-                    feed
-                )
-                return None
-
+            response = self._fetch_file(feed)
         except requests.RequestException as error:
             logging.error('Ошибка при загрузке %s: %s', feed, error)
             return None
 
+        if response.status_code == requests.codes.ok:
+            return response
+        logging.error(
+            'HTTP ошибка %s при загрузке %s',
+            response.status_code,
+            feed
+        )
+        return None
+
     def _get_filename(self, feed: str) -> str:
-        """Защищенный метод, формирующий имя xml-файлу."""
-        return feed.split('/')[-1]
+        """
+        Защищенный метод, формирующий имя xml-файлу: из filenames
+        или по последней части ссылки.
+        """
+        return self.filenames.get(feed) or feed.split('/')[-1]
 
-    def _validate_xml(self, xml_content: bytes) -> str:
+    def _validate_xml(self, xml_content: bytes):
         """
         Валидирует XML.
-        Возвращает декодированное содержимое.
+        Возвращает корневой элемент разобранного документа,
+        чтобы не разбирать его повторно.
         """
         if not xml_content.strip():
             logging.error('Получен пустой XML-файл')
@@ -72,35 +100,97 @@ class FeedSaver(FileMixin):
             logging.error('Ошибка декодирования XML-файла')
             raise
         try:
-            ET.fromstring(decoded_content)
-        except ET.ParseError as e:
+            return xml_backend.fromstring(decoded_content)
+        except xml_backend.PARSE_ERRORS as e:
             logging.error('XML-файл содержит синтаксические ошибки')
             raise InvalidXMLError(f'XML содержит синтаксические ошибки: {e}')
-        return decoded_content
+
+    def _check_quality(self, file_path: Path) -> None:
+        """
+        Защищенный метод, строит индекс сохраненного фида, в том же
+        проходе проверяет офферы и пишет отчет о качестве.
+        """
+        validator = FeedValidator(file_path.name)
+        OfferIndex.for_feed(file_path, validator)
+        report = validator.report()
+        self._atomic_write(
+            quality_path(file_path),
+            json.dumps(report, ensure_ascii=False, indent=2).encode('utf-8')
+        )
+        REGISTRY.gauge(
+            'feed_invalid_offers',
+            'Офферы с ошибками структуры, пропускаемые обработкой',
+            feed=file_path.name
+        ).set(report['invalid_offers'])
+        for rule, violations in report['rules'].items():
+            level = logging.INFO
+            if violations['severity'] == 'error':
+                level = logging.WARNING
+            logging.log(
+                level,
+                'Фид %s: %s - %s офферов, например %s',
+                file_path.name,
+                RULES[rule][1],
+                violations['count'],
+                violations['samples'][:3]
+            )
 
     @time_of_function
+    def _add_snapshot(self, file_path: Path) -> None:
+        """Защищенный метод, сохраняет снимок фида в историю."""
+        try:
+            with SnapshotStore() as store:
+                store.add(file_path)
+        except (sqlite3.Error, OSError) as error:
+            logging.error(
+                'Не удалось сохранить снимок %s: %s',
+                file_path.name,
+                error
+            )
+
     def save_xml(self) -> None:
-        """Метод, сохраняющий фиды в xml-файлы"""
+        """
+        Метод, сохраняющий фиды в xml-файлы.
+
+        Сжатые копии по умолчанию не пишутся: директория фидов рабочая,
+        и каждый файл в ней считается фидом. Их можно включить
+        параметром compression, например для отдачи сырых фидов.
+        Сразу после сохранения строится индекс офферов (см.
+        handler.offer_index), чтобы поиск оффера по id и этапы
+        обработки не разбирали файл заново; в том же проходе офферы
+        проверяются и пишется отчет о качестве (handler.feed_quality).
+        Затем фид сохраняется в хранилище снимков (handler.snapshots),
+        если включено SNAPSHOTS.
+        Ошибка хранилища снимков не прерывает скачивание.
+        """
         total_files: int = len(self.feeds_list)
         saved_files = 0
         folder_path = self._make_dir(self.feeds_folder)
         for feed in self.feeds_list:
             file_name = self._get_filename(feed)
-            file_path = folder_path / file_name
-            response = self._get_file(feed)
+            with REGISTRY.timer('feed_download_seconds', feed=file_name):
+                response = self._get_file(feed)
+                if response is not None:
+                    xml_content = response.content
             if response is None:
                 logging.warning('XML-файл %s не получен.', file_name)
                 continue
+            REGISTRY.gauge('feed_bytes', feed=file_name).set(len(xml_content))
             try:
-                xml_content = response.content
-                decoded_content = self._validate_xml(xml_content)
-                xml_tree = ET.fromstring(decoded_content)
-                self._indent(xml_tree)
-                tree = ET.ElementTree(xml_tree)
-                with open(file_path, 'wb') as file:
-                    tree.write(file, encoding=ENCODING, xml_declaration=True)
+                xml_tree = self._validate_xml(xml_content)
+                self._save_xml(
+                    xml_tree,
+                    self.feeds_folder,
+                    file_name,
+                    ENCODING,
+                    self.compression,
+                    xml_declaration=True
+                )
                 saved_files += 1
                 logging.info('Файл %s успешно сохранен', file_name)
+                self._check_quality(folder_path / file_name)
+                if self.snapshots:
+                    self._add_snapshot(folder_path / file_name)
             except (EmptyXMLError, InvalidXMLError) as error:
                 logging.error('Ошибка валидации XML %s: %s', file_name, error)
                 continue
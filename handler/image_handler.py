@@ -1,27 +1,84 @@
+import functools
+import json
 import logging
 import os
+import threading
+import time
+from collections.abc import Iterator
+from io import BytesIO
 from pathlib import Path
 
 import requests
 from PIL import Image
 
-from handler.constants import (FEEDS_FOLDER, FRAME_FOLDER, HEADERS,
-                               IMAGE_FOLDER, NAME_OF_CANVAS, NEW_IMAGE_FOLDER)
-from handler.decorators import retry_photoroom, time_of_function
-from handler.exceptions import DirectoryCreationError, EmptyFeedsListError
-from handler.logging_config import setup_logging
+from handler.constants import (COMPOSITE_BATCH, COMPOSITE_ENGINE, FEEDS_FOLDER,
+                               FRAME_FOLDER, HEADERS, IMAGE_CHUNK_SIZE,
+                               IMAGE_FOLDER, IMAGE_SIGNATURES, MAX_IMAGE_BYTES,
+                               NEW_IMAGE_FOLDER, PHOTOROOM_URL, PICTURES_STATE,
+                               PIPELINE_QUEUE_SIZE, PIPELINE_WORKERS,
+                               RENDER_PLAN, RGB_COLOR_SETTINGS,
+                               TEMP_FILE_MAX_AGE, UPLOAD_DOWNSCALE,
+                               UPLOAD_QUALITY)
+from handler.decorators import RETRY_POLICIES, retry, time_of_function
+from handler.exceptions import (DirectoryCreationError, EmptyFeedsListError,
+                                ImageTooLargeError, InvalidImageError,
+                                InvalidRenderPlanError)
+from handler.metrics import REGISTRY
 from handler.mixins import FileMixin
+from handler.offer_index import OfferIndex
+from handler.pipeline import Pipeline, Stage, parse_workers
+from handler.publish import Publisher, staging_folder
+from handler.render import RenderVariant, load_render_plan
 
-setup_logging()
 logger = logging.getLogger(__name__)
 
 
+def read_picture_state(folder_path: Path) -> dict[str, str]:
+    """
+    Функция, читает ссылки на картинки, из которых получены исходники
+    директории ({offer_id: url}). Если файла нет, возвращает {}.
+    """
+    state_path = folder_path / PICTURES_STATE
+    if not state_path.exists():
+        return {}
+    try:
+        with open(state_path, encoding='utf-8') as f:
+            return json.load(f)
+    except (OSError, ValueError) as error:
+        logging.warning('Файл %s не прочитан: %s', state_path, error)
+        return {}
+
+
+class ImageJob:
+    """Оффер, проходящий через конвейер изображений."""
+
+    def __init__(
+        self,
+        offer_id: str,
+        url: str,
+        source_path: Path,
+        has_source: bool = False
+    ) -> None:
+        self.offer_id = offer_id
+        self.url = url
+        self.source_path = source_path
+        self.download_path = FileMixin._download_path(source_path)
+        self.has_source = has_source
+        self.frames: list[tuple[RenderVariant, Image.Image]] = []
+        self.staged: list[Path] = []
+
+
 class FeedImage(FileMixin):
     """
     Класс, предоставляющий интерфейс
     для работы с изображениями.
     """
 
+    _canvas_cache: dict = {}
+    _in_flight: set[str] = set()
+    _in_flight_lock = threading.Lock()
+    _state_lock = threading.Lock()
+
     def __init__(
         self,
         filenames: list,
@@ -29,16 +86,75 @@ class FeedImage(FileMixin):
         feeds_folder: str = FEEDS_FOLDER,
         image_folder: str = IMAGE_FOLDER,
         frame_folder: str = FRAME_FOLDER,
-        new_image_folder: str = NEW_IMAGE_FOLDER
+        new_image_folder: str = NEW_IMAGE_FOLDER,
+        journal=None,
+        session: requests.Session | None = None,
+        photoroom_url: str = PHOTOROOM_URL,
+        max_image_bytes: int = MAX_IMAGE_BYTES,
+        render_plan: tuple[RenderVariant, ...] | None = None,
+        composite_engine: str = COMPOSITE_ENGINE,
+        composite_batch: int = COMPOSITE_BATCH,
+        pipeline_workers: str = PIPELINE_WORKERS,
+        pipeline_queue_size: int = PIPELINE_QUEUE_SIZE,
+        upload_downscale: bool = UPLOAD_DOWNSCALE,
+        upload_quality: int = UPLOAD_QUALITY,
+        budget=None,
+        feed: str | None = None
     ) -> None:
         self.filenames = filenames
         self.images = images
+        self.feed = feed or ','.join(filenames)
         self.feeds_folder = feeds_folder
         self.image_folder = image_folder
         self.frame_folder = frame_folder
         self.new_image_folder = new_image_folder
         self._existing_image_offers: set[str] = set()
-        self._existing_framed_offers: set[str] = set()
+        self._existing_framed_offers: dict[str, set[str]] = {}
+        self.journal = journal
+        self.session = session or requests.Session()
+        self.photoroom_url = photoroom_url
+        self.max_image_bytes = max_image_bytes
+        self.offer_pictures: dict[str, str] = {}
+        self.render_plan = render_plan
+        self.composite_engine = composite_engine
+        self.composite_batch = composite_batch
+        self._compositors = threading.local()
+        self.pipeline_workers = pipeline_workers
+        self.pipeline_queue_size = pipeline_queue_size
+        self.upload_downscale = upload_downscale
+        self.upload_quality = upload_quality
+        self._max_product_height = None
+        self.budget = budget
+
+    def _is_done(self, stage: str, offer_id: str) -> bool:
+        """Защищенный метод, проверяет оффер по журналу прогона."""
+        return bool(self.journal) and self.journal.is_item_done(
+            stage, offer_id
+        )
+
+    def _mark_done(self, stage: str, offer_id: str) -> None:
+        """Защищенный метод, отмечает оффер в журнале прогона."""
+        if self.journal:
+            self.journal.mark_item_done(stage, offer_id)
+
+    def _clean_temp_files(self, folder_path: Path) -> None:
+        """
+        Защищенный метод, удаляет временные файлы,
+        оставшиеся от прерванного прогона (старше TEMP_FILE_MAX_AGE).
+        """
+        deadline = time.time() - TEMP_FILE_MAX_AGE
+        temp_files = [
+            *folder_path.glob('.*.tmp'),
+            *folder_path.glob('.*.download'),
+        ]
+        for temp_file in temp_files:
+            try:
+                if temp_file.stat().st_mtime > deadline:
+                    continue
+            except FileNotFoundError:
+                continue
+            temp_file.unlink(missing_ok=True)
+            logging.info('Удален недописанный файл %s', temp_file.name)
 
     # def _get_image_data_with_bg(self, url: str) -> tuple:
     #     """
@@ -71,38 +187,119 @@ class FeedImage(FileMixin):
     #         )
     #         return None, None
 
-    def _get_image_data(self, url: str):
+    @retry(RETRY_POLICIES['image'])
+    def _fetch_image(self, url: str, file_path: Path) -> int:
+        """
+        Защищенный метод, потоково скачивает изображение в файл.
+
+        Ответ не загружается в память целиком: блоки по IMAGE_CHUNK_SIZE
+        пишутся в file_path. Скачивание прерывается, если размер по
+        Content-Length или фактический превышает MAX_IMAGE_BYTES.
+        Возвращает количество скачанных байт.
+        """
+        with REGISTRY.timer('image_download_seconds'):
+            with self.session.get(
+                url,
+                headers=HEADERS,
+                timeout=10,
+                stream=True
+            ) as response:
+                response.raise_for_status()
+                declared = int(response.headers.get('Content-Length') or 0)
+                if declared > self.max_image_bytes:
+                    raise ImageTooLargeError(
+                        f'Content-Length {declared} больше '
+                        f'{self.max_image_bytes}'
+                    )
+                size = 0
+                with open(file_path, 'wb') as f:
+                    for chunk in response.iter_content(IMAGE_CHUNK_SIZE):
+                        size += len(chunk)
+                        if size > self.max_image_bytes:
+                            raise ImageTooLargeError(
+                                f'Изображение больше {self.max_image_bytes}'
+                            )
+                        f.write(chunk)
+        return size
+
+    def _validate_image(self, file_path: Path) -> str:
+        """
+        Защищенный метод, проверяет скачанный файл до платного
+        удаления фона: сигнатуру формата и целостность через
+        Image.verify(). Возвращает формат или бросает InvalidImageError.
+        """
+        with open(file_path, 'rb') as f:
+            header = f.read(16)
+        image_format = next(
+            (name for signature, name in IMAGE_SIGNATURES
+             if header.startswith(signature)),
+            None
+        )
+        if image_format == 'webp' and header[8:12] != b'WEBP':
+            image_format = None
+        if image_format is None:
+            raise InvalidImageError(
+                f'Неизвестная сигнатура файла: {header[:8]!r}'
+            )
+        try:
+            with Image.open(file_path) as image:
+                image.verify()
+        except Exception as error:
+            raise InvalidImageError(f'Изображение повреждено: {error}')
+        return image_format
+
+    def _download_image(self, url: str, file_path: Path) -> bool:
         """
-        Защищенный метод, загружает данные изображения
-        и возвращает (image_data, image_format).
+        Защищенный метод, скачивает и проверяет изображение.
+
+        Возвращает True, если в file_path лежит валидное изображение.
+        При любой ошибке файл удаляется, а ошибка логируется.
         """
         try:
-            response = requests.get(url, headers=HEADERS, timeout=10)
-            response.raise_for_status()
-            return response.content
-        except requests.exceptions.HTTPError as error:
-            if response.status_code == 403:
+            size = self._fetch_image(url, file_path)
+            REGISTRY.counter('image_download_bytes_total').inc(size)
+            self._validate_image(file_path)
+            return True
+        except Exception as error:
+            self._reject_image(url, file_path, error)
+            return False
+
+    def _reject_image(self, url: str, file_path: Path, error: Exception):
+        """
+        Защищенный метод, удаляет непригодный файл, логирует ошибку
+        скачивания или проверки и считает ее в метриках.
+        """
+        file_path.unlink(missing_ok=True)
+        if isinstance(error, (InvalidImageError, ImageTooLargeError)):
+            REGISTRY.counter(
+                'images_rejected_total',
+                reason=type(error).__name__
+            ).inc()
+            logging.warning('Изображение %s отклонено: %s', url, error)
+        elif isinstance(error, requests.exceptions.HTTPError):
+            status_code = error.response.status_code
+            REGISTRY.counter(
+                'image_download_errors_total',
+                reason=status_code
+            ).inc()
+            if status_code == 403:
                 logging.warning('Доступ запрещен (403) для %s', url)
             else:
                 logging.error(
                     'HTTP ошибка %s при загрузке %s: %s',
-                    response.status_code,
+                    status_code,
                     url,
                     error
                 )
-            return None
-        except Exception as error:
+        else:
+            REGISTRY.counter(
+                'image_download_errors_total',
+                reason=type(error).__name__
+            ).inc()
             logging.error('Ошибка при загрузке изображения %s: %s', url, error)
-            return None
 
-    def _get_image_filename(
-        self,
-        offer_id: str,
-        image_data: bytes,
-    ) -> str:
+    def _get_image_filename(self, offer_id: str) -> str:
         """Защищенный метод, создает имя файла с изображением."""
-        if not image_data:
-            return ''
         return f'{offer_id}.png'
 
     def _save_image(
@@ -116,8 +313,7 @@ class FeedImage(FileMixin):
             return
         try:
             file_path = folder_path / image_filename
-            with open(file_path, 'wb') as f:
-                f.write(image_data)
+            self._atomic_write(file_path, image_data)
             logging.debug('Изображение сохранено: %s', file_path)
         except Exception as error:
             logging.error(
@@ -126,15 +322,111 @@ class FeedImage(FileMixin):
                 error
             )
 
-    @retry_photoroom()
-    def _remove_bg(self, filepath, imagename):
+    def _store_source(
+        self,
+        folder_path: Path,
+        download_path: Path,
+        image_filename: str
+    ) -> None:
+        """
+        Защищенный метод, удаляет фон у скачанного файла и сохраняет
+        исходник под финальным именем. Если PhotoRoom вернул пустой
+        ответ, сохраняется скачанный файл как есть.
+
+        Ошибка записи (нет места, нет прав) пробрасывается, поэтому
+        вызывающий код отмечает оффер готовым, только если файл
+        действительно записан.
+        """
+        try:
+            upload = self._prepare_upload(download_path)
+            bg_removed = self._remove_bg(
+                folder_path,
+                download_path.name,
+                upload
+            )
+            if bg_removed:
+                self._atomic_write(folder_path / image_filename, bg_removed)
+            else:
+                os.replace(download_path, folder_path / image_filename)
+        finally:
+            download_path.unlink(missing_ok=True)
+
+    def _upload_height(self) -> int:
+        """
+        Защищенный метод, возвращает высоту товара в самом большом
+        варианте плана рендеринга: больше пикселей в подложку не попадет.
+        """
+        if self._max_product_height is None:
+            frame_path = self._make_dir(self.frame_folder)
+            self._max_product_height = max(
+                int(variant.size[1] * variant.height_ratio)
+                for variant in self._get_render_plan(frame_path)
+            )
+        return self._max_product_height
+
+    def _prepare_upload(self, file_path: Path) -> tuple:
+        """
+        Защищенный метод, готовит файл к отправке в PhotoRoom.
+
+        Изображение выше нужного плану рендеринга уменьшается до этой
+        высоты и перекодируется в JPEG (прозрачность заливается белым,
+        фон все равно удаляется). Перекодированный вариант отправляется,
+        только если он меньше исходного файла. Возвращает кортеж
+        (имя, данные, MIME-тип) для поля multipart.
+        """
+        data = file_path.read_bytes()
+        original = (file_path.name, data, None)
+        if not self.upload_downscale:
+            return original
+        try:
+            target_height = self._upload_height()
+        except InvalidRenderPlanError as error:
+            logging.warning(
+                'Изображение отправляется без уменьшения: %s',
+                error
+            )
+            return original
+        with Image.open(BytesIO(data)) as image:
+            if image.format == 'JPEG' and image.height <= target_height:
+                return original
+            image.draft(
+                'RGB',
+                (image.width * target_height // image.height, target_height)
+            )
+            image = image.convert('RGBA')
+        if image.height > target_height:
+            image = image.resize(
+                (
+                    max(1, round(image.width * target_height / image.height)),
+                    target_height
+                ),
+                Image.Resampling.LANCZOS
+            )
+        flat = Image.new('RGB', image.size, RGB_COLOR_SETTINGS)
+        flat.paste(image, mask=image)
+        buffer = BytesIO()
+        flat.save(buffer, 'JPEG', quality=self.upload_quality, optimize=True)
+        if buffer.tell() >= len(data):
+            return original
+        return f'{file_path.stem}.jpg', buffer.getvalue(), 'image/jpeg'
+
+    @retry(RETRY_POLICIES['photoroom'])
+    def _remove_bg(self, filepath, imagename, upload: tuple | None = None):
+        """
+        Защищенный метод, удаляет фон через PhotoRoom.
+
+        upload - подготовленный _prepare_upload кортеж; без него
+        отправляется файл imagename как есть.
+        """
         file_path = Path(filepath) / imagename
+        if upload is None:
+            upload = (imagename, file_path.read_bytes(), None)
         api_key = os.getenv('RM_BG_API_KEY')
 
-        with open(file_path, 'rb') as f:
-            response = requests.post(
-                'https://image-api.photoroom.com/v2/edit',
-                files={"imageFile": f},
+        with REGISTRY.timer('photoroom_seconds') as timer:
+            response = self.session.post(
+                self.photoroom_url,
+                files={"imageFile": upload},
                 data={
                     "removeBackground": "true"
                 },
@@ -143,10 +435,120 @@ class FeedImage(FileMixin):
                 },
                 timeout=60
             )
+        REGISTRY.counter(
+            'photoroom_requests_total',
+            status=response.status_code
+        ).inc()
         response.raise_for_status()
-        logging.info('Фон успешно удалён PhotoRoom')
+        original_size = file_path.stat().st_size
+        REGISTRY.counter(
+            'photoroom_upload_bytes_total',
+            kind='original'
+        ).inc(original_size)
+        REGISTRY.counter(
+            'photoroom_upload_bytes_total',
+            kind='sent'
+        ).inc(len(upload[1]))
+        logging.info(
+            'Фон успешно удалён PhotoRoom: %s, отправлено %s байт '
+            'из %s, %.2f сек',
+            imagename,
+            len(upload[1]),
+            original_size,
+            timer.elapsed
+        )
         return response.content
 
+    def _load_existing_images(self) -> Path:
+        """
+        Защищенный метод, готовит директорию исходников: удаляет
+        недописанные файлы и строит множество скачанных офферов.
+        Возвращает путь к директории.
+        """
+        folder_path = self._make_dir(self.image_folder)
+        self._clean_temp_files(folder_path)
+        if not self._existing_image_offers:
+            try:
+                self._build_set(
+                    self.image_folder,
+                    self._existing_image_offers
+                )
+            except (DirectoryCreationError, EmptyFeedsListError):
+                logging.warning(
+                    'Директория с изображениями отсутствует. Первый запуск'
+                )
+        return folder_path
+
+    def _save_picture_state(self) -> None:
+        """
+        Защищенный метод, дописывает offer_pictures в PICTURES_STATE
+        директории исходников. Записи других фидов сохраняются.
+        """
+        folder_path = Path(__file__).parent.parent / self.image_folder
+        if not self.offer_pictures or not folder_path.exists():
+            return
+        state_path = folder_path / PICTURES_STATE
+        with self._state_lock, self._file_lock(state_path):
+            state = read_picture_state(folder_path)
+            state.update(self.offer_pictures)
+            self._atomic_write(
+                state_path,
+                json.dumps(state, ensure_ascii=False).encode('utf-8')
+            )
+
+    def _iter_offer_pictures(self):
+        """
+        Защищенный метод, отдает пары (offer_id, url картинки или None)
+        по всем офферам фидов. Офферы с ошибками структуры
+        (OfferIndex.invalid) пропускаются.
+
+        Заодно обновляет offer_pictures и сбрасывает кэши готовых
+        изображений оффера, у которого сменилась картинка. При первом
+        прогоне процесса ссылки прошлого прогона берутся из
+        PICTURES_STATE.
+        """
+        previous_pictures = self.offer_pictures or read_picture_state(
+            Path(__file__).parent.parent / self.image_folder
+        )
+        self.offer_pictures = {}
+        for filename in self.filenames:
+            root = self._get_root(filename, self.feeds_folder)
+            offers = root.findall('.//offer')
+
+            if not offers:
+                logging.debug('В файле %s не найдено offers', filename)
+                return
+
+            invalid = OfferIndex.for_feed(
+                Path(__file__).parent.parent.joinpath(
+                    self.feeds_folder,
+                    filename
+                )
+            ).invalid()
+            if len(invalid) != len(offers):
+                invalid = OfferIndex.from_elements(offers).invalid()
+            if invalid.any():
+                logging.warning(
+                    'В файле %s пропущено %s офферов с ошибками структуры',
+                    filename,
+                    int(invalid.sum())
+                )
+            for offer, is_invalid in zip(offers, invalid.tolist()):
+                if is_invalid:
+                    continue
+                offer_id = str(offer.get('id'))
+                offer_image = offer.findtext('picture')
+                if offer_image:
+                    self.offer_pictures[offer_id] = offer_image
+                    previous_image = previous_pictures.get(offer_id)
+                    if previous_image and previous_image != offer_image:
+                        self._existing_image_offers.discard(offer_id)
+                        for framed_offers in (
+                            self._existing_framed_offers.values()
+                        ):
+                            framed_offers.discard(offer_id)
+                yield offer_id, offer_image
+
     @time_of_function
     def get_images(self):
         """Метод получения и сохранения изображений из xml-файла."""
@@ -154,66 +556,50 @@ class FeedImage(FileMixin):
         offers_with_images = 0
         images_downloaded = 0
         offers_skipped_existing = 0
-
+        folder_path = self._load_existing_images()
         try:
-            self._build_set(
-                self.image_folder,
-                self._existing_image_offers
-            )
-        except (DirectoryCreationError, EmptyFeedsListError):
-            logging.warning(
-                'Директория с изображениями отсутствует. Первый запуск'
-            )
-        try:
-            for filename in self.filenames:
-                root = self._get_root(filename, self.feeds_folder)
-                offers = root.findall('.//offer')
-
-                if not offers:
-                    logging.debug('В файле %s не найдено offers', filename)
-                    return
-
-                for offer in offers:
-                    offer_id = str(offer.get('id'))
-                    total_offers_processed += 1
-
-                    picture = offer.find('picture')
-                    if picture is None:
-                        continue
-
-                    offer_image = picture.text
-                    if not offer_image:
-                        continue
-
-                    offers_with_images += 1
+            for offer_id, offer_image in self._iter_offer_pictures():
+                total_offers_processed += 1
+                if not offer_image:
+                    continue
 
-                    if offer_id in self._existing_image_offers:
-                        offers_skipped_existing += 1
-                        continue
+                offers_with_images += 1
+                is_existing = offer_id in self._existing_image_offers
+                if is_existing or self._is_done('get_images', offer_id):
+                    offers_skipped_existing += 1
+                    continue
 
-                    image_data = self._get_image_data(offer_image)
+                image_filename = self._get_image_filename(offer_id)
+                final_path = folder_path / image_filename
+                download_path = self._download_path(final_path)
 
-                    if not image_data:
-                        continue
+                if not self._download_image(offer_image, download_path):
+                    self._mark_done('get_images', offer_id)
+                    continue
 
-                    image_filename = self._get_image_filename(
-                        offer_id,
-                        image_data
+                try:
+                    self._store_source(
+                        folder_path,
+                        download_path,
+                        image_filename
                     )
-
-                    if not image_filename:
-                        continue
-
-                    folder_path = self._make_dir(self.image_folder)
-                    self._save_image(image_data, folder_path, image_filename)
-                    bg_removed = self._remove_bg(folder_path, image_filename)
-                    if bg_removed:
-                        self._save_image(
-                            bg_removed,
-                            folder_path,
-                            image_filename
-                        )
-                    images_downloaded += 1
+                except OSError as error:
+                    logging.error(
+                        'Ошибка при сохранении %s: %s',
+                        image_filename,
+                        error
+                    )
+                    continue
+                self._existing_image_offers.add(offer_id)
+                self._mark_done('get_images', offer_id)
+                images_downloaded += 1
+            for name, value in (
+                ('image_offers', total_offers_processed),
+                ('image_offers_with_pictures', offers_with_images),
+                ('images_downloaded', images_downloaded),
+                ('images_skipped_existing', offers_skipped_existing),
+            ):
+                REGISTRY.gauge(name, feed=self.feed).set(value)
             logging.info(
                 '\nВсего обработано фидов - %s'
                 '\nВсего обработано офферов - %s'
@@ -226,41 +612,212 @@ class FeedImage(FileMixin):
                 images_downloaded,
                 offers_skipped_existing
             )
+            self._save_picture_state()
         except Exception as error:
             logging.error(
                 'Неожиданная ошибка при получении изображений: %s',
                 error
             )
 
+    def _get_canvas(self, canvas_path: Path, size: tuple) -> Image.Image:
+        """
+        Защищенный метод, возвращает подложку нужного размера.
+
+        Подготовленные подложки кэшируются на уровне класса по пути и
+        размеру варианта и перечитываются только при изменении файла,
+        поэтому долгоживущий процесс не декодирует и не масштабирует
+        их на каждом цикле.
+        """
+        mtime = canvas_path.stat().st_mtime_ns
+        key = (str(canvas_path), size)
+        cached = self._canvas_cache.get(key)
+        if cached is None or cached[0] != mtime:
+            with Image.open(canvas_path) as canvas:
+                canvas = canvas.convert('RGBA')
+            canvas = canvas.resize(size, Image.Resampling.LANCZOS)
+            cached = (mtime, canvas)
+            self._canvas_cache[key] = cached
+        return cached[1]
+
+    def _get_render_plan(self, frame_path: Path) -> tuple:
+        """Защищенный метод, возвращает план рендеринга вариантов."""
+        if self.render_plan is None:
+            self.render_plan = load_render_plan(frame_path / RENDER_PLAN)
+        return self.render_plan
+
+    def _prepare_variants(
+        self,
+        frame_path: Path,
+        new_file_path: Path
+    ) -> list[tuple[RenderVariant, Image.Image]]:
+        """
+        Защищенный метод, готовит варианты к рендерингу: подложки,
+        директории и множества уже обрамленных офферов. Вариант,
+        подложку которого не удалось загрузить, пропускается.
+        """
+        prepared = []
+        for variant in self._get_render_plan(frame_path):
+            try:
+                canvas = self._get_canvas(
+                    frame_path / variant.canvas,
+                    variant.size
+                )
+            except Exception as error:
+                logging.error(
+                    'Не удалось загрузить подложку варианта %s: %s',
+                    variant.name,
+                    error
+                )
+                continue
+            variant_path = new_file_path / variant.folder
+            variant_path.mkdir(parents=True, exist_ok=True)
+            self._clean_temp_files(variant_path)
+            if variant.name not in self._existing_framed_offers:
+                framed_offers = set()
+                try:
+                    self._build_set(
+                        str(Path(self.new_image_folder) / variant.folder),
+                        framed_offers
+                    )
+                except (DirectoryCreationError, EmptyFeedsListError):
+                    logging.warning(
+                        'Изображений варианта %s еще нет. Первый запуск',
+                        variant.name
+                    )
+                framed_offers.update(
+                    file.name.split('.')[0]
+                    for file in variant_path.iterdir()
+                    if file.is_file() and not file.name.startswith('.')
+                )
+                self._existing_framed_offers[variant.name] = framed_offers
+            prepared.append((variant, canvas))
+        return prepared
+
+    def _get_compositor(self):
+        """
+        Защищенный метод, возвращает NumpyCompositor для движка 'numpy'
+        или None для Pillow. NumPy импортируется только при выборе движка.
+        У каждого потока свой компоновщик со своими буферами, поэтому
+        рабочие потоки конвейера накладывают товары без блокировки.
+        """
+        if self.composite_engine != 'numpy':
+            return None
+        compositor = getattr(self._compositors, 'compositor', None)
+        if compositor is None:
+            from handler.compositing import NumpyCompositor
+
+            compositor = NumpyCompositor(self.composite_batch)
+            self._compositors.compositor = compositor
+        return compositor
+
+    def _compose(
+        self,
+        variant: RenderVariant,
+        canvas: Image.Image,
+        jobs: list[tuple[str, Image.Image]]
+    ):
+        """
+        Защищенный метод, отдает пары (offer_id, кадр) для товаров
+        пачки выбранным движком наложения.
+        """
+        compositor = self._get_compositor()
+        if compositor is None:
+            for offer_id, product in jobs:
+                yield offer_id, variant.compose(canvas, product)
+            return
+        placements = [
+            (product, variant.position(canvas, product))
+            for _, product in jobs
+        ]
+        for index, frame in compositor.composite(canvas, placements):
+            yield jobs[index][0], frame
+
+    def _render_batch(
+        self,
+        batch: list[tuple[str, Image.Image]],
+        variants: list[tuple[RenderVariant, Image.Image]],
+        new_file_path: Path
+    ) -> None:
+        """
+        Защищенный метод, рендерит все варианты офферов пачки.
+
+        Каждый исходник декодирован один раз, отмасштабированный товар
+        переиспользуется вариантами с одинаковым размером товара.
+        Кадр кодируется сразу после наложения.
+        """
+        products: dict[tuple, Image.Image] = {}
+        for variant, canvas in variants:
+            framed_offers = self._existing_framed_offers[variant.name]
+            jobs = []
+            for offer_id, image in batch:
+                if offer_id in framed_offers:
+                    continue
+                with REGISTRY.timer('composite_seconds'):
+                    key = (offer_id, variant.product_size(image.size))
+                    product = products.get(key)
+                    if product is None:
+                        product = image.resize(
+                            key[1],
+                            Image.Resampling.LANCZOS
+                        )
+                        products[key] = product
+                jobs.append((offer_id, product))
+            frames = self._compose(variant, canvas, jobs)
+            while True:
+                with REGISTRY.timer('composite_seconds'):
+                    item = next(frames, None)
+                if item is None:
+                    break
+                offer_id, final_image = item
+                final_path = variant.output_path(new_file_path, offer_id)
+                temp_path = self._temp_path(final_path)
+                with REGISTRY.timer('encode_seconds'):
+                    variant.save(final_image, temp_path)
+                os.replace(temp_path, final_path)
+                framed_offers.add(offer_id)
+        for offer_id, _ in batch:
+            self._mark_done('add_background', offer_id)
+
     @time_of_function
     def add_background(self):
-        """Накладывает PNG без фона на дизайнерскую подложку."""
+        """
+        Накладывает PNG без фона на дизайнерские подложки.
+
+        Для каждого оффера исходник декодируется один раз, из него
+        рендерятся все варианты плана (см. RenderVariant, RENDER_PLAN).
+        Оффер пропускается, если готовы все его варианты. Движок
+        'numpy' (COMPOSITE_ENGINE) обрабатывает офферы пачками по
+        COMPOSITE_BATCH, результат совпадает с Pillow байт в байт.
+        Кадры пишутся в staging и публикуются через Publisher; офферы,
+        ожидающие публикации, тоже считаются готовыми.
+        """
         file_path = self._make_dir(self.image_folder)
         frame_path = self._make_dir(self.frame_folder)
-        new_file_path = self._make_dir(self.new_image_folder)
+        new_file_path = self._make_dir(staging_folder(self.new_image_folder))
         total_framed_images = 0
         total_failed_images = 0
         skipped_images = 0
 
         try:
-            self._build_set(
-                self.new_image_folder,
-                self._existing_framed_offers
-            )
-        except (DirectoryCreationError, EmptyFeedsListError):
-            logging.warning(
-                'Директория с форматированными изображениями отсутствует. '
-                'Первый запуск'
-            )
-        try:
-            canvas = Image.open(frame_path / NAME_OF_CANVAS).convert('RGBA')
-            canvas = canvas.resize((1000, 1000), Image.Resampling.LANCZOS)
-        except Exception as error:
-            logging.error('Не удалось загрузить подложку: %s', error)
+            variants = self._prepare_variants(frame_path, new_file_path)
+        except InvalidRenderPlanError as error:
+            logging.error('Ошибка плана рендеринга: %s', error)
+            return
+        if not variants:
+            logging.error('Нет ни одного варианта для рендеринга')
             return
+        batch_size = 1
+        if self._get_compositor() is not None:
+            batch_size = self.composite_batch
+        pending: list[tuple[str, Image.Image]] = []
         try:
             for image_name in self.images:
-                if image_name.split('.')[0] in self._existing_framed_offers:
+                offer_id = image_name.split('.')[0]
+                is_existing = all(
+                    offer_id in self._existing_framed_offers[variant.name]
+                    for variant, _ in variants
+                )
+                if is_existing or self._is_done('add_background', offer_id):
                     skipped_images += 1
                     continue
                 try:
@@ -276,28 +833,403 @@ class FeedImage(FileMixin):
                     )
                     continue
 
-                max_product_height = int(canvas.height * 0.6)
-                scale = max_product_height / image.height
-                new_size = (
-                    int(image.width * scale),
-                    int(image.height * scale)
+                pending.append((offer_id, image))
+                if len(pending) >= batch_size:
+                    self._render_batch(pending, variants, new_file_path)
+                    total_framed_images += len(pending)
+                    pending.clear()
+            if pending:
+                self._render_batch(pending, variants, new_file_path)
+                total_framed_images += len(pending)
+
+        except Exception as error:
+            logging.error(
+                'Критическая ошибка в процессе обрамления: %s', error)
+            raise
+        finally:
+            for name, value in (
+                ('images_framed', total_framed_images),
+                ('images_frame_failed', total_failed_images),
+                ('images_frame_skipped', skipped_images),
+            ):
+                REGISTRY.gauge(name, feed=self.feed).set(value)
+
+    def _iter_image_jobs(
+        self,
+        folder_path: Path,
+        variants: list[tuple[RenderVariant, Image.Image]],
+        claimed: set[str],
+        offers: dict[str, str] | None = None,
+        force: bool = False
+    ) -> Iterator[ImageJob]:
+        """
+        Защищенный метод, отдает задания конвейера по офферам фидов.
+
+        Оффер пропускается, если исходник уже скачан и все варианты
+        готовы, а также если в этом прогоне его изображение уже было
+        отклонено. Повторы одного оффера отбрасываются. Оффер, который
+        сейчас обрабатывает конвейер другого фида (файлы изображений
+        общие), тоже пропускается; взятые офферы копятся в claimed.
+        Файлы, записанные другими фидами, находятся по диску (см.
+        _refresh_offer).
+
+        Если передан offers ({offer_id: url}), задания строятся только
+        по нему. Оффер обрабатывается заново целиком при force или если
+        его картинка сменилась с прошлого прогона.
+        """
+        seen = set()
+        pictures = self._iter_offer_pictures()
+        previous_pictures = {}
+        if offers is not None:
+            pictures = iter(offers.items())
+            previous_pictures = self.offer_pictures or read_picture_state(
+                folder_path
+            )
+            self.offer_pictures = {**previous_pictures, **offers}
+        for offer_id, offer_image in pictures:
+            if not offer_image or offer_id in seen:
+                continue
+            seen.add(offer_id)
+            with self._in_flight_lock:
+                if offer_id in self._in_flight:
+                    continue
+                self._in_flight.add(offer_id)
+            claimed.add(offer_id)
+            previous_image = previous_pictures.get(offer_id, offer_image)
+            if force or previous_image != offer_image:
+                self._existing_image_offers.discard(offer_id)
+                for framed_offers in self._existing_framed_offers.values():
+                    framed_offers.discard(offer_id)
+                yield ImageJob(
+                    offer_id,
+                    offer_image,
+                    folder_path / self._get_image_filename(offer_id),
+                    False
                 )
-                image = image.resize(new_size, Image.Resampling.LANCZOS)
+                continue
+            source_path = folder_path / self._get_image_filename(offer_id)
+            self._refresh_offer(offer_id, source_path, variants)
+            has_source = offer_id in self._existing_image_offers
+            if not has_source and self._is_done('get_images', offer_id):
+                continue
+            is_framed = self._is_done('add_background', offer_id) or all(
+                offer_id in self._existing_framed_offers[variant.name]
+                for variant, _ in variants
+            )
+            if has_source and is_framed:
+                continue
+            yield ImageJob(offer_id, offer_image, source_path, has_source)
+
+    def _refresh_offer(
+        self,
+        offer_id: str,
+        source_path: Path,
+        variants: list[tuple[RenderVariant, Image.Image]]
+    ) -> None:
+        """
+        Защищенный метод, дополняет кэши готовых файлов оффера по диску.
 
-                product_x = (canvas.width - image.width) // 2
-                visual_center_y = int(canvas.height * 0.56)
-                product_y = int(visual_center_y - image.height / 2)
+        Директории изображений общие для всех фидов, а кэши у каждого
+        экземпляра свои: исходник или кадр мог записать конвейер
+        другого фида уже после построения кэша. Диск проверяется только
+        для оффера, которого в кэше нет.
+        """
+        if offer_id not in self._existing_image_offers:
+            if source_path.exists():
+                self._existing_image_offers.add(offer_id)
+        base_path = Path(__file__).parent.parent
+        frame_folders = (
+            base_path / self.new_image_folder,
+            base_path / staging_folder(self.new_image_folder),
+        )
+        for variant, _ in variants:
+            framed_offers = self._existing_framed_offers[variant.name]
+            if offer_id in framed_offers:
+                continue
+            if any(
+                variant.output_path(folder, offer_id).exists()
+                for folder in frame_folders
+            ):
+                framed_offers.add(offer_id)
 
-                final_image = canvas.copy()
-                final_image.paste(image, (product_x, product_y), image)
-                final_image.save(
-                    new_file_path / f"{image_name.split('.')[0]}.png", 'PNG')
-                total_framed_images += 1
+    def _fetch_stage(self, job: ImageJob) -> ImageJob | None:
+        """Защищенный метод, этап конвейера: скачивание исходника."""
+        if job.has_source:
+            return job
+        try:
+            size = self._fetch_image(job.url, job.download_path)
+        except Exception as error:
+            self._reject_image(job.url, job.download_path, error)
+            self._mark_done('get_images', job.offer_id)
+            return None
+        REGISTRY.counter('image_download_bytes_total').inc(size)
+        return job
 
+    def _validate_stage(self, job: ImageJob) -> ImageJob | None:
+        """Защищенный метод, этап конвейера: проверка скачанного файла."""
+        if job.has_source:
+            return job
+        try:
+            self._validate_image(job.download_path)
+        except Exception as error:
+            self._reject_image(job.url, job.download_path, error)
+            self._mark_done('get_images', job.offer_id)
+            return None
+        return job
+
+    def _remove_bg_stage(self, job: ImageJob) -> ImageJob:
+        """Защищенный метод, этап конвейера: удаление фона."""
+        if job.has_source:
+            return job
+        self._store_source(
+            job.source_path.parent,
+            job.download_path,
+            job.source_path.name
+        )
+        self._existing_image_offers.add(job.offer_id)
+        self._mark_done('get_images', job.offer_id)
+        job.has_source = True
+        return job
+
+    def _composite_stage(
+        self,
+        variants: list[tuple[RenderVariant, Image.Image]],
+        new_file_path: Path,
+        job: ImageJob
+    ) -> ImageJob | None:
+        """
+        Защищенный метод, этап конвейера: наложение товара на подложки
+        всех еще не готовых вариантов. Исходник декодируется один раз.
+
+        Кадр движка 'numpy' ссылается на буфер компоновщика потока и
+        кодируется здесь же, до следующего наложения, без копирования;
+        кадры Pillow кодирует этап encode.
+        """
+        missing = [
+            (variant, canvas) for variant, canvas in variants
+            if job.offer_id not in self._existing_framed_offers[variant.name]
+        ]
+        if not missing:
+            self._mark_done('add_background', job.offer_id)
+            return None
+        with Image.open(job.source_path) as image:
+            image = image.convert('RGBA')
+        compositor = self._get_compositor()
+        products: dict[tuple, Image.Image] = {}
+        for variant, canvas in missing:
+            with REGISTRY.timer('composite_seconds'):
+                size = variant.product_size(image.size)
+                product = products.get(size)
+                if product is None:
+                    product = image.resize(size, Image.Resampling.LANCZOS)
+                    products[size] = product
+                if compositor is None:
+                    frame = variant.compose(canvas, product)
+                else:
+                    _, frame = next(compositor.composite(
+                        canvas,
+                        [(product, variant.position(canvas, product))]
+                    ))
+            if compositor is None:
+                job.frames.append((variant, frame))
+            else:
+                self._encode_frame(new_file_path, job, variant, frame)
+        if compositor is not None:
+            self._mark_done('add_background', job.offer_id)
+        return job
+
+    def _encode_frame(
+        self,
+        new_file_path: Path,
+        job: ImageJob,
+        variant: RenderVariant,
+        frame: Image.Image
+    ) -> None:
+        """Защищенный метод, кодирует кадр варианта оффера в staging."""
+        final_path = variant.output_path(new_file_path, job.offer_id)
+        temp_path = self._temp_path(final_path)
+        with REGISTRY.timer('encode_seconds'):
+            variant.save(frame, temp_path)
+        os.replace(temp_path, final_path)
+        self._existing_framed_offers[variant.name].add(job.offer_id)
+        job.staged.append(final_path)
+
+    def _encode_stage(self, new_file_path: Path, job: ImageJob) -> ImageJob:
+        """Защищенный метод, этап конвейера: кодирование кадров в staging."""
+        for variant, frame in job.frames:
+            self._encode_frame(new_file_path, job, variant, frame)
+        job.frames = []
+        self._mark_done('add_background', job.offer_id)
+        return job
+
+    def _publish_stage(self, publisher: Publisher, job: ImageJob) -> ImageJob:
+        """Защищенный метод, этап конвейера: публикация кадров."""
+        for staged_path in job.staged:
+            publisher.publish_file(staged_path)
+        return job
+
+    @time_of_function
+    def process_images(
+        self,
+        frame: bool = True,
+        offers: dict[str, str] | None = None,
+        force: bool = False
+    ) -> int:
+        """
+        Потоковая обработка изображений конвейером
+        fetch -> validate -> remove_bg -> composite -> encode -> publish.
+
+        В отличие от последовательных get_images и add_background,
+        оффер переходит на следующий этап сразу, как только готов:
+        сеть, PhotoRoom и процессор заняты одновременно. Число потоков
+        этапов задает PIPELINE_WORKERS, емкость очередей между ними -
+        PIPELINE_QUEUE_SIZE. С движком 'numpy' кадры кодирует этап
+        composite, и потоки encode добавляются к его потокам. При
+        frame=False выполняются только скачивание, проверка и удаление
+        фона. Публикация всегда идет в один поток, потому что манифест
+        общий. Если задан budget
+        (scheduler.ResourceBudget), сетевые и вычислительные этапы
+        занимают его общие слоты. offers ({offer_id: url}) ограничивает
+        прогон этими офферами, force обрабатывает их заново, даже если
+        все готово (см. reprocess_offers). Возвращает число офферов,
+        прошедших конвейер.
+        """
+        folder_path = self._load_existing_images()
+        workers = parse_workers(self.pipeline_workers)
+        cpu = network = None
+        if self.budget is not None:
+            cpu, network = self.budget.cpu, self.budget.network
+        stages = [
+            Stage(name, func, workers.get(name, 1), limit)
+            for name, func, limit in (
+                ('fetch', self._fetch_stage, network),
+                ('validate', self._validate_stage, cpu),
+                ('remove_bg', self._remove_bg_stage, network),
+            )
+        ]
+        variants = []
+        publisher = None
+        if frame:
+            frame_path = self._make_dir(self.frame_folder)
+            new_file_path = self._make_dir(
+                staging_folder(self.new_image_folder)
+            )
+            try:
+                variants = self._prepare_variants(frame_path, new_file_path)
+            except InvalidRenderPlanError as error:
+                logging.error('Ошибка плана рендеринга: %s', error)
+                return 0
+            if not variants:
+                logging.error('Нет ни одного варианта для рендеринга')
+                return 0
+            publisher = Publisher(self.new_image_folder)
+            composite_workers = workers.get('composite', 1)
+            if self.composite_engine == 'numpy':
+                composite_workers += workers.get('encode', 1)
+            stages.append(Stage(
+                'composite',
+                functools.partial(
+                    self._composite_stage,
+                    variants,
+                    new_file_path
+                ),
+                composite_workers,
+                cpu
+            ))
+            if self.composite_engine != 'numpy':
+                stages.append(Stage(
+                    'encode',
+                    functools.partial(self._encode_stage, new_file_path),
+                    workers.get('encode', 1),
+                    cpu
+                ))
+            stages += [
+                Stage(
+                    'publish',
+                    functools.partial(self._publish_stage, publisher)
+                ),
+            ]
+        claimed: set[str] = set()
+        try:
+            processed = Pipeline(stages, self.pipeline_queue_size).run(
+                self._iter_image_jobs(
+                    folder_path,
+                    variants,
+                    claimed,
+                    offers,
+                    force
+                )
+            )
         except Exception as error:
             logging.error(
-                'Критическая ошибка в процессе обрамления: %s', error)
+                'Неожиданная ошибка в конвейере изображений: %s',
+                error
+            )
             raise
+        finally:
+            with self._in_flight_lock:
+                self._in_flight.difference_update(claimed)
+            self._save_picture_state()
+            if publisher is not None:
+                publisher.save_manifest()
+        REGISTRY.gauge(
+            'images_pipeline_processed',
+            feed=self.feed
+        ).set(processed)
+        return processed
+
+    def find_offer_pictures(self, offer_ids: list[str]) -> dict[str, str]:
+        """
+        Метод находит картинки офферов по индексам фидов, без разбора
+        XML. Возвращает {offer_id: url} для найденных офферов.
+        """
+        pictures = {}
+        feeds_path = Path(__file__).parent.parent / self.feeds_folder
+        for filename in self.filenames:
+            index = OfferIndex.for_feed(feeds_path / filename)
+            for offer_id in offer_ids:
+                if offer_id in pictures:
+                    continue
+                url = index.picture(offer_id)
+                if url:
+                    pictures[offer_id] = url
+        return pictures
+
+    def is_offer_done(self, offer_id: str, frame: bool = True) -> bool:
+        """
+        Метод проверяет по кэшам экземпляра, что исходник оффера
+        скачан и, при frame, все варианты обрамлены. Наличие исходника
+        дополнительно проверяется на диске.
+        """
+        if offer_id not in self._existing_image_offers:
+            return False
+        source_path = Path(__file__).parent.parent.joinpath(
+            self.image_folder,
+            self._get_image_filename(offer_id)
+        )
+        if not source_path.exists():
+            return False
+        return not frame or all(
+            offer_id in framed_offers
+            for framed_offers in self._existing_framed_offers.values()
+        )
+
+    def reprocess_offers(self, offer_ids: list[str], frame: bool = True):
+        """
+        Метод заново скачивает и обрабатывает изображения офферов:
+        удаление фона, наложение на подложку и публикация.
+
+        Картинки берутся из индексов фидов, поэтому на один оффер
+        уходят миллисекунды поиска вместо разбора всех фидов.
+        Возвращает число обработанных офферов.
+        """
+        pictures = self.find_offer_pictures(offer_ids)
+        for offer_id in offer_ids:
+            if offer_id not in pictures:
+                logging.warning('Картинка оффера %s не найдена', offer_id)
+        if not pictures:
+            return 0
+        return self.process_images(frame, pictures, force=True)
 
     # def add_ai_bg(self):
     #     bg_path = self._make_dir('frame')
@@ -0,0 +1,393 @@
+"""
+Очередь заданий изображений с арендой для нескольких обработчиков.
+
+Очередь - файл SQLite (QUEUE_DB) на томе, общем для всех контейнеров.
+Задание - один оффер и ссылка на его картинку. Обработчик берет пачку
+заданий в аренду (lease) на QUEUE_LEASE_SECONDS и, пока работает,
+продлевает ее (heartbeat). Если обработчик упал, аренда истекает и
+задание выдается другому. Выдача идет в транзакции BEGIN IMMEDIATE,
+поэтому два обработчика не получают одно задание.
+
+Завершение идемпотентно: оно принимается только от текущего
+арендатора (по токену аренды), повторное или запоздавшее завершение
+ничего не меняет. Ошибка возвращает задание в очередь с удвоением
+задержки, после QUEUE_MAX_ATTEMPTS попыток оно считается проваленным.
+Сами результаты пишутся атомарно (см. FileMixin), поэтому повторная
+обработка оффера после истекшей аренды безопасна.
+
+SQLite полагается на блокировки файловой системы: том должен быть
+локальным для хоста (docker volume, bind mount). На сетевых ФС (NFS,
+SMB) блокировки ненадежны.
+"""
+import logging
+import os
+import socket
+import sqlite3
+import threading
+import time
+import uuid
+from collections.abc import Iterable
+from pathlib import Path
+
+from handler.constants import (QUEUE_BATCH, QUEUE_DB, QUEUE_LEASE_SECONDS,
+                               QUEUE_MAX_ATTEMPTS, QUEUE_POLL_SECONDS,
+                               QUEUE_RETRY_DELAY)
+from handler.metrics import REGISTRY
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS jobs (
+    offer_id TEXT PRIMARY KEY,
+    url TEXT NOT NULL,
+    status TEXT NOT NULL DEFAULT 'pending',
+    attempts INTEGER NOT NULL DEFAULT 0,
+    available_at REAL NOT NULL DEFAULT 0,
+    lease_token TEXT,
+    worker TEXT,
+    lease_until REAL,
+    error TEXT,
+    updated REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS jobs_ready ON jobs (status, available_at);
+'''
+"""Схема очереди. status: pending, leased, done, failed."""
+
+
+class Job:
+    """Арендованное задание: оффер, картинка, номер попытки и токен."""
+
+    def __init__(
+        self,
+        offer_id: str,
+        url: str,
+        attempts: int,
+        token: str
+    ) -> None:
+        self.offer_id = offer_id
+        self.url = url
+        self.attempts = attempts
+        self.token = token
+
+    def __repr__(self) -> str:
+        return f'Job({self.offer_id!r}, attempt={self.attempts})'
+
+
+class JobQueue:
+    """
+    Класс очереди заданий в SQLite.
+
+    Соединение общее для потоков экземпляра (обработчик и поток
+    продления аренды) и защищено блокировкой; разные процессы
+    открывают свои экземпляры.
+    """
+
+    def __init__(
+        self,
+        db_name: str = QUEUE_DB,
+        max_attempts: int = QUEUE_MAX_ATTEMPTS,
+        retry_delay: int = QUEUE_RETRY_DELAY
+    ) -> None:
+        self.db_path = Path(__file__).parent.parent / db_name
+        self.db_path.parent.mkdir(parents=True, exist_ok=True)
+        self.max_attempts = max_attempts
+        self.retry_delay = retry_delay
+        self.connection = sqlite3.connect(
+            self.db_path,
+            timeout=60,
+            isolation_level=None,
+            check_same_thread=False
+        )
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.executescript(SCHEMA)
+        self._lock = threading.Lock()
+
+    def close(self) -> None:
+        """Метод закрывает соединение с очередью."""
+        self.connection.close()
+
+    def __enter__(self) -> 'JobQueue':
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.close()
+
+    def _execute(self, query: str, params: tuple = ()) -> sqlite3.Cursor:
+        """Защищенный метод, выполняет запрос под блокировкой."""
+        with self._lock:
+            return self.connection.execute(query, params)
+
+    def fill(self, pictures: Iterable[tuple[str, str]]) -> int:
+        """
+        Метод добавляет задания по парам (offer_id, url).
+
+        Новые офферы попадают в очередь, у оффера со сменившейся
+        картинкой задание сбрасывается (текущая аренда перестает
+        действовать), остальные не меняются. Возвращает число
+        добавленных и сброшенных заданий.
+        """
+        now = time.time()
+        with self._lock:
+            before = self.connection.total_changes
+            self.connection.execute('BEGIN IMMEDIATE')
+            try:
+                self.connection.executemany(
+                    'INSERT INTO jobs (offer_id, url, updated) '
+                    'VALUES (?, ?, ?) '
+                    'ON CONFLICT (offer_id) DO UPDATE SET '
+                    "url = excluded.url, status = 'pending', attempts = 0, "
+                    'available_at = 0, lease_token = NULL, error = NULL, '
+                    'updated = excluded.updated '
+                    'WHERE jobs.url != excluded.url',
+                    ((offer_id, url, now) for offer_id, url in pictures)
+                )
+                self.connection.execute('COMMIT')
+            except BaseException:
+                self.connection.execute('ROLLBACK')
+                raise
+            return self.connection.total_changes - before
+
+    def lease(
+        self,
+        worker: str,
+        limit: int = QUEUE_BATCH,
+        lease_seconds: int = QUEUE_LEASE_SECONDS
+    ) -> list[Job]:
+        """
+        Метод выдает до limit готовых заданий в аренду.
+
+        Готовы ожидающие задания, у которых прошла задержка повтора, и
+        задания с истекшей арендой. Задание с истекшей арендой, у
+        которого кончились попытки, помечается проваленным.
+        """
+        now = time.time()
+        token = uuid.uuid4().hex
+        with self._lock:
+            self.connection.execute('BEGIN IMMEDIATE')
+            try:
+                self.connection.execute(
+                    "UPDATE jobs SET status = 'failed', lease_token = NULL, "
+                    "error = 'Аренда истекла', updated = ? "
+                    "WHERE status = 'leased' AND lease_until < ? "
+                    'AND attempts >= ?',
+                    (now, now, self.max_attempts)
+                )
+                rows = self.connection.execute(
+                    'SELECT offer_id, url, attempts FROM jobs '
+                    "WHERE (status = 'pending' AND available_at <= ?) "
+                    "OR (status = 'leased' AND lease_until < ?) "
+                    'ORDER BY available_at LIMIT ?',
+                    (now, now, limit)
+                ).fetchall()
+                self.connection.executemany(
+                    "UPDATE jobs SET status = 'leased', lease_token = ?, "
+                    'worker = ?, lease_until = ?, attempts = attempts + 1, '
+                    'updated = ? WHERE offer_id = ?',
+                    (
+                        (token, worker, now + lease_seconds, now, row[0])
+                        for row in rows
+                    )
+                )
+                self.connection.execute('COMMIT')
+            except BaseException:
+                self.connection.execute('ROLLBACK')
+                raise
+        return [
+            Job(offer_id, url, attempts + 1, token)
+            for offer_id, url, attempts in rows
+        ]
+
+    def heartbeat(
+        self,
+        token: str,
+        lease_seconds: int = QUEUE_LEASE_SECONDS
+    ) -> int:
+        """
+        Метод продлевает аренду заданий с токеном token и возвращает
+        число заданий, которые все еще принадлежат арендатору.
+        """
+        now = time.time()
+        return self._execute(
+            'UPDATE jobs SET lease_until = ?, updated = ? '
+            "WHERE lease_token = ? AND status = 'leased'",
+            (now + lease_seconds, now, token)
+        ).rowcount
+
+    def complete(self, job: Job) -> bool:
+        """
+        Метод отмечает задание выполненным.
+
+        Возвращает False, если аренда уже не принадлежит этому
+        обработчику (истекла, задание сброшено или уже завершено):
+        состояние очереди тогда не меняется.
+        """
+        completed = self._execute(
+            "UPDATE jobs SET status = 'done', lease_token = NULL, "
+            'lease_until = NULL, error = NULL, updated = ? '
+            "WHERE offer_id = ? AND lease_token = ? AND status = 'leased'",
+            (time.time(), job.offer_id, job.token)
+        ).rowcount == 1
+        REGISTRY.counter(
+            'queue_jobs_total',
+            'Задания очереди изображений по результату',
+            result='done' if completed else 'stale'
+        ).inc()
+        return completed
+
+    def fail(self, job: Job, error: str) -> bool:
+        """
+        Метод возвращает задание в очередь после ошибки или, если
+        попытки кончились, помечает его проваленным.
+        """
+        status = 'failed' if job.attempts >= self.max_attempts else 'pending'
+        delay = self.retry_delay * 2 ** (job.attempts - 1)
+        failed = self._execute(
+            'UPDATE jobs SET status = ?, lease_token = NULL, '
+            'lease_until = NULL, available_at = ?, error = ?, updated = ? '
+            "WHERE offer_id = ? AND lease_token = ? AND status = 'leased'",
+            (
+                status,
+                time.time() + delay,
+                error[:500],
+                time.time(),
+                job.offer_id,
+                job.token
+            )
+        ).rowcount == 1
+        if failed:
+            REGISTRY.counter(
+                'queue_jobs_total',
+                result='failed' if status == 'failed' else 'retry'
+            ).inc()
+        return failed
+
+    def retry_failed(self) -> int:
+        """Метод возвращает проваленные задания в очередь."""
+        return self._execute(
+            "UPDATE jobs SET status = 'pending', attempts = 0, "
+            'available_at = 0, updated = ? '
+            "WHERE status = 'failed'",
+            (time.time(),)
+        ).rowcount
+
+    def stats(self) -> dict[str, int]:
+        """Метод возвращает число заданий по статусам."""
+        counts = {'pending': 0, 'leased': 0, 'done': 0, 'failed': 0}
+        counts.update(self._execute(
+            'SELECT status, COUNT(*) FROM jobs GROUP BY status'
+        ).fetchall())
+        return counts
+
+    def has_work(self) -> bool:
+        """Метод проверяет, есть ли ожидающие или арендованные задания."""
+        return self._execute(
+            "SELECT 1 FROM jobs WHERE status IN ('pending', 'leased') LIMIT 1"
+        ).fetchone() is not None
+
+
+class QueueWorker:
+    """
+    Класс обработчика очереди изображений.
+
+    Пачка заданий проходит обычный конвейер FeedImage.process_images,
+    ограниченный офферами пачки. Оффер считается выполненным, если
+    после прогона его исходник и кадры готовы (FeedImage.is_offer_done).
+    """
+
+    def __init__(
+        self,
+        job_queue: JobQueue,
+        image_client,
+        frame: bool = True,
+        batch: int = QUEUE_BATCH,
+        lease_seconds: int = QUEUE_LEASE_SECONDS,
+        poll_seconds: int = QUEUE_POLL_SECONDS,
+        worker_id: str | None = None
+    ) -> None:
+        self.job_queue = job_queue
+        self.image_client = image_client
+        self.frame = frame
+        self.batch = max(1, batch)
+        self.lease_seconds = lease_seconds
+        self.poll_seconds = poll_seconds
+        self.worker_id = worker_id or f'{socket.gethostname()}-{os.getpid()}'
+
+    def _heartbeat(self, token: str, stop: threading.Event) -> None:
+        """Защищенный метод, продлевает аренду пачки, пока она в работе."""
+        while not stop.wait(self.lease_seconds / 3):
+            try:
+                self.job_queue.heartbeat(token, self.lease_seconds)
+            except sqlite3.Error as error:
+                logging.warning('Аренда %s не продлена: %s', token, error)
+
+    def run_batch(self) -> dict[str, int] | None:
+        """
+        Метод берет и обрабатывает одну пачку заданий.
+
+        Возвращает счетчики done/failed/stale или None, если свободных
+        заданий нет.
+        """
+        jobs = self.job_queue.lease(
+            self.worker_id,
+            self.batch,
+            self.lease_seconds
+        )
+        if not jobs:
+            return None
+        stop = threading.Event()
+        heartbeat = threading.Thread(
+            target=self._heartbeat,
+            args=(jobs[0].token, stop),
+            name='queue-heartbeat',
+            daemon=True
+        )
+        heartbeat.start()
+        error = None
+        try:
+            self.image_client.process_images(
+                self.frame,
+                {job.offer_id: job.url for job in jobs}
+            )
+        except Exception as batch_error:
+            error = f'{type(batch_error).__name__}: {batch_error}'
+            logging.error('Ошибка пачки заданий: %s', batch_error)
+        finally:
+            stop.set()
+            heartbeat.join()
+        counts = {'done': 0, 'failed': 0, 'stale': 0}
+        for job in jobs:
+            if error is None and self.image_client.is_offer_done(
+                job.offer_id,
+                self.frame
+            ):
+                result = 'done' if self.job_queue.complete(job) else 'stale'
+            else:
+                result = 'failed' if self.job_queue.fail(
+                    job,
+                    error or 'Изображение не получено'
+                ) else 'stale'
+            counts[result] += 1
+        logging.info('Пачка %s: %s', len(jobs), counts)
+        return counts
+
+    def run(self, once: bool = False) -> dict[str, int]:
+        """
+        Метод обрабатывает пачки, пока в очереди есть работа.
+
+        Если свободных заданий нет, но другие обработчики еще держат
+        аренду, обработчик ждет: истекшая аренда вернет задания.
+        При once выполняется не больше одной пачки.
+        """
+        totals = {'done': 0, 'failed': 0, 'stale': 0}
+        logging.info('Обработчик очереди %s запущен', self.worker_id)
+        while True:
+            counts = self.run_batch()
+            if counts is not None:
+                for result, count in counts.items():
+                    totals[result] += count
+            if once:
+                break
+            if counts is None:
+                if not self.job_queue.has_work():
+                    break
+                time.sleep(self.poll_seconds)
+        logging.info('Обработчик очереди %s: %s', self.worker_id, totals)
+        return totals
@@ -0,0 +1,204 @@
+import json
+import logging
+import os
+import threading
+from datetime import datetime as dt
+
+from handler.constants import (DATE_FORMAT, JOURNAL_FOLDER,
+                               JOURNAL_MAX_RESUMES, TIME_FORMAT)
+from handler.mixins import FileMixin
+
+
+class RunJournal(FileMixin):
+    """
+    Журнал прогона пайплайна.
+
+    Хранит состояние текущего прогона в двух видах:
+    - '{name}.json' - статус прогона и завершенные этапы,
+    перезаписывается атомарно;
+    - '{name}.{stage}.items' - построчный журнал обработанных элементов
+    этапа, дописывается по одной строке на элемент.
+
+    Если предыдущий прогон не дошел до finish() (процесс упал),
+    следующий start() продолжает его: завершенные этапы и элементы
+    пропускаются, но не больше max_resumes раз подряд. Прогон, этап
+    которого завершился исключением, отмечается fail() и не
+    продолжается: иначе фид с постоянно падающим этапом никогда не
+    скачивался бы заново.
+    """
+
+    def __init__(
+        self,
+        name: str = 'pipeline',
+        journal_folder: str = JOURNAL_FOLDER,
+        max_resumes: int = JOURNAL_MAX_RESUMES
+    ) -> None:
+        self.name = name
+        self.journal_folder = journal_folder
+        self.max_resumes = max_resumes
+        self._folder_path = self._make_dir(journal_folder)
+        self._state_path = self._folder_path / f'{name}.json'
+        self._state: dict = {}
+        self._done_items: dict[str, set[str]] = {}
+        self._item_files: dict = {}
+        self._lock = threading.Lock()
+
+    @property
+    def run_id(self) -> str | None:
+        """Идентификатор текущего прогона."""
+        return self._state.get('run_id')
+
+    def _items_path(self, stage: str):
+        """Защищенный метод, возвращает путь журнала элементов этапа."""
+        return self._folder_path / f'{self.name}.{stage}.items'
+
+    def _load_state(self) -> dict:
+        """Защищенный метод, читает состояние прошлого прогона."""
+        if not self._state_path.exists():
+            return {}
+        try:
+            with open(self._state_path, encoding='utf-8') as f:
+                return json.load(f)
+        except (OSError, ValueError) as error:
+            logging.warning(
+                'Журнал %s поврежден и будет создан заново: %s',
+                self._state_path,
+                error
+            )
+            return {}
+
+    def _write_state(self) -> None:
+        """Защищенный метод, атомарно сохраняет состояние прогона."""
+        data = json.dumps(self._state, ensure_ascii=False, indent=2)
+        self._atomic_write(self._state_path, data.encode('utf-8'))
+
+    def _reset_items(self) -> None:
+        """Защищенный метод, удаляет журналы элементов прошлого прогона."""
+        for items_path in self._folder_path.glob(f'{self.name}.*.items'):
+            items_path.unlink(missing_ok=True)
+
+    def start(self) -> bool:
+        """
+        Метод начинает новый прогон или продолжает прерванный.
+
+        Возвращает True, если прогон продолжен после сбоя.
+        """
+        with self._lock:
+            state = self._load_state()
+            resumes = state.get('resumes', 0)
+            if state.get('status') == 'running':
+                if resumes < self.max_resumes:
+                    state['resumes'] = resumes + 1
+                    self._state = state
+                    self._write_state()
+                    logging.warning(
+                        'Продолжаем прерванный прогон %s, завершенные '
+                        'этапы: %s',
+                        self.run_id,
+                        ', '.join(state.get('stages', {})) or 'нет'
+                    )
+                    return True
+                logging.warning(
+                    'Прогон %s прерывался %s раз, начинаем новый',
+                    state.get('run_id'),
+                    resumes + 1
+                )
+            self._reset_items()
+            now = dt.now()
+            self._state = {
+                'run_id': now.strftime('%Y%m%d%H%M%S'),
+                'status': 'running',
+                'started': (
+                    f'{now.strftime(DATE_FORMAT)} '
+                    f'{now.strftime(TIME_FORMAT)}'
+                ),
+                'stages': {},
+            }
+            self._write_state()
+            logging.info('Начат прогон %s', self.run_id)
+            return False
+
+    def is_stage_done(self, stage: str) -> bool:
+        """Метод проверяет, завершен ли этап в текущем прогоне."""
+        return stage in self._state.get('stages', {})
+
+    def mark_stage_done(self, stage: str) -> None:
+        """Метод отмечает этап завершенным."""
+        with self._lock:
+            self._state.setdefault('stages', {})[stage] = (
+                dt.now().strftime(TIME_FORMAT)
+            )
+            self._write_state()
+            self._close_items(stage)
+        logging.info('Этап %s отмечен завершенным', stage)
+
+    def done_items(self, stage: str) -> set[str]:
+        """
+        Метод возвращает множество обработанных элементов этапа.
+
+        Последняя строка без перевода строки считается недописанной
+        (сбой во время записи) и игнорируется.
+        """
+        with self._lock:
+            if stage in self._done_items:
+                return self._done_items[stage]
+            items: set[str] = set()
+            items_path = self._items_path(stage)
+            if items_path.exists():
+                with open(items_path, encoding='utf-8') as f:
+                    for line in f:
+                        if line.endswith('\n') and line.strip():
+                            items.add(line.strip())
+            self._done_items[stage] = items
+            return items
+
+    def is_item_done(self, stage: str, item: str) -> bool:
+        """Метод проверяет, обработан ли элемент этапа."""
+        return item in self.done_items(stage)
+
+    def mark_item_done(self, stage: str, item: str) -> None:
+        """Метод дописывает элемент в журнал этапа и сбрасывает его на диск."""
+        done = self.done_items(stage)
+        with self._lock:
+            if item in done:
+                return
+            items_file = self._item_files.get(stage)
+            if items_file is None:
+                items_file = open(
+                    self._items_path(stage), 'a', encoding='utf-8'
+                )
+                self._item_files[stage] = items_file
+            items_file.write(f'{item}\n')
+            items_file.flush()
+            os.fsync(items_file.fileno())
+            done.add(item)
+
+    def _close_items(self, stage: str | None = None) -> None:
+        """Защищенный метод, закрывает открытые журналы элементов."""
+        stages = [stage] if stage else list(self._item_files)
+        for name in stages:
+            items_file = self._item_files.pop(name, None)
+            if items_file is not None:
+                items_file.close()
+
+    def fail(self, error: BaseException) -> None:
+        """
+        Метод отмечает прогон завершенным с ошибкой, следующий start()
+        начнет новый.
+        """
+        with self._lock:
+            self._close_items()
+            self._state['status'] = 'failed'
+            self._state['error'] = f'{type(error).__name__}: {error}'
+            self._state['finished'] = dt.now().strftime(TIME_FORMAT)
+            self._write_state()
+        logging.warning('Прогон %s завершен с ошибкой', self.run_id)
+
+    def finish(self) -> None:
+        """Метод завершает прогон, следующий start() начнет новый."""
+        with self._lock:
+            self._close_items()
+            self._state['status'] = 'finished'
+            self._state['finished'] = dt.now().strftime(TIME_FORMAT)
+            self._write_state()
+        logging.info('Прогон %s завершен', self.run_id)
@@ -1,12 +1,34 @@
+import atexit
 import logging
 import os
+import queue
+import time
 from datetime import datetime as dt
-from logging.handlers import RotatingFileHandler
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
 
 INFO_BOT = 25
 
 logging.addLevelName(INFO_BOT, 'INFO_BOT')
 
+LOG_QUEUE = os.getenv('LOG_QUEUE', '1') == '1'
+"""Писать логи через очередь в фоновом потоке."""
+
+LOG_AGGREGATE_AFTER = int(os.getenv('LOG_AGGREGATE_AFTER', '5'))
+"""Сколько одинаковых сообщений пропускать до начала агрегации."""
+
+LOG_AGGREGATE_INTERVAL = float(os.getenv('LOG_AGGREGATE_INTERVAL', '60'))
+"""Период выдачи сводок по повторяющимся сообщениям, в секундах."""
+
+LOG_FORMAT = (
+    '%(asctime)s, '
+    '%(filename)s, '
+    '%(funcName)s, '
+    '%(levelname)s, '
+    '%(message)s, '
+    '%(name)s'
+)
+"""Формат записей лога."""
+
 
 class CustomLogger(logging.Logger):
     def bot_event(self, message, *args, **kws):
@@ -17,7 +39,107 @@ class CustomLogger(logging.Logger):
 logging.setLoggerClass(CustomLogger)
 
 
-def setup_logging():
+class DeferredQueueHandler(QueueHandler):
+    """
+    QueueHandler, который не форматирует запись в вызывающем потоке.
+
+    Стандартный prepare() подставляет аргументы и форматирует запись
+    до постановки в очередь. Очередь у нас внутри процесса, поэтому
+    запись передается как есть: форматирование и запись на диск
+    выполняет поток QueueListener. В вызывающем потоке заранее
+    рендерится только traceback, если он есть.
+    """
+
+    def prepare(self, record):
+        if record.exc_info and not record.exc_text:
+            record.exc_text = logging.Formatter().formatException(
+                record.exc_info
+            )
+            record.exc_info = None
+        return record
+
+
+class AggregatingHandler(logging.Handler):
+    """
+    Обертка над обработчиком, сворачивающая повторяющиеся сообщения.
+
+    Сообщения группируются по логгеру, уровню и шаблону (msg до
+    подстановки аргументов). Первые `after` сообщений группы за период
+    пишутся как есть, остальные только считаются; раз в `interval`
+    секунд (и при закрытии) по каждой группе пишется одна сводка вида
+    "повторилось N раз" с последним примером.
+    """
+
+    def __init__(
+        self,
+        target: logging.Handler,
+        after: int = LOG_AGGREGATE_AFTER,
+        interval: float = LOG_AGGREGATE_INTERVAL
+    ) -> None:
+        super().__init__(target.level)
+        self.target = target
+        self.after = after
+        self.interval = interval
+        self._seen: dict[tuple, int] = {}
+        self._suppressed: dict[tuple, list] = {}
+        self._window_start = time.monotonic()
+
+    def emit(self, record: logging.LogRecord) -> None:
+        if self.after <= 0 or record.levelno >= logging.CRITICAL:
+            self.target.handle(record)
+            return
+        now = time.monotonic()
+        if now - self._window_start >= self.interval:
+            self._flush_summaries()
+            self._window_start = now
+        key = (record.name, record.levelno, str(record.msg))
+        count = self._seen.get(key, 0) + 1
+        self._seen[key] = count
+        if count <= self.after:
+            self.target.handle(record)
+            return
+        suppressed = self._suppressed.setdefault(key, [0, record])
+        suppressed[0] += 1
+        suppressed[1] = record
+
+    def _flush_summaries(self) -> None:
+        """Защищенный метод, пишет сводки по подавленным сообщениям."""
+        for (name, _, template), (count, record) in self._suppressed.items():
+            summary = logging.makeLogRecord(record.__dict__)
+            summary.msg = (
+                'Сообщение "%s" повторилось еще %s раз, последнее: %s'
+            )
+            summary.args = (template, count, record.getMessage())
+            summary.exc_info = None
+            summary.exc_text = None
+            self.target.handle(summary)
+        self._seen.clear()
+        self._suppressed.clear()
+
+    def flush(self) -> None:
+        self.target.flush()
+
+    def close(self) -> None:
+        self.acquire()
+        try:
+            self._flush_summaries()
+        finally:
+            self.release()
+        self.target.close()
+        super().close()
+
+
+def get_log_dir() -> str:
+    """Функция, возвращает (и создает) директорию логов текущего дня."""
+    date_dir = dt.now().strftime('%Y-%m-%d')
+    log_dir = os.path.abspath(
+        os.path.join(os.path.dirname(__file__), '..', 'logs', date_dir)
+    )
+    os.makedirs(log_dir, exist_ok=True)
+    return log_dir
+
+
+def setup_logging(use_queue: bool = LOG_QUEUE):
     """
     Настройка логирования приложения.
 
@@ -29,15 +151,21 @@ def setup_logging():
     - Кастомный уровень логирования INFO_BOT (помечать им сообщения,
     которые хотим видеть в деталях сообщений по отработке скриптов)
     - Уровень логирования: INFO.
+    - Сворачивание повторяющихся сообщений в периодические сводки
+    (LOG_AGGREGATE_AFTER, LOG_AGGREGATE_INTERVAL).
+    - При use_queue (LOG_QUEUE=1, по умолчанию) рабочие потоки только
+    кладут записи в очередь, а форматирование и запись в файл делает
+    фоновый поток QueueListener. Очередь сбрасывается при выходе.
 
     Логи сохраняются в папку 'logs' с именем файла в формате ГГГГ-ММ-ДД.log.
     Автоматически создает папку логов, если она не существует.
+
+    Вызывается точками входа (main, daemon, cli), а не при импорте
+    модулей. Повторный вызов ничего не делает.
     """
-    date_dir = dt.now().strftime('%Y-%m-%d')
-    log_dir = os.path.abspath(
-        os.path.join(os.path.dirname(__file__), '..', 'logs', date_dir)
-    )
-    os.makedirs(log_dir, exist_ok=True)
+    if logging.getLogger().handlers:
+        return
+    log_dir = get_log_dir()
     log_id = dt.now().strftime('%Y%m%d%H%M')
     log_filename = f'{log_id}.log'
     log_filepath = os.path.join(log_dir, log_filename)
@@ -50,16 +178,30 @@ def setup_logging():
     )
 
     handler.setLevel(logging.INFO)
+    handler.setFormatter(logging.Formatter(LOG_FORMAT))
+    aggregating_handler = AggregatingHandler(handler)
 
+    if not use_queue:
+        logging.basicConfig(
+            level=logging.INFO,
+            handlers=[aggregating_handler]
+        )
+        return
+
+    log_queue = queue.SimpleQueue()
+    listener = QueueListener(
+        log_queue,
+        aggregating_handler,
+        respect_handler_level=True
+    )
+    listener.start()
     logging.basicConfig(
         level=logging.INFO,
-        format=(
-            '%(asctime)s, '
-            '%(filename)s, '
-            '%(funcName)s, '
-            '%(levelname)s, '
-            '%(message)s, '
-            '%(name)s'
-        ),
-        handlers=[handler]
+        handlers=[DeferredQueueHandler(log_queue)]
     )
+
+    def stop_listener():
+        listener.stop()
+        aggregating_handler.close()
+
+    atexit.register(stop_listener)
@@ -1,47 +1,29 @@
-import logging
-
-from handler.constants import FEEDS_FOLDER, IMAGE_FOLDER  # NEW_FEEDS_FOLDER
 from handler.decorators import time_of_function, time_of_script
-# from handler.feeds_handler import FeedHandler
-from handler.feeds_save import FeedSaver
-from handler.image_handler import FeedImage
 from handler.logging_config import setup_logging
-from handler.utils import get_filenames_list
+from handler.scheduler import FeedScheduler
+
 
-setup_logging()
+def run_pipeline(scheduler: FeedScheduler | None = None) -> FeedScheduler:
+    """
+    Функция, выполняющая все этапы обработки фидов.
+
+    Фиды и их преобразования описаны в FEEDS_CONFIG (см.
+    handler.feed_config), конвейеры фидов идут параллельно в общем
+    бюджете ресурсов. Принимает готовый FeedScheduler, чтобы
+    долгоживущий процесс переиспользовал его состояние между циклами.
+    Возвращает использованный планировщик.
+    """
+    scheduler = scheduler or FeedScheduler.from_config()
+    scheduler.run()
+    return scheduler
 
 
 @time_of_script
 @time_of_function
 def main():
-    saver = FeedSaver()
-    saver.save_xml()
-    filenames = get_filenames_list(FEEDS_FOLDER)
-
-    if not filenames:
-        logging.error('Директория %s пуста', FEEDS_FOLDER)
-        raise FileNotFoundError(
-            f'Директория {FEEDS_FOLDER} не содержит файлов'
-        )
-    image_client = FeedImage(filenames, images=[])
-    image_client.get_images()
-    # image_client.get_images_with_bg()
-    images = get_filenames_list(IMAGE_FOLDER)
-
-    if not images:
-        logging.error('Директория %s пуста', IMAGE_FOLDER)
-        raise FileNotFoundError(
-            f'Директория {IMAGE_FOLDER} не содержит файлов'
-        )
-
-    image_client.images = images
-    # image_client.add_background()
-    # image_client.add_ai_bg()
-
-    # for filename in filenames:
-    #     handler_client = FeedHandler(filename)
-    #     handler_client.replace_images().save()
+    run_pipeline()
 
 
 if __name__ == '__main__':
+    setup_logging()
     main()
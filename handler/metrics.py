@@ -0,0 +1,298 @@
+import functools
+import json
+import logging
+import os
+import threading
+import time
+from pathlib import Path
+
+METRICS_PREFIX = 'yvesrocher_'
+"""Префикс имен метрик в формате Prometheus."""
+
+DEFAULT_BUCKETS = (
+    0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+    1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 300.0, 1800.0
+)
+"""Границы корзин гистограмм задержек, в секундах."""
+
+
+def _labels_key(labels: dict) -> tuple:
+    """Защищенная функция, приводит метки к хешируемому ключу."""
+    return tuple(sorted((key, str(value)) for key, value in labels.items()))
+
+
+def _format_labels(labels: tuple, extra: tuple = ()) -> str:
+    """Защищенная функция, форматирует метки для Prometheus."""
+    pairs = labels + extra
+    if not pairs:
+        return ''
+    body = ','.join(
+        '{}="{}"'.format(
+            key,
+            value.replace('\\', '\\\\').replace('"', '\\"')
+        )
+        for key, value in pairs
+    )
+    return f'{{{body}}}'
+
+
+class Counter:
+    """Монотонно растущий счетчик."""
+
+    kind = 'counter'
+
+    def __init__(self) -> None:
+        self.value = 0
+        self._lock = threading.Lock()
+
+    def clear(self) -> None:
+        self.value = 0
+
+    def inc(self, amount: float = 1) -> None:
+        with self._lock:
+            self.value += amount
+
+    def summary(self) -> float:
+        return self.value
+
+
+class Gauge:
+    """Значение, которое может как расти, так и уменьшаться."""
+
+    kind = 'gauge'
+
+    def __init__(self) -> None:
+        self.value = 0
+
+    def clear(self) -> None:
+        self.value = 0
+
+    def set(self, value: float) -> None:
+        self.value = value
+
+    def summary(self) -> float:
+        return self.value
+
+
+class Histogram:
+    """
+    Гистограмма задержек с фиксированными корзинами.
+
+    Хранит только счетчики корзин, сумму, минимум и максимум, поэтому
+    размер не зависит от количества наблюдений. Перцентили в сводке
+    оцениваются по верхним границам корзин.
+    """
+
+    kind = 'histogram'
+
+    def __init__(self, buckets: tuple = DEFAULT_BUCKETS) -> None:
+        self.buckets = tuple(sorted(buckets))
+        self._lock = threading.Lock()
+        self.clear()
+
+    def clear(self) -> None:
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.min: float | None = None
+        self.max: float | None = None
+
+    def observe(self, value: float) -> None:
+        with self._lock:
+            index = len(self.buckets)
+            for position, bound in enumerate(self.buckets):
+                if value <= bound:
+                    index = position
+                    break
+            self.counts[index] += 1
+            self.count += 1
+            self.sum += value
+            self.min = value if self.min is None else min(self.min, value)
+            self.max = value if self.max is None else max(self.max, value)
+
+    def quantile(self, q: float) -> float | None:
+        """Метод оценивает перцентиль по корзинам."""
+        if not self.count:
+            return None
+        target = q * self.count
+        cumulative = 0
+        for position, bucket_count in enumerate(self.counts):
+            cumulative += bucket_count
+            if cumulative >= target:
+                if position < len(self.buckets):
+                    return min(self.buckets[position], self.max)
+                return self.max
+        return self.max
+
+    def summary(self) -> dict:
+        return {
+            'count': self.count,
+            'sum': round(self.sum, 6),
+            'avg': round(self.sum / self.count, 6) if self.count else None,
+            'min': self.min,
+            'max': self.max,
+            'p50': self.quantile(0.5),
+            'p95': self.quantile(0.95),
+            'p99': self.quantile(0.99),
+        }
+
+
+class MetricsRegistry:
+    """
+    Реестр метрик процесса.
+
+    Метрика идентифицируется именем и набором меток, например
+    registry.histogram('stage_duration_seconds', stage='get_images').
+    В конце прогона реестр выгружается в JSON-сводку и текстовый файл
+    Prometheus для textfile-коллектора node exporter.
+    """
+
+    def __init__(self) -> None:
+        self._metrics: dict[tuple, object] = {}
+        self._help: dict[str, str] = {}
+        self._lock = threading.Lock()
+
+    def _get(self, metric_class, name: str, help_text: str, labels: dict):
+        """Защищенный метод, возвращает метрику, создавая ее при нужде."""
+        key = (name, _labels_key(labels))
+        metric = self._metrics.get(key)
+        if metric is None:
+            with self._lock:
+                metric = self._metrics.get(key)
+                if metric is None:
+                    metric = metric_class()
+                    self._metrics[key] = metric
+                    if help_text:
+                        self._help[name] = help_text
+        return metric
+
+    def counter(self, name: str, help_text: str = '', **labels) -> Counter:
+        return self._get(Counter, name, help_text, labels)
+
+    def gauge(self, name: str, help_text: str = '', **labels) -> Gauge:
+        return self._get(Gauge, name, help_text, labels)
+
+    def histogram(
+        self,
+        name: str,
+        help_text: str = '',
+        **labels
+    ) -> Histogram:
+        return self._get(Histogram, name, help_text, labels)
+
+    def timer(self, name: str, **labels) -> 'Timer':
+        """
+        Метод возвращает таймер для гистограммы name.
+
+        Таймер работает и как контекстный менеджер, и как декоратор,
+        время меряется по монотонным часам time.perf_counter.
+        """
+        return Timer(self.histogram(name, **labels))
+
+    def reset(self) -> None:
+        """
+        Метод обнуляет значения всех метрик перед новым замером.
+
+        Сами объекты метрик сохраняются: декораторы держат ссылки
+        на гистограммы, созданные при импорте.
+        """
+        with self._lock:
+            for metric in self._metrics.values():
+                metric.clear()
+
+    def to_dict(self) -> dict:
+        """Метод возвращает сводку всех метрик."""
+        result: dict = {}
+        for (name, labels), metric in sorted(
+            self._metrics.items(), key=lambda item: item[0]
+        ):
+            label_text = ','.join(f'{key}={value}' for key, value in labels)
+            result.setdefault(name, {})[label_text or '_'] = (
+                metric.summary()
+            )
+        return result
+
+    def to_prometheus(self) -> str:
+        """Метод форматирует метрики в текстовом формате Prometheus."""
+        lines = []
+        described = set()
+        for (name, labels), metric in sorted(
+            self._metrics.items(), key=lambda item: item[0]
+        ):
+            full_name = f'{METRICS_PREFIX}{name}'
+            if name not in described:
+                if name in self._help:
+                    lines.append(f'# HELP {full_name} {self._help[name]}')
+                lines.append(f'# TYPE {full_name} {metric.kind}')
+                described.add(name)
+            if metric.kind != 'histogram':
+                lines.append(
+                    f'{full_name}{_format_labels(labels)} {metric.value}'
+                )
+                continue
+            cumulative = 0
+            for bound, bucket_count in zip(
+                metric.buckets + ('+Inf',), metric.counts
+            ):
+                cumulative += bucket_count
+                lines.append(
+                    f'{full_name}_bucket'
+                    f'{_format_labels(labels, (("le", str(bound)),))} '
+                    f'{cumulative}'
+                )
+            lines.append(
+                f'{full_name}_sum{_format_labels(labels)} {metric.sum}'
+            )
+            lines.append(
+                f'{full_name}_count{_format_labels(labels)} {metric.count}'
+            )
+        return '\n'.join(lines) + '\n'
+
+    def export(self, folder: Path, extra: dict | None = None) -> None:
+        """
+        Метод атомарно записывает 'last_run.json' и 'handler.prom'.
+
+        Файл .prom переименовывается целиком, чтобы node exporter
+        никогда не прочитал его наполовину записанным.
+        """
+        folder.mkdir(parents=True, exist_ok=True)
+        summary = {**(extra or {}), 'metrics': self.to_dict()}
+        for filename, content in (
+            ('last_run.json', json.dumps(
+                summary, ensure_ascii=False, indent=2
+            )),
+            ('handler.prom', self.to_prometheus()),
+        ):
+            temp_path = folder / f'.{filename}.tmp'
+            with open(temp_path, 'w', encoding='utf-8') as f:
+                f.write(content)
+            os.replace(temp_path, folder / filename)
+        logging.info('Метрики прогона выгружены в %s', folder)
+
+
+class Timer:
+    """Таймер, записывающий длительность в гистограмму."""
+
+    def __init__(self, histogram: Histogram) -> None:
+        self.histogram = histogram
+        self.elapsed = 0.0
+        self._start = 0.0
+
+    def __enter__(self) -> 'Timer':
+        self._start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.elapsed = time.perf_counter() - self._start
+        self.histogram.observe(self.elapsed)
+
+    def __call__(self, func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with Timer(self.histogram):
+                return func(*args, **kwargs)
+        return wrapper
+
+
+REGISTRY = MetricsRegistry()
+"""Общий реестр метрик процесса."""
@@ -1,12 +1,18 @@
+import fcntl
 import logging
-import xml.etree.ElementTree as ET
+import os
+from contextlib import ExitStack, contextmanager
 from pathlib import Path
 
+from handler import xml_backend
+from handler.compression import COMPRESSION_EXTENSIONS, CompressingWriter
+from handler.constants import OUTPUT_ENCODING
 from handler.exceptions import (DirectoryCreationError, EmptyFeedsListError,
                                 GetTreeError)
-from handler.logging_config import setup_logging
+from handler.xml_writer import write_xml
 
-setup_logging()
+WRITE_BUFFER_SIZE = 1024 * 1024
+"""Размер буфера файла при атомарной записи."""
 
 
 class FileMixin:
@@ -16,19 +22,105 @@ class FileMixin:
     - _get_filenames_list - Получение имен для XML-файлов списком.
     - _make_dir - Создает директорию и возвращает путь до нее.
     - _get_tree - Получает дерево XML-файла.
+    - _atomic_write - Атомарно записывает файл через временный.
     """
 
-    def _save_xml(self, elem, file_folder, filename) -> None:
-        """Защищенный метод, сохраняет отформатированные файлы."""
+    @staticmethod
+    def _temp_path(file_path: Path) -> Path:
+        """
+        Защищенный метод, возвращает путь временного файла.
+
+        Временный файл скрытый (начинается с точки), поэтому
+        не попадает в списки файлов и кэши готовых офферов.
+        """
+        return file_path.with_name(f'.{file_path.name}.tmp')
+
+    @staticmethod
+    def _download_path(file_path: Path) -> Path:
+        """
+        Защищенный метод, возвращает путь скачиваемого файла.
+
+        Имя отличается от _temp_path, потому что скачанный файл живет,
+        пока из него пишется итоговый через _atomic_open.
+        """
+        return file_path.with_name(f'.{file_path.name}.download')
+
+    @contextmanager
+    def _atomic_open(self, file_path: Path):
+        """
+        Защищенный метод, открывает файл для атомарной записи.
+
+        Данные пишутся во временный файл рядом с целевым и переименовываются
+        только после fsync, поэтому недописанный файл никогда не окажется
+        под финальным именем.
+        """
+        temp_path = self._temp_path(file_path)
+        try:
+            with open(temp_path, 'wb', buffering=WRITE_BUFFER_SIZE) as f:
+                yield f
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(temp_path, file_path)
+        except BaseException:
+            temp_path.unlink(missing_ok=True)
+            raise
+
+    @staticmethod
+    @contextmanager
+    def _file_lock(file_path: Path):
+        """
+        Защищенный метод, берет межпроцессную блокировку файла.
+
+        Блокировка (flock) держится на скрытом файле .{имя}.lock рядом
+        с file_path, поэтому ее видят все процессы и контейнеры,
+        смонтировавшие ту же директорию.
+        """
+        lock_path = file_path.with_name(f'.{file_path.name}.lock')
+        with open(lock_path, 'a') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def _atomic_write(self, file_path: Path, data: bytes) -> None:
+        """Защищенный метод, атомарно записывает данные в файл."""
+        with self._atomic_open(file_path) as f:
+            f.write(data)
+
+    def _save_xml(
+        self,
+        elem,
+        file_folder,
+        filename,
+        encoding: str = OUTPUT_ENCODING,
+        compression: tuple[str, ...] = (),
+        xml_declaration: bool | None = None
+    ) -> dict:
+        """
+        Защищенный метод, сохраняет отформатированные файлы.
+
+        Документ пишется в файл потоково, блоками, без сборки всего
+        результата в памяти (см. xml_writer). Для форматов compression
+        рядом атомарно пишутся сжатые копии (см. compression).
+        Возвращает размеры сжатых копий по форматам.
+        """
         root = elem
         self._indent(root)
-        formatted_xml = ET.tostring(root, encoding='windows-1251')
-        file_path = self._make_dir(file_folder)
-        with open(
-            file_path / filename,
-            'wb'
-        ) as f:
-            f.write(formatted_xml)
+        file_path = self._make_dir(file_folder) / filename
+        with ExitStack() as stack:
+            f = stack.enter_context(self._atomic_open(file_path))
+            siblings = {
+                name: stack.enter_context(self._atomic_open(
+                    file_path.with_name(
+                        f'{filename}.{COMPRESSION_EXTENSIONS[name]}'
+                    )
+                ))
+                for name in compression
+            }
+            writer = CompressingWriter(f, siblings)
+            write_xml(root, writer, encoding, xml_declaration)
+            return writer.finish(filename)
 
     def _indent(self, elem, level=0) -> None:
         """Защищенный метод, расставляет правильные отступы в XML файлах."""
@@ -53,7 +145,8 @@ class FileMixin:
             logging.error(f'Папка {folder_name} не существует')
             raise DirectoryCreationError(f'Папка {folder_name} не найдена')
         files_names = [
-            file.name for file in folder_path.iterdir() if file.is_file()
+            file.name for file in folder_path.iterdir()
+            if file.is_file() and not file.name.startswith('.')
         ]
         if not files_names:
             logging.error('В папке нет файлов')
@@ -72,7 +165,8 @@ class FileMixin:
             raise DirectoryCreationError(f'Папка {folder_name} не найдена')
         files_dict = {
             file.name.split('.')[0]: file.name for file
-            in folder_path.iterdir() if file.is_file()
+            in folder_path.iterdir()
+            if file.is_file() and not file.name.startswith('.')
         }
         if not files_dict:
             logging.error('В папке нет файлов')
@@ -116,15 +210,14 @@ class FileMixin:
             logging.error('Не удалось создать директорию по причине %s', error)
             raise DirectoryCreationError('Ошибка создания директории.')
 
-    def _get_root(self, file_name: str, folder_name: str) -> ET.Element:
+    def _get_root(self, file_name: str, folder_name: str):
         """Защищенный метод, создает экземпляр класса Element."""
         try:
             file_path = (
                 Path(__file__).parent.parent / folder_name / file_name
             )
             logging.debug(f'Путь к файлу: {file_path}')
-            tree = ET.parse(file_path)
-            return tree.getroot()
+            return xml_backend.parse(file_path)
         except Exception as error:
             logging.error(
                 'Не удалось получить дерево фида по причине %s',
@@ -0,0 +1,443 @@
+"""
+Колоночный индекс офферов фида.
+
+Индекс строится одним потоковым проходом по байтам файла (mmap и
+поиск подстрок, без построения дерева) и хранит на каждый
+оффер: id, categoryId, номер первой картинки в списке уникальных URL
+и байтовые границы элемента <offer> в исходном файле. Индекс
+кэшируется рядом с фидом в скрытом файле .<фид>.index.npz и
+пересобирается, если фид изменился.
+
+По байтовым границам один оффер читается без разбора всего фида:
+find находит строку по id, offer_text отображает файл через mmap и
+декодирует только срез элемента, read_offer разбирает этот срез.
+"""
+import html
+import logging
+import mmap
+import os
+import re
+from collections.abc import Iterator
+from pathlib import Path
+
+import numpy as np
+
+from handler import xml_backend
+
+MISSING = -1
+"""Значение колонки для отсутствующего или нецелого id/categoryId."""
+
+ID_PATTERN = re.compile(rb'\sid\s*=\s*["\']([^"\']*)["\']')
+CDATA_PATTERN = re.compile(rb'<!\[CDATA\[(.*?)\]\]>', re.DOTALL)
+ENCODING_PATTERN = re.compile(rb'<\?xml[^>]*encoding=["\']([\w.-]+)["\']')
+
+OFFER_TAG_ENDS = frozenset(
+    (b' ', b'>', b'/', b'\t', b'\n', b'\r')
+)
+"""Символы, которыми может продолжаться имя тега <offer."""
+
+INDEX_VERSION = 2
+"""Версия формата кэша; при изменении формата кэш пересобирается."""
+
+
+def _unwrap_cdata(match: re.Match) -> bytes:
+    """Защищенная функция, экранирует & в содержимом секции CDATA."""
+    return match.group(1).replace(b'&', b'&amp;')
+
+
+def _tag_text(offer: bytes, tag: bytes) -> bytes | None:
+    """
+    Защищенная функция, возвращает текст первого тега tag в оффере.
+
+    Секции <![CDATA[...]]> разворачиваются, их & экранируется, поэтому
+    текст всегда в экранированном виде XML (см. html.unescape в build).
+    """
+    start = offer.find(b'<' + tag + b'>')
+    if start < 0:
+        return None
+    start += len(tag) + 2
+    end = offer.find(b'<', start)
+    if offer.startswith(b'<![CDATA[', end):
+        end = offer.find(b'</' + tag + b'>', start)
+        return CDATA_PATTERN.sub(_unwrap_cdata, offer[start:end]).strip()
+    return offer[start:end].strip()
+
+
+def _offer_spans(data) -> Iterator[tuple[int, int]]:
+    """
+    Защищенная функция, отдает байтовые границы элементов <offer>.
+
+    Поиск идет через bytes.find по mmap без регулярных выражений;
+    <offers> и прочие теги с тем же префиксом пропускаются.
+    """
+    position = 0
+    while True:
+        start = data.find(b'<offer', position)
+        if start < 0:
+            return
+        position = start + 6
+        if data[position:position + 1] not in OFFER_TAG_ENDS:
+            continue
+        head_end = data.find(b'>', position)
+        if head_end < 0:
+            return
+        if data[head_end - 1:head_end] == b'/':
+            position = head_end + 1
+        else:
+            end = data.find(b'</offer>', head_end)
+            if end < 0:
+                return
+            position = end + 8
+        yield start, position
+
+
+def _feed_encoding(data) -> str:
+    """Защищенная функция, возвращает кодировку из XML-декларации."""
+    declaration = ENCODING_PATTERN.match(data[:200])
+    return declaration.group(1).decode() if declaration else 'utf-8'
+
+
+def _to_int(value: bytes | str | None) -> int:
+    """Защищенная функция, приводит id к числу или MISSING."""
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return MISSING
+
+
+class OfferIndex:
+    """
+    Класс колоночного индекса офферов.
+
+    Колонки - массивы NumPy одинаковой длины в порядке следования
+    офферов в файле: ids, category_ids, picture_ids (номер в pictures
+    или MISSING), starts и ends (байтовые смещения элемента). Фильтры,
+    разбиение по четности и статистика считаются векторно.
+    """
+
+    def __init__(
+        self,
+        ids: np.ndarray,
+        category_ids: np.ndarray,
+        picture_ids: np.ndarray,
+        pictures: list[str],
+        starts: np.ndarray,
+        ends: np.ndarray,
+        source: tuple[int, int] = (0, 0)
+    ) -> None:
+        self.ids = ids
+        self.category_ids = category_ids
+        self.picture_ids = picture_ids
+        self.pictures = pictures
+        self.starts = starts
+        self.ends = ends
+        self.source = source
+
+    def __len__(self) -> int:
+        return len(self.ids)
+
+    @staticmethod
+    def cache_path(feed_path: Path) -> Path:
+        """Метод возвращает путь кэша индекса для фида."""
+        return feed_path.with_name(f'.{feed_path.name}.index.npz')
+
+    @staticmethod
+    def _source_key(feed_path: Path) -> tuple[int, int]:
+        """Защищенный метод, возвращает (размер, mtime) фида."""
+        stat = feed_path.stat()
+        return stat.st_size, stat.st_mtime_ns
+
+    @classmethod
+    def build(cls, feed_path: Path, validator=None) -> 'OfferIndex':
+        """
+        Метод строит индекс одним проходом по байтам фида.
+
+        validator (handler.feed_quality.FeedValidator) получает в том
+        же проходе сырые поля каждого оффера.
+        """
+        ids, category_ids, picture_ids = [], [], []
+        starts, ends = [], []
+        pictures: dict[str, int] = {}
+        source = cls._source_key(feed_path)
+        if not source[0]:
+            return cls.from_columns([], [], [], [], [], [], source)
+        with open(feed_path, 'rb') as f, mmap.mmap(
+            f.fileno(), 0, access=mmap.ACCESS_READ
+        ) as data:
+            encoding = _feed_encoding(data)
+            for start, end in _offer_spans(data):
+                offer = data[start:end]
+                offer_id = ID_PATTERN.search(offer, 0, offer.find(b'>') + 1)
+                offer_id = offer_id and offer_id.group(1)
+                category_id = _tag_text(offer, b'categoryId')
+                picture = _tag_text(offer, b'picture')
+                if validator is not None:
+                    validator.check(len(ids), offer_id, category_id, picture)
+                ids.append(_to_int(offer_id))
+                category_ids.append(_to_int(category_id))
+                if picture:
+                    url = html.unescape(picture.decode(encoding))
+                    picture_ids.append(pictures.setdefault(url, len(pictures)))
+                else:
+                    picture_ids.append(MISSING)
+                starts.append(start)
+                ends.append(end)
+        return cls.from_columns(
+            ids, category_ids, picture_ids, list(pictures), starts, ends,
+            source
+        )
+
+    @classmethod
+    def from_columns(
+        cls,
+        ids,
+        category_ids,
+        picture_ids,
+        pictures,
+        starts,
+        ends,
+        source=(0, 0)
+    ) -> 'OfferIndex':
+        """Метод собирает индекс из списков значений колонок."""
+        return cls(
+            np.asarray(ids, dtype=np.int64),
+            np.asarray(category_ids, dtype=np.int64),
+            np.asarray(picture_ids, dtype=np.int32),
+            pictures,
+            np.asarray(starts, dtype=np.int64),
+            np.asarray(ends, dtype=np.int64),
+            source
+        )
+
+    @classmethod
+    def from_elements(cls, offers: list) -> 'OfferIndex':
+        """
+        Метод строит колонки по уже разобранным элементам <offer>.
+
+        Используется, когда дерево разошлось с файлом индекса;
+        байтовых смещений у таких колонок нет.
+        """
+        pictures: dict[str, int] = {}
+        picture_ids = []
+        for offer in offers:
+            url = offer.findtext('picture')
+            picture_ids.append(
+                pictures.setdefault(url, len(pictures)) if url else MISSING
+            )
+        empty = [MISSING] * len(offers)
+        return cls.from_columns(
+            [_to_int(offer.get('id')) for offer in offers],
+            [_to_int(offer.findtext('categoryId')) for offer in offers],
+            picture_ids,
+            list(pictures),
+            empty,
+            empty
+        )
+
+    def save(self, cache_path: Path) -> None:
+        """Метод атомарно сохраняет индекс в npz."""
+        temp_path = cache_path.with_name(f'{cache_path.name}.tmp')
+        with open(temp_path, 'wb') as f:
+            np.savez(
+                f,
+                version=np.int64(INDEX_VERSION),
+                source=np.asarray(self.source, dtype=np.int64),
+                ids=self.ids,
+                category_ids=self.category_ids,
+                picture_ids=self.picture_ids,
+                pictures=np.asarray(self.pictures, dtype=np.str_),
+                starts=self.starts,
+                ends=self.ends
+            )
+        os.replace(temp_path, cache_path)
+
+    @classmethod
+    def load(cls, cache_path: Path) -> 'OfferIndex':
+        """Метод читает индекс из npz."""
+        with np.load(cache_path, allow_pickle=False) as data:
+            if int(data['version']) != INDEX_VERSION:
+                raise ValueError('Устаревшая версия индекса')
+            return cls(
+                data['ids'],
+                data['category_ids'],
+                data['picture_ids'],
+                data['pictures'].tolist(),
+                data['starts'],
+                data['ends'],
+                tuple(int(value) for value in data['source'])
+            )
+
+    @classmethod
+    def for_feed(cls, feed_path: Path, validator=None) -> 'OfferIndex':
+        """
+        Метод возвращает индекс фида из кэша или строит и кэширует его.
+
+        Кэш считается актуальным, если совпадают размер и mtime фида.
+        С validator кэш не читается: индекс строится заново, и офферы
+        проверяются в том же проходе (см. build).
+        """
+        cache_path = cls.cache_path(feed_path)
+        source = cls._source_key(feed_path)
+        if validator is None and cache_path.exists():
+            try:
+                index = cls.load(cache_path)
+                if index.source == source:
+                    return index
+            except Exception as error:
+                logging.warning(
+                    'Кэш индекса %s не прочитан: %s',
+                    cache_path.name,
+                    error
+                )
+        index = cls.build(feed_path, validator)
+        try:
+            index.save(cache_path)
+        except OSError as error:
+            logging.warning(
+                'Не удалось сохранить индекс %s: %s',
+                cache_path.name,
+                error
+            )
+        logging.info(
+            'Построен индекс %s: %s офферов',
+            feed_path.name,
+            len(index)
+        )
+        return index
+
+    def find(self, offer_id: int | str) -> int:
+        """
+        Метод возвращает строку индекса оффера или MISSING.
+
+        Офферы с нецелым id в индексе не различаются и не находятся.
+        При повторяющихся id возвращается первый оффер.
+        """
+        offer_id = _to_int(offer_id)
+        if offer_id == MISSING:
+            return MISSING
+        rows = np.flatnonzero(self.ids == offer_id)
+        return int(rows[0]) if rows.size else MISSING
+
+    def offer_text(self, feed_path: Path, offer_id: int | str) -> str | None:
+        """
+        Метод возвращает исходный текст элемента <offer> из фида.
+
+        Читается только байтовый срез оффера через mmap. Индекс должен
+        быть построен по текущей версии файла (см. for_feed); у
+        колонок, собранных по элементам, смещений нет, и возвращается
+        None, как и для отсутствующего оффера.
+        """
+        row = self.find(offer_id)
+        if row == MISSING or self.starts[row] == MISSING:
+            return None
+        with open(feed_path, 'rb') as f, mmap.mmap(
+            f.fileno(), 0, access=mmap.ACCESS_READ
+        ) as data:
+            encoding = _feed_encoding(data)
+            offer = data[int(self.starts[row]):int(self.ends[row])]
+        return offer.decode(encoding)
+
+    def iter_offer_bytes(self, feed_path: Path) -> Iterator[bytes]:
+        """
+        Метод отдает исходные байты элементов <offer> по порядку.
+
+        Файл отображается через mmap один раз, XML не разбирается.
+        """
+        if not len(self):
+            return
+        with open(feed_path, 'rb') as f, mmap.mmap(
+            f.fileno(), 0, access=mmap.ACCESS_READ
+        ) as data:
+            for start, end in zip(self.starts.tolist(), self.ends.tolist()):
+                yield data[start:end]
+
+    def invalid(self) -> np.ndarray:
+        """
+        Метод возвращает маску офферов с ошибками структуры, которые
+        этапы обработки пропускают: без целого id или categoryId и
+        повторы id (первый оффер с id остается). Совпадает с ошибками
+        handler.feed_quality.FeedValidator.
+        """
+        invalid = (self.ids == MISSING) | (self.category_ids == MISSING)
+        _, first_rows = np.unique(self.ids, return_index=True)
+        duplicate = np.ones(len(self), dtype=bool)
+        duplicate[first_rows] = False
+        return invalid | duplicate
+
+    def offer_pictures(self) -> Iterator[tuple[str, str]]:
+        """
+        Метод отдает пары (offer_id, url первой картинки) по офферам
+        без ошибок структуры (см. invalid) с картинкой, в порядке
+        следования в фиде.
+        """
+        for offer_id, picture_id, is_invalid in zip(
+            self.ids.tolist(),
+            self.picture_ids.tolist(),
+            self.invalid().tolist()
+        ):
+            if not is_invalid and picture_id != MISSING:
+                yield str(offer_id), self.pictures[picture_id]
+
+    def picture(self, offer_id: int | str) -> str | None:
+        """Метод возвращает url первой картинки оффера по индексу."""
+        row = self.find(offer_id)
+        if row == MISSING or self.picture_ids[row] == MISSING:
+            return None
+        return self.pictures[int(self.picture_ids[row])]
+
+    def parity(self) -> np.ndarray:
+        """
+        Метод возвращает четность id (1 - нечетный).
+
+        Офферу без id достается четность ближайшего предыдущего оффера
+        с id, как в поэлементной обработке add_custom_label.
+        """
+        has_id = self.ids != MISSING
+        rows = np.where(has_id, np.arange(len(self.ids)), 0)
+        np.maximum.accumulate(rows, out=rows)
+        return self.ids[rows] % 2
+
+    def stats(self) -> dict:
+        """Метод считает сводную статистику фида."""
+        has_id = self.ids != MISSING
+        unique_ids, id_counts = np.unique(
+            self.ids[has_id], return_counts=True
+        )
+        categories, category_counts = np.unique(
+            self.category_ids, return_counts=True
+        )
+        parity = self.ids[has_id] % 2
+        has_picture = self.picture_ids != MISSING
+        top = np.argsort(category_counts)[::-1][:10]
+        return {
+            'offers': len(self),
+            'without_id': int((~has_id).sum()),
+            'duplicate_ids': int((id_counts > 1).sum()),
+            'unique_ids': len(unique_ids),
+            'odd_ids': int(parity.sum()),
+            'even_ids': int(len(parity) - parity.sum()),
+            'category_zero': int((self.category_ids == 0).sum()),
+            'categories': len(categories),
+            'top_categories': {
+                int(categories[row]): int(category_counts[row])
+                for row in top
+            },
+            'with_picture': int(has_picture.sum()),
+            'unique_pictures': len(
+                np.unique(self.picture_ids[has_picture])
+            ),
+        }
+
+
+def read_offer(feed_path: Path, offer_id: int | str):
+    """
+    Функция, возвращает разобранный элемент <offer> по id или None.
+
+    Индекс берется из кэша (или строится), разбирается только срез
+    файла с нужным оффером.
+    """
+    index = OfferIndex.for_feed(feed_path)
+    text = index.offer_text(feed_path, offer_id)
+    if text is None:
+        return None
+    return xml_backend.fromstring(text)
@@ -0,0 +1,200 @@
+"""
+Потоковый конвейер этапов с ограниченными очередями.
+
+Этапы соединены очередями queue.Queue(maxsize): элемент уходит на
+следующий этап, как только готов, а заполненная очередь блокирует
+предыдущий этап (backpressure), поэтому в памяти одновременно живет
+не больше queue_size элементов на стык. У каждого этапа свое число
+рабочих потоков, и общее время стремится ко времени самого медленного
+этапа, а не к сумме всех.
+"""
+import logging
+import queue
+import threading
+from collections.abc import Callable, Iterable
+from contextlib import nullcontext
+
+from handler.constants import PIPELINE_QUEUE_SIZE
+from handler.metrics import REGISTRY
+from handler.profiling import profile_thread
+
+_DONE = object()
+"""Маркер конца потока элементов."""
+
+
+def parse_workers(spec: str) -> dict[str, int]:
+    """
+    Функция, разбирает число потоков этапов из строки
+    вида 'fetch=8,remove_bg=4'.
+    """
+    workers = {}
+    for part in spec.split(','):
+        name, _, count = part.partition('=')
+        if name.strip() and count.strip():
+            workers[name.strip()] = max(1, int(count))
+    return workers
+
+
+class Stage:
+    """
+    Этап конвейера.
+
+    func принимает элемент и возвращает элемент для следующего этапа
+    или None, если элемент дальше не идет. limit - общий семафор
+    бюджета (см. scheduler.ResourceBudget), который занимается на время
+    обработки одного элемента.
+    """
+
+    def __init__(
+        self,
+        name: str,
+        func: Callable,
+        workers: int = 1,
+        limit: threading.Semaphore | None = None
+    ) -> None:
+        self.name = name
+        self.func = func
+        self.workers = max(1, workers)
+        self.limit = limit
+
+    def __repr__(self) -> str:
+        return f'Stage({self.name!r}, workers={self.workers})'
+
+
+class Pipeline:
+    """
+    Класс конвейера из последовательных этапов.
+
+    Ошибка на элементе логируется и считается в метрике
+    pipeline_errors_total, элемент отбрасывается, остальные
+    продолжают обработку.
+    """
+
+    def __init__(
+        self,
+        stages: list[Stage],
+        queue_size: int = PIPELINE_QUEUE_SIZE
+    ) -> None:
+        self.stages = stages
+        self.queue_size = max(1, queue_size)
+
+    def _work(
+        self,
+        stage: Stage,
+        source: queue.Queue,
+        target: queue.Queue,
+        remaining: list,
+        lock: threading.Lock
+    ) -> None:
+        """
+        Защищенный метод, цикл рабочего потока этапа.
+
+        Маркер конца возвращается во входную очередь для соседних
+        потоков; последний завершившийся поток этапа передает его
+        следующему этапу. Под профилированием этапа (PROFILE_STAGES)
+        у потока свой cProfile, см. profiling.profile_thread.
+        """
+        with profile_thread():
+            self._loop(stage, source, target, remaining, lock)
+
+    def _loop(
+        self,
+        stage: Stage,
+        source: queue.Queue,
+        target: queue.Queue,
+        remaining: list,
+        lock: threading.Lock
+    ) -> None:
+        """Защищенный метод, обрабатывает элементы входной очереди."""
+        while True:
+            item = source.get()
+            if item is _DONE:
+                source.put(_DONE)
+                with lock:
+                    remaining[0] -= 1
+                    is_last = not remaining[0]
+                if is_last:
+                    target.put(_DONE)
+                return
+            timer = REGISTRY.timer('pipeline_stage_seconds', stage=stage.name)
+            try:
+                with stage.limit or nullcontext(), timer:
+                    result = stage.func(item)
+            except Exception as error:
+                REGISTRY.counter(
+                    'pipeline_errors_total',
+                    stage=stage.name
+                ).inc()
+                logging.error('Ошибка этапа %s: %s', stage.name, error)
+                continue
+            if result is not None:
+                target.put(result)
+
+    def run(self, items: Iterable) -> int:
+        """
+        Метод прогоняет элементы через все этапы.
+
+        Возвращает число элементов, прошедших последний этап. Ошибка
+        источника элементов пробрасывается после остановки этапов.
+        Все потоки конвейера - демоны: если ожидание результатов
+        прервано (KeyboardInterrupt, SystemExit), источник перестает
+        отдавать элементы, а заблокированные на полной очереди потоки
+        не мешают процессу завершиться.
+        """
+        queues = [
+            queue.Queue(maxsize=self.queue_size)
+            for _ in range(len(self.stages) + 1)
+        ]
+        feed_errors = []
+        stopped = threading.Event()
+
+        def feed() -> None:
+            try:
+                with profile_thread():
+                    for item in items:
+                        if stopped.is_set():
+                            break
+                        queues[0].put(item)
+            except Exception as error:
+                feed_errors.append(error)
+            finally:
+                queues[0].put(_DONE)
+
+        threads = [
+            threading.Thread(target=feed, name='pipeline-feed', daemon=True)
+        ]
+        for index, stage in enumerate(self.stages):
+            remaining = [stage.workers]
+            lock = threading.Lock()
+            for number in range(stage.workers):
+                threads.append(threading.Thread(
+                    target=self._work,
+                    args=(
+                        stage,
+                        queues[index],
+                        queues[index + 1],
+                        remaining,
+                        lock
+                    ),
+                    name=f'pipeline-{stage.name}-{number}',
+                    daemon=True
+                ))
+        for thread in threads:
+            thread.start()
+        completed = 0
+        try:
+            while queues[-1].get() is not _DONE:
+                completed += 1
+        except BaseException:
+            stopped.set()
+            raise
+        for thread in threads:
+            thread.join()
+        if feed_errors:
+            raise feed_errors[0]
+        logging.info(
+            'Конвейер %s завершен: %s элементов',
+            ' -> '.join(repr(stage) for stage in self.stages),
+            completed
+        )
+        return completed
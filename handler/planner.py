@@ -0,0 +1,249 @@
+"""
+Пробный план прогона: сколько работы и вызовов API впереди.
+
+План строится только по локальным данным, без обращений к хостам
+картинок и к PhotoRoom:
+- офферы и ссылки на картинки берутся из индексов скачанных фидов
+(handler.offer_index, mmap без разбора XML);
+- готовые исходники и кадры - по файлам директорий изображений и
+staging;
+- смена картинки - по PICTURES_STATE, который пишет FeedImage;
+- длительность - по средним задержкам прошлого прогона из
+METRICS_FOLDER/last_run.json и числу потоков этапов PIPELINE_WORKERS.
+"""
+import json
+import logging
+from pathlib import Path
+
+from handler.constants import (FEEDS_FOLDER, FRAME_FOLDER, IMAGE_FOLDER,
+                               METRICS_FOLDER, NEW_IMAGE_FOLDER,
+                               PIPELINE_WORKERS, RENDER_PLAN, STAGING_FOLDER)
+from handler.feed_config import FeedConfig
+from handler.image_handler import read_picture_state
+from handler.offer_index import OfferIndex
+from handler.pipeline import parse_workers
+from handler.render import load_render_plan
+
+STAGE_METRICS = {
+    'fetch': 'image_download_seconds',
+    'remove_bg': 'photoroom_seconds',
+    'composite': 'composite_seconds',
+    'encode': 'encode_seconds',
+}
+"""Гистограммы задержек этапов, по которым оценивается длительность."""
+
+
+def _offer_ids(folder_path: Path) -> set[str]:
+    """Защищенная функция, возвращает id офферов по именам файлов."""
+    if not folder_path.exists():
+        return set()
+    return {
+        file.name.split('.')[0] for file in folder_path.iterdir()
+        if file.is_file() and not file.name.startswith('.')
+    }
+
+
+def load_latencies(metrics_path: Path) -> dict[str, float]:
+    """
+    Функция, возвращает среднюю задержку этапов (сек) по сводке
+    прошлого прогона. Этапа без наблюдений в словаре нет.
+    """
+    if not metrics_path.exists():
+        return {}
+    try:
+        with open(metrics_path, encoding='utf-8') as f:
+            metrics = json.load(f).get('metrics', {})
+    except (OSError, ValueError) as error:
+        logging.warning('Сводка %s не прочитана: %s', metrics_path, error)
+        return {}
+    latencies = {}
+    for stage, name in STAGE_METRICS.items():
+        summaries = [
+            summary for summary in metrics.get(name, {}).values()
+            if isinstance(summary, dict) and summary.get('count')
+        ]
+        count = sum(summary['count'] for summary in summaries)
+        if count:
+            latencies[stage] = sum(
+                summary['sum'] for summary in summaries
+            ) / count
+    return latencies
+
+
+class RunPlanner:
+    """
+    Класс, оценивающий предстоящий прогон изображений.
+
+    Оффер относится к одной группе:
+    - new - исходника нет, будет скачан и отправлен в PhotoRoom;
+    - changed - исходник есть, но ссылка на картинку сменилась;
+    - frame_only - исходник актуален, не хватает кадров вариантов;
+    - skipped - вся работа по офферу уже сделана.
+    orphaned - файлы офферов, которых больше нет в фидах, по директориям
+    исходников и вариантов (их удалит gc). Кадры нужны по планам
+    рендеринга всех фидов оффера с профилем frame.
+    """
+
+    def __init__(
+        self,
+        configs: list[FeedConfig],
+        feeds_folder: str = FEEDS_FOLDER,
+        image_folder: str = IMAGE_FOLDER,
+        new_image_folder: str = NEW_IMAGE_FOLDER,
+        frame_folder: str = FRAME_FOLDER,
+        metrics_folder: str = METRICS_FOLDER,
+        pipeline_workers: str = PIPELINE_WORKERS
+    ) -> None:
+        self.configs = configs
+        base_path = Path(__file__).parent.parent
+        self.feeds_path = base_path / feeds_folder
+        self.image_path = base_path / image_folder
+        self.new_image_folder = new_image_folder
+        self.new_image_path = base_path / new_image_folder
+        self.frame_path = base_path / frame_folder
+        self.metrics_path = base_path / metrics_folder / 'last_run.json'
+        self.workers = parse_workers(pipeline_workers)
+        self._plans: dict[str, frozenset[str]] = {}
+
+    def _plan_folders(self, config: FeedConfig) -> frozenset[str]:
+        """
+        Защищенный метод, возвращает директории вариантов плана
+        рендеринга фида: его render_plan или общий RENDER_PLAN, как в
+        FeedScheduler._image_client.
+        """
+        plan_name = config.render_plan or RENDER_PLAN
+        if plan_name not in self._plans:
+            self._plans[plan_name] = frozenset(
+                variant.folder for variant in load_render_plan(
+                    self.frame_path / plan_name
+                )
+            )
+        return self._plans[plan_name]
+
+    def _feed_pictures(self) -> tuple[dict, dict, dict]:
+        """
+        Защищенный метод, собирает по индексам фидов ссылки на
+        картинки, нужные кадры и отсутствующие фиды.
+
+        Возвращает ({offer_id: url}, {offer_id: директории вариантов
+        всех фидов оффера с профилем frame}, {имя фида: число офферов
+        или None, если фид не скачан}).
+        """
+        pictures: dict[str, str] = {}
+        framed: dict[str, frozenset[str]] = {}
+        feeds: dict[str, int | None] = {}
+        for config in self.configs:
+            feed_path = self.feeds_path / config.filename
+            if not feed_path.exists():
+                feeds[config.name] = None
+                continue
+            index = OfferIndex.for_feed(feed_path)
+            feeds[config.name] = len(index)
+            if config.image_profile == 'none':
+                continue
+            folders = frozenset()
+            if config.image_profile == 'frame':
+                folders = self._plan_folders(config)
+            for offer_id, url in index.offer_pictures():
+                pictures.setdefault(offer_id, url)
+                framed[offer_id] = framed.get(offer_id, frozenset()) | folders
+        return pictures, framed, feeds
+
+    def _framed_offers(self) -> dict[str, set[str]]:
+        """
+        Защищенный метод, возвращает готовые кадры по директориям
+        вариантов планов рендеринга всех фидов: опубликованные и
+        ожидающие в staging.
+        """
+        framed = {}
+        for folder in frozenset().union(*self._plans.values()):
+            framed[folder] = _offer_ids(
+                self.new_image_path / folder
+            ) | _offer_ids(
+                self.new_image_path.joinpath(STAGING_FOLDER, folder)
+            )
+        return framed
+
+    def _estimate(self, counts: dict, latencies: dict) -> dict:
+        """
+        Защищенный метод, оценивает длительность прогона.
+
+        sequential - сумма задержек всех элементов; pipeline - время
+        самого медленного этапа конвейера с учетом числа его потоков.
+        Этапы без истории задержек перечисляются в unknown.
+        """
+        stage_seconds = {}
+        unknown = []
+        for stage, items in counts.items():
+            if not items:
+                continue
+            if stage not in latencies:
+                unknown.append(stage)
+                continue
+            stage_seconds[stage] = items * latencies[stage]
+        pipeline = [
+            seconds / self.workers.get(stage, 1)
+            for stage, seconds in stage_seconds.items()
+        ]
+        return {
+            'sequential_seconds': round(sum(stage_seconds.values()), 1),
+            'pipeline_seconds': round(max(pipeline, default=0.0), 1),
+            'latencies': {
+                stage: round(seconds, 4)
+                for stage, seconds in latencies.items()
+            },
+            'unknown': unknown,
+        }
+
+    def plan(self) -> dict:
+        """Метод строит план прогона и возвращает его словарем."""
+        pictures, frame_offers, feeds = self._feed_pictures()
+        sources = _offer_ids(self.image_path)
+        state = read_picture_state(self.image_path)
+        framed = self._framed_offers()
+        groups = {'new': 0, 'changed': 0, 'frame_only': 0, 'skipped': 0}
+        frames = 0
+        for offer_id, url in pictures.items():
+            folders = frame_offers[offer_id]
+            missing_frames = sum(
+                offer_id not in framed[folder] for folder in folders
+            )
+            previous = state.get(offer_id)
+            if offer_id not in sources:
+                group = 'new'
+            elif previous and previous != url:
+                group = 'changed'
+            elif missing_frames:
+                group = 'frame_only'
+            else:
+                group = 'skipped'
+            groups[group] += 1
+            if group in ('new', 'changed'):
+                frames += len(folders)
+            elif group == 'frame_only':
+                frames += missing_frames
+        feed_ids = set(pictures)
+        orphaned = {'sources': len(sources - feed_ids)}
+        for folder, offers in framed.items():
+            orphaned[str(Path(self.new_image_folder) / folder)] = len(
+                offers - feed_ids
+            )
+        downloads = groups['new'] + groups['changed']
+        counts = {
+            'fetch': downloads,
+            'remove_bg': downloads,
+            'composite': frames,
+            'encode': frames,
+        }
+        return {
+            'feeds': feeds,
+            'offers_with_pictures': len(pictures),
+            **groups,
+            'orphaned': orphaned,
+            'downloads': downloads,
+            'photoroom_calls': downloads,
+            'frames': frames,
+            'estimate': self._estimate(counts, load_latencies(
+                self.metrics_path
+            )),
+        }
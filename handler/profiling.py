@@ -0,0 +1,164 @@
+import cProfile
+import fnmatch
+import logging
+import os
+import pstats
+import resource
+import sys
+import threading
+import tracemalloc
+from contextlib import contextmanager
+from datetime import datetime as dt
+
+from handler.constants import PROFILE_MODE, PROFILE_STAGES
+from handler.logging_config import get_log_dir
+
+TOP_ALLOCATIONS = 25
+"""Количество строк в отчете о выделениях памяти."""
+
+STAGE_PEAK_RSS: dict[str, int] = {}
+"""Пиковый RSS процесса (байты) на момент окончания каждого этапа."""
+
+_config = {'stages': (), 'modes': (), 'threads': None}
+_active = threading.Lock()
+_threads_lock = threading.Lock()
+
+
+def _split(value: str) -> tuple[str, ...]:
+    """Защищенная функция, разбирает список через запятую."""
+    return tuple(item.strip() for item in value.split(',') if item.strip())
+
+
+def configure(stages: str | None = None, modes: str | None = None) -> None:
+    """
+    Функция, включает профилирование этапов.
+
+    stages - шаблоны имен через запятую ('get_images', 'FeedHandler.*',
+    'all'), modes - 'cpu', 'mem' или 'cpu,mem'. Без аргументов
+    берутся значения PROFILE_STAGES и PROFILE_MODE.
+    """
+    _config['stages'] = _split(PROFILE_STAGES if stages is None else stages)
+    _config['modes'] = _split(PROFILE_MODE if modes is None else modes)
+
+
+def is_enabled(stage: str) -> bool:
+    """Функция, проверяет, нужно ли профилировать этап."""
+    if 'all' in _config['stages']:
+        return True
+    short_name = stage.rsplit('.', 1)[-1]
+    return any(
+        fnmatch.fnmatchcase(name, pattern)
+        for pattern in _config['stages']
+        for name in (stage, short_name)
+    )
+
+
+def peak_rss_bytes() -> int:
+    """Функция, возвращает пиковый RSS процесса в байтах."""
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux отдает килобайты, macOS - байты.
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+
+def _report_path(stage: str, suffix: str) -> str:
+    """Защищенная функция, формирует путь отчета в директории логов."""
+    stamp = dt.now().strftime('%H%M%S')
+    return os.path.join(get_log_dir(), f'{stamp}_{stage}.{suffix}')
+
+
+def _dump_allocations(stage: str, snapshot, peak: int) -> str:
+    """Защищенная функция, сохраняет топ выделений памяти этапа."""
+    report_path = _report_path(stage, 'mem.txt')
+    stats = snapshot.statistics('lineno')
+    with open(report_path, 'w', encoding='utf-8') as f:
+        f.write(f'Пик tracemalloc: {peak / 1024 / 1024:.1f} MB\n')
+        f.write(f'Пик RSS: {peak_rss_bytes() / 1024 / 1024:.1f} MB\n\n')
+        for stat in stats[:TOP_ALLOCATIONS]:
+            f.write(f'{stat}\n')
+    return report_path
+
+
+@contextmanager
+def profile_thread():
+    """
+    Контекстный менеджер профилирования рабочего потока.
+
+    cProfile видит только поток, в котором включен, поэтому потоки,
+    работающие внутри профилируемого этапа (например, потоки
+    конвейера), заводят собственный профиль, а profile_stage
+    объединяет его с профилем этапа. Вне профилирования ничего не
+    делает.
+    """
+    with _threads_lock:
+        profiles = _config['threads']
+    if profiles is None:
+        yield
+        return
+    profiler = cProfile.Profile()
+    profiler.enable()
+    try:
+        yield
+    finally:
+        profiler.disable()
+        with _threads_lock:
+            profiles.append(profiler)
+
+
+@contextmanager
+def profile_stage(stage: str):
+    """
+    Контекстный менеджер профилирования этапа.
+
+    Всегда фиксирует пиковый RSS на выходе из этапа. Если этап включен
+    через configure(), дополнительно запускает cProfile (файл .prof)
+    и/или tracemalloc (файл .mem.txt) с выгрузкой в директорию логов.
+    Профили потоков из profile_thread() сливаются в файл этапа через
+    pstats, tracemalloc и так учитывает все потоки. Вложенные этапы
+    внутри уже профилируемого не профилируются отдельно.
+    """
+    enabled = is_enabled(stage) and _active.acquire(blocking=False)
+    profiler = None
+    started_tracing = False
+    try:
+        if enabled:
+            if 'cpu' in _config['modes']:
+                profiler = cProfile.Profile()
+                with _threads_lock:
+                    _config['threads'] = []
+                profiler.enable()
+            if 'mem' in _config['modes'] and not tracemalloc.is_tracing():
+                tracemalloc.start()
+                started_tracing = True
+        yield
+    finally:
+        if profiler is not None:
+            profiler.disable()
+            with _threads_lock:
+                threads, _config['threads'] = _config['threads'], None
+            stats = pstats.Stats(profiler)
+            for thread_profiler in threads:
+                stats.add(thread_profiler)
+            report_path = _report_path(stage, 'prof')
+            stats.dump_stats(report_path)
+            logging.info(
+                'Профиль этапа %s сохранен (потоков: %s): %s',
+                stage,
+                len(threads) + 1,
+                report_path
+            )
+        if started_tracing:
+            snapshot = tracemalloc.take_snapshot()
+            _, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+            report_path = _dump_allocations(stage, snapshot, peak)
+            logging.info(
+                'Отчет о памяти этапа %s сохранен: %s',
+                stage,
+                report_path
+            )
+        if enabled:
+            _active.release()
+        STAGE_PEAK_RSS[stage] = peak_rss_bytes()
+
+
+configure()
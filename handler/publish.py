@@ -0,0 +1,236 @@
+"""
+Инкрементальная публикация результатов в раздаваемые директории.
+
+Этапы пишут результаты не в саму раздаваемую директорию, а в скрытую
+поддиректорию STAGING_FOLDER внутри нее (та же файловая система,
+поэтому перенос - атомарный rename). Publisher сравнивает хеш каждого
+файла из staging с манифестом опубликованных файлов: измененные файлы
+переносятся через os.replace, неизменные удаляются из staging, а
+опубликованный файл не трогается - его mtime сохраняется, и условные
+запросы краулеров (If-Modified-Since) получают 304.
+
+Манифест PUBLISH_MANIFEST лежит в раздаваемой директории и хранит для
+каждого файла sha256, размер и время публикации. Несколько
+Publisher одной директории (конвейеры разных фидов) могут работать
+одновременно, в том числе в разных процессах: save_manifest под
+блокировкой сливает свои изменения с манифестом на диске, а не
+перезаписывает его.
+"""
+import hashlib
+import json
+import logging
+import os
+import shutil
+import threading
+from datetime import datetime as dt
+from pathlib import Path
+
+from handler.constants import (PICTURE_VERSIONS_FOLDER, PUBLISH_MANIFEST,
+                               STAGING_FOLDER)
+from handler.metrics import REGISTRY
+from handler.mixins import FileMixin
+
+_manifest_lock = threading.Lock()
+"""Блокировка слияния манифестов в пределах процесса."""
+
+
+def staging_folder(folder_name: str) -> str:
+    """Функция, возвращает директорию staging для раздаваемой директории."""
+    return str(Path(folder_name) / STAGING_FOLDER)
+
+
+def file_digest(file_path: Path) -> str:
+    """Функция, считает sha256 файла потоково."""
+    with open(file_path, 'rb') as f:
+        return hashlib.file_digest(f, 'sha256').hexdigest()
+
+
+class Publisher(FileMixin):
+    """
+    Класс, публикующий файлы из staging в раздаваемую директорию.
+
+    Публикуются только файлы, содержимое которых отличается от уже
+    опубликованного. Файлы, которых нет в staging, не удаляются
+    (этим занимается команда gc).
+    """
+
+    def __init__(
+        self,
+        folder_name: str,
+        manifest_name: str = PUBLISH_MANIFEST
+    ) -> None:
+        self.folder_name = folder_name
+        self.folder_path = self._make_dir(folder_name)
+        self.staging_path = self.folder_path / STAGING_FOLDER
+        self.manifest_path = self.folder_path / manifest_name
+        self.manifest = self.load_manifest()
+        self._changed: set[str] = set()
+
+    def load_manifest(self) -> dict:
+        """Метод читает манифест опубликованных файлов."""
+        if not self.manifest_path.exists():
+            return {}
+        try:
+            with open(self.manifest_path, encoding='utf-8') as f:
+                return json.load(f)
+        except (OSError, ValueError) as error:
+            logging.warning(
+                'Манифест %s поврежден и будет собран заново: %s',
+                self.manifest_path,
+                error
+            )
+            return {}
+
+    def _staged_files(self) -> list[Path]:
+        """Защищенный метод, возвращает готовые файлы из staging."""
+        if not self.staging_path.exists():
+            return []
+        return sorted(
+            file for file in self.staging_path.rglob('*')
+            if file.is_file() and not file.name.startswith('.')
+        )
+
+    def _published_digest(self, name: str, published_path: Path) -> str:
+        """
+        Защищенный метод, возвращает хеш опубликованного файла.
+
+        Хеш берется из манифеста, если размер файла совпадает с
+        записанным; иначе (первый запуск, файл заменили вручную)
+        считается заново.
+        """
+        if not published_path.exists():
+            return ''
+        entry = self.manifest.get(name)
+        if entry and entry.get('size') == published_path.stat().st_size:
+            return entry['sha256']
+        return file_digest(published_path)
+
+    def digest(self, name: str) -> str:
+        """
+        Метод возвращает sha256 опубликованного файла name (путь
+        относительно раздаваемой директории) или '', если файла нет.
+        """
+        return self._published_digest(name, self.folder_path / name)
+
+    def version_file(self, name: str, version: str) -> str:
+        """
+        Метод возвращает путь копии файла с версией в имени:
+        {PICTURE_VERSIONS_FOLDER}/{stem}.{version}{suffix}.
+
+        Копия создается жесткой ссылкой на опубликованный файл (или
+        копированием, если ссылки не поддерживаются) и дальше не
+        меняется: новая версия файла получает новое имя.
+        """
+        source_path = self.folder_path / name
+        versioned = Path(PICTURE_VERSIONS_FOLDER).joinpath(
+            f'{source_path.stem}.{version}{source_path.suffix}'
+        )
+        versioned_path = self.folder_path / versioned
+        if not versioned_path.exists():
+            versioned_path.parent.mkdir(parents=True, exist_ok=True)
+            temp_path = self._temp_path(versioned_path)
+            temp_path.unlink(missing_ok=True)
+            try:
+                os.link(source_path, temp_path)
+            except OSError:
+                shutil.copy2(source_path, temp_path)
+            os.replace(temp_path, versioned_path)
+        return versioned.as_posix()
+
+    def publish_file(self, staged_path: Path) -> bool:
+        """
+        Метод публикует один файл из staging.
+
+        Возвращает True, если файл заменил опубликованный, и False,
+        если содержимое не изменилось и файл из staging удален.
+        Манифест обновляется в памяти, записывает его save_manifest().
+        """
+        name = staged_path.relative_to(self.staging_path).as_posix()
+        published_path = self.folder_path / name
+        digest = file_digest(staged_path)
+        size = staged_path.stat().st_size
+        if digest == self._published_digest(name, published_path):
+            staged_path.unlink()
+            if name not in self.manifest:
+                self.manifest[name] = {
+                    'sha256': digest,
+                    'size': size,
+                    'published': dt.fromtimestamp(
+                        published_path.stat().st_mtime
+                    ).isoformat(timespec='seconds'),
+                }
+                self._changed.add(name)
+            REGISTRY.counter(
+                'publish_files_total',
+                'Файлы, обработанные публикацией',
+                folder=self.folder_name,
+                result='skipped'
+            ).inc()
+            return False
+        published_path.parent.mkdir(parents=True, exist_ok=True)
+        os.replace(staged_path, published_path)
+        self.manifest[name] = {
+            'sha256': digest,
+            'size': size,
+            'published': dt.now().isoformat(timespec='seconds'),
+        }
+        self._changed.add(name)
+        REGISTRY.counter(
+            'publish_files_total',
+            'Файлы, обработанные публикацией',
+            folder=self.folder_name,
+            result='published'
+        ).inc()
+        REGISTRY.counter(
+            'publish_bytes_total',
+            folder=self.folder_name
+        ).inc(size)
+        return True
+
+    def save_manifest(self) -> None:
+        """
+        Метод атомарно сохраняет манифест.
+
+        Записи, измененные этим Publisher, накладываются на текущий
+        манифест с диска, поэтому записи других Publisher той же
+        директории (в том числе из других процессов) не теряются.
+        """
+        with _manifest_lock, self._file_lock(self.manifest_path):
+            manifest = self.load_manifest()
+            for name in self._changed:
+                manifest[name] = self.manifest[name]
+            self._atomic_write(
+                self.manifest_path,
+                json.dumps(
+                    manifest,
+                    ensure_ascii=False,
+                    indent=2,
+                    sort_keys=True
+                ).encode('utf-8')
+            )
+            self.manifest = manifest
+            self._changed.clear()
+
+    def publish(self) -> dict:
+        """
+        Метод публикует измененные файлы из staging.
+
+        Возвращает словарь со списками опубликованных и пропущенных
+        файлов (пути относительно раздаваемой директории).
+        """
+        published, skipped = [], []
+        for staged_path in self._staged_files():
+            name = staged_path.relative_to(self.staging_path).as_posix()
+            if self.publish_file(staged_path):
+                published.append(name)
+            else:
+                skipped.append(name)
+        if published or skipped:
+            self.save_manifest()
+        logging.info(
+            'Публикация %s: обновлено %s файлов, без изменений %s',
+            self.folder_name,
+            len(published),
+            len(skipped)
+        )
+        return {'published': published, 'skipped': skipped}
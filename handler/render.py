@@ -0,0 +1,147 @@
+import json
+import logging
+from pathlib import Path
+
+from PIL import Image
+
+from handler.constants import NAME_OF_CANVAS
+from handler.exceptions import InvalidRenderPlanError
+
+FORMAT_EXTENSIONS = {'PNG': 'png', 'JPEG': 'jpg', 'WEBP': 'webp'}
+"""Поддерживаемые форматы вариантов и расширения файлов."""
+
+
+class RenderVariant:
+    """
+    Вариант обрамленного изображения.
+
+    - name - имя варианта, по умолчанию и имя поддиректории в
+    new_images; вариант 'main' пишется прямо в new_images;
+    - width, height - размер итогового изображения;
+    - canvas - файл подложки в директории рамки;
+    - height_ratio - доля высоты подложки под товар;
+    - center_ratio - вертикальный визуальный центр товара;
+    - image_format - PNG, JPEG или WEBP, quality - для JPEG/WEBP.
+    """
+
+    def __init__(
+        self,
+        name: str = 'main',
+        width: int = 1000,
+        height: int = 1000,
+        canvas: str = NAME_OF_CANVAS,
+        height_ratio: float = 0.6,
+        center_ratio: float = 0.56,
+        image_format: str = 'PNG',
+        quality: int = 90,
+        folder: str | None = None
+    ) -> None:
+        image_format = image_format.upper().replace('JPG', 'JPEG')
+        if image_format not in FORMAT_EXTENSIONS:
+            raise InvalidRenderPlanError(
+                f'Формат {image_format} варианта {name} не поддерживается'
+            )
+        if width <= 0 or height <= 0 or not 0 < height_ratio <= 1:
+            raise InvalidRenderPlanError(
+                f'Неверные размеры варианта {name}'
+            )
+        self.name = name
+        self.size = (int(width), int(height))
+        self.canvas = canvas
+        self.height_ratio = height_ratio
+        self.center_ratio = center_ratio
+        self.image_format = image_format
+        self.quality = quality
+        if folder is None:
+            folder = '' if name == 'main' else name
+        self.folder = folder
+
+    def __repr__(self) -> str:
+        return (
+            f'RenderVariant({self.name!r}, {self.size[0]}x{self.size[1]}, '
+            f'{self.image_format})'
+        )
+
+    @property
+    def extension(self) -> str:
+        return FORMAT_EXTENSIONS[self.image_format]
+
+    def output_path(self, folder_path: Path, offer_id: str) -> Path:
+        """Метод возвращает путь итогового файла оффера."""
+        return folder_path / self.folder / f'{offer_id}.{self.extension}'
+
+    def product_size(self, image_size: tuple) -> tuple:
+        """Метод считает размер товара на подложке этого варианта."""
+        scale = int(self.size[1] * self.height_ratio) / image_size[1]
+        return (int(image_size[0] * scale), int(image_size[1] * scale))
+
+    def position(
+        self,
+        canvas: Image.Image,
+        product: Image.Image
+    ) -> tuple[int, int]:
+        """
+        Метод считает левый верхний угол товара на подложке:
+        по центру по горизонтали, по center_ratio по вертикали.
+        """
+        product_x = (canvas.width - product.width) // 2
+        visual_center_y = int(canvas.height * self.center_ratio)
+        product_y = int(visual_center_y - product.height / 2)
+        return product_x, product_y
+
+    def compose(
+        self,
+        canvas: Image.Image,
+        product: Image.Image
+    ) -> Image.Image:
+        """Метод накладывает отмасштабированный товар на копию подложки."""
+        final_image = canvas.copy()
+        final_image.paste(product, self.position(canvas, product), product)
+        return final_image
+
+    def save(self, image: Image.Image, file_path: Path) -> None:
+        """Метод кодирует изображение в формат варианта."""
+        if self.image_format == 'JPEG':
+            image.convert('RGB').save(
+                file_path, 'JPEG', quality=self.quality, optimize=True
+            )
+        elif self.image_format == 'WEBP':
+            image.save(file_path, 'WEBP', quality=self.quality)
+        else:
+            image.save(file_path, 'PNG')
+
+
+DEFAULT_RENDER_PLAN = (RenderVariant(),)
+"""План по умолчанию: один вариант 1000x1000 PNG, как раньше."""
+
+
+def load_render_plan(plan_path: Path) -> tuple[RenderVariant, ...]:
+    """
+    Функция, читает план рендеринга из JSON.
+
+    Формат: {"variants": [{"name": "main"}, {"name": "thumb",
+    "width": 600, "height": 600, "image_format": "JPEG"}]}.
+    Ключи варианта совпадают с аргументами RenderVariant.
+    Если файла нет, возвращается DEFAULT_RENDER_PLAN.
+    """
+    if not plan_path.exists():
+        return DEFAULT_RENDER_PLAN
+    try:
+        with open(plan_path, encoding='utf-8') as f:
+            plan = json.load(f)
+        variants = tuple(
+            RenderVariant(**variant) for variant in plan['variants']
+        )
+    except InvalidRenderPlanError:
+        raise
+    except Exception as error:
+        raise InvalidRenderPlanError(
+            f'Не удалось прочитать план {plan_path}: {error}'
+        )
+    names = [variant.name for variant in variants]
+    if not variants or len(set(names)) != len(names):
+        raise InvalidRenderPlanError(
+            f'План {plan_path} пуст или содержит повторяющиеся варианты'
+        )
+    logging.info('План рендеринга: %s', variants)
+    return variants
@@ -0,0 +1,250 @@
+"""
+Параллельный запуск конвейеров нескольких фидов.
+
+Каждый фид из конфигурации (handler.feed_config) проходит свой
+конвейер: скачивание фида, изображения по профилю, преобразования и
+сохранение. Фиды идут параллельно в пределах FEED_CONCURRENCY, а общие
+ресурсы делятся через ResourceBudget: сетевые операции (скачивание
+фидов и изображений, удаление фона) занимают слоты network,
+вычислительные (проверка, наложение, кодирование, преобразования
+фида) - слоты cpu. Поэтому большой фид не забирает все соединения и
+ядра, а маленькие не ждут его завершения.
+
+Изображения общие для всех фидов: один оффер одновременно
+обрабатывает только один конвейер (см. FeedImage._in_flight).
+Публикация изображений и фидов выполняется один раз после всех фидов.
+"""
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+import requests
+
+from handler.constants import (CPU_BUDGET, FEED_CONCURRENCY, FEEDS_CONFIG,
+                               FEEDS_FOLDER, FRAME_FOLDER, NETWORK_BUDGET,
+                               NEW_FEEDS_FOLDER, NEW_IMAGE_FOLDER)
+from handler.decorators import RUN_RETRY_BUDGET
+from handler.exceptions import FeedsRunError
+from handler.feed_config import FeedConfig, load_feed_configs
+from handler.feeds_handler import FeedHandler
+from handler.feeds_save import FeedSaver
+from handler.image_handler import FeedImage
+from handler.journal import RunJournal
+from handler.metrics import REGISTRY
+from handler.publish import Publisher
+from handler.render import load_render_plan
+
+
+class ResourceBudget:
+    """
+    Общий бюджет ресурсов для конвейеров всех фидов.
+
+    cpu и network - семафоры, слот занимается на время обработки
+    одного элемента (см. pipeline.Stage.limit).
+    """
+
+    def __init__(
+        self,
+        cpu: int = CPU_BUDGET,
+        network: int = NETWORK_BUDGET
+    ) -> None:
+        self.cpu_slots = max(1, cpu)
+        self.network_slots = max(1, network)
+        self.cpu = threading.BoundedSemaphore(self.cpu_slots)
+        self.network = threading.BoundedSemaphore(self.network_slots)
+
+    def __repr__(self) -> str:
+        return (
+            f'ResourceBudget(cpu={self.cpu_slots}, '
+            f'network={self.network_slots})'
+        )
+
+
+class FeedScheduler:
+    """
+    Класс, запускающий конвейеры фидов параллельно.
+
+    Экземпляры FeedImage хранятся по имени фида и переиспользуются
+    между прогонами (долгоживущий режим, handler.daemon).
+    """
+
+    def __init__(
+        self,
+        configs: list[FeedConfig],
+        budget: ResourceBudget | None = None,
+        concurrency: int = FEED_CONCURRENCY,
+        session: requests.Session | None = None,
+        feeds_folder: str = FEEDS_FOLDER
+    ) -> None:
+        self.configs = configs
+        self.budget = budget or ResourceBudget()
+        self.concurrency = max(1, concurrency)
+        self.session = session or requests.Session()
+        self.feeds_folder = feeds_folder
+        self.image_clients: dict[str, FeedImage] = {}
+
+    @classmethod
+    def from_config(
+        cls,
+        config_path: str = FEEDS_CONFIG,
+        session: requests.Session | None = None
+    ) -> 'FeedScheduler':
+        """
+        Метод создает планировщик по файлу конфигурации.
+
+        Ключи бюджета: feeds - число одновременных фидов, cpu и
+        network - слоты ResourceBudget.
+        """
+        configs, budget = load_feed_configs(config_path)
+        return cls(
+            configs,
+            ResourceBudget(
+                int(budget.get('cpu', CPU_BUDGET)),
+                int(budget.get('network', NETWORK_BUDGET))
+            ),
+            int(budget.get('feeds', FEED_CONCURRENCY)),
+            session
+        )
+
+    def _image_client(
+        self,
+        config: FeedConfig,
+        journal: RunJournal
+    ) -> FeedImage:
+        """
+        Защищенный метод, возвращает FeedImage фида, создавая его
+        при первом прогоне.
+        """
+        image_client = self.image_clients.get(config.name)
+        if image_client is None:
+            render_plan = None
+            if config.render_plan:
+                render_plan = load_render_plan(
+                    Path(__file__).parent.parent.joinpath(
+                        FRAME_FOLDER,
+                        config.render_plan
+                    )
+                )
+            image_client = FeedImage(
+                [config.filename],
+                images=[],
+                feeds_folder=self.feeds_folder,
+                session=self.session,
+                render_plan=render_plan,
+                budget=self.budget,
+                feed=config.name
+            )
+            self.image_clients[config.name] = image_client
+        image_client.journal = journal
+        return image_client
+
+    def _transform(self, config: FeedConfig) -> None:
+        """Защищенный метод, применяет преобразования и сохраняет фид."""
+        handler = FeedHandler(
+            config.filename,
+            feeds_folder=self.feeds_folder,
+            compression=config.compression
+        )
+        for transform in config.transforms:
+            if transform == 'category_filter':
+                handler.delete_offers(config.exclude_categories)
+            elif transform == 'replace_images':
+                handler.replace_images()
+            elif transform == 'custom_label':
+                handler.add_custom_label()
+        handler.save(encoding=config.encoding)
+
+    def run_feed(self, config: FeedConfig) -> None:
+        """
+        Метод выполняет конвейер одного фида.
+
+        Этапы отмечаются в журнале 'pipeline-{name}', поэтому после
+        падения процесса фид продолжает с незавершенного этапа. Если
+        этап выбросил исключение, прогон в журнале отмечается
+        неудачным, и следующий цикл скачивает свежий фид.
+        """
+        journal = RunJournal(f'pipeline-{config.name}')
+        journal.start()
+        try:
+            self._run_stages(config, journal)
+        except Exception as error:
+            journal.fail(error)
+            raise
+        journal.finish()
+        logging.info('Фид %s обработан', config.name)
+
+    def _run_stages(self, config: FeedConfig, journal: RunJournal) -> None:
+        """Защищенный метод, выполняет незавершенные этапы фида."""
+        with REGISTRY.timer('feed_pipeline_seconds', feed=config.name):
+            if not journal.is_stage_done('save_xml'):
+                with self.budget.network:
+                    FeedSaver(
+                        feeds_list=(config.url,),
+                        feeds_folder=self.feeds_folder,
+                        session=self.session,
+                        filenames={config.url: config.filename}
+                    ).save_xml()
+                journal.mark_stage_done('save_xml')
+            feed_path = Path(__file__).parent.parent.joinpath(
+                self.feeds_folder,
+                config.filename
+            )
+            if not feed_path.exists():
+                logging.error('Фид %s не скачан', config.name)
+                raise FileNotFoundError(f'Файл {feed_path} не найден')
+
+            with_images = config.image_profile != 'none'
+            if with_images and not journal.is_stage_done('images'):
+                self._image_client(config, journal).process_images(
+                    frame=config.image_profile == 'frame'
+                )
+                journal.mark_stage_done('images')
+
+            if config.transforms and not journal.is_stage_done('transforms'):
+                with self.budget.cpu:
+                    self._transform(config)
+                journal.mark_stage_done('transforms')
+
+    def run(self) -> dict[str, str | None]:
+        """
+        Метод запускает конвейеры всех фидов и публикует результат.
+
+        Возвращает словарь {имя фида: текст ошибки или None}. Если
+        хотя бы один фид завершился ошибкой, результаты остальных все
+        равно публикуются, после чего выбрасывается FeedsRunError.
+        """
+        RUN_RETRY_BUDGET.reset()
+        logging.info(
+            'Запуск %s фидов, одновременно %s, %s',
+            len(self.configs),
+            self.concurrency,
+            self.budget
+        )
+        with ThreadPoolExecutor(
+            max_workers=self.concurrency,
+            thread_name_prefix='feed'
+        ) as executor:
+            futures = {
+                config.name: executor.submit(self.run_feed, config)
+                for config in self.configs
+            }
+        results = {}
+        for name, future in futures.items():
+            error = future.exception()
+            results[name] = None
+            if error is not None:
+                results[name] = f'{type(error).__name__}: {error}'
+                logging.error('Фид %s завершился ошибкой: %s', name, error)
+
+        Publisher(NEW_IMAGE_FOLDER).publish()
+        Publisher(NEW_FEEDS_FOLDER).publish()
+
+        failed = sorted(name for name, error in results.items() if error)
+        REGISTRY.gauge(
+            'feeds_failed',
+            'Фиды, завершившиеся ошибкой в последнем прогоне'
+        ).set(len(failed))
+        if failed:
+            raise FeedsRunError(f'Фиды завершились ошибкой: {failed}')
+        return results
@@ -0,0 +1,393 @@
+"""
+Хранилище истории скачанных фидов.
+
+Каждый снимок фида раскладывается на офферы по байтовым границам из
+индекса (handler.offer_index), XML не разбирается. В SQLite хранятся:
+- blobs - уникальные версии офферов по sha256 (32 байта), сжатые zlib. Новая
+версия оффера сжимается с прошлой версией в качестве словаря (zdict),
+поэтому небольшое изменение занимает десятки байт; новый оффер -
+с соседним оффером фида, у которого та же разметка. Длина цепочки
+дельт ограничена SNAPSHOT_DELTA_DEPTH;
+- changes - только изменения: строка появляется, когда оффер
+добавлен, изменен (новый хеш) или удален (hash NULL). Неизменные
+офферы в новом снимке ничего не стоят;
+- runs - снимки: порядок ключей офферов и обрамление фида (все, что
+до первого и после последнего оффера) тоже хранятся как blobs.
+
+Ключ оффера - значение атрибута id; повтор id в одном фиде получает
+суффикс ~2, ~3, оффер без id - ключ ~N по номеру в фиде.
+"""
+import hashlib
+import logging
+import sqlite3
+import zlib
+from datetime import datetime as dt
+from pathlib import Path
+
+from handler.constants import JOURNAL_FOLDER, SNAPSHOT_DB, SNAPSHOT_DELTA_DEPTH
+from handler.exceptions import SnapshotNotFoundError
+from handler.metrics import REGISTRY
+from handler.offer_index import ID_PATTERN, OfferIndex
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS blobs (
+    hash BLOB PRIMARY KEY,
+    base BLOB,
+    depth INTEGER NOT NULL,
+    data BLOB NOT NULL
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS runs (
+    seq INTEGER PRIMARY KEY AUTOINCREMENT,
+    feed TEXT NOT NULL,
+    run_id TEXT NOT NULL,
+    created TEXT NOT NULL,
+    offers INTEGER NOT NULL,
+    changes INTEGER NOT NULL,
+    head BLOB NOT NULL,
+    tail BLOB NOT NULL,
+    separator BLOB NOT NULL,
+    keys BLOB NOT NULL
+);
+CREATE TABLE IF NOT EXISTS changes (
+    feed TEXT NOT NULL,
+    offer_key TEXT NOT NULL,
+    seq INTEGER NOT NULL,
+    hash BLOB,
+    PRIMARY KEY (feed, offer_key, seq)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS changes_seq ON changes (feed, seq);
+'''
+"""Схема хранилища."""
+
+
+def _offer_keys(offers: list[bytes]) -> list[str]:
+    """Защищенная функция, строит уникальные ключи офферов."""
+    keys = []
+    counts: dict[str, int] = {}
+    for number, offer in enumerate(offers):
+        match = ID_PATTERN.search(offer, 0, offer.find(b'>') + 1)
+        key = match.group(1).decode('ascii', 'replace') if match else ''
+        counts[key] = counts.get(key, 0) + 1
+        if not key:
+            key = f'~{number}'
+        elif counts[key] > 1:
+            key = f'{key}~{counts[key]}'
+        keys.append(key)
+    return keys
+
+
+class SnapshotStore:
+    """
+    Класс хранилища снимков фидов.
+
+    Снимок адресуется номером seq (сквозным для всех фидов). Соединение
+    открывается на экземпляр; из разных потоков и процессов нужно
+    создавать свои экземпляры, SQLite сам упорядочит запись.
+    """
+
+    def __init__(
+        self,
+        db_name: str = SNAPSHOT_DB,
+        folder_name: str = JOURNAL_FOLDER,
+        delta_depth: int = SNAPSHOT_DELTA_DEPTH
+    ) -> None:
+        folder_path = Path(__file__).parent.parent / folder_name
+        folder_path.mkdir(parents=True, exist_ok=True)
+        self.db_path = folder_path / db_name
+        self.delta_depth = delta_depth
+        self.connection = sqlite3.connect(self.db_path, timeout=60)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.executescript(SCHEMA)
+        self._cache: dict[str, bytes] = {}
+
+    def close(self) -> None:
+        """Метод закрывает соединение с базой."""
+        self.connection.close()
+
+    def __enter__(self) -> 'SnapshotStore':
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.close()
+
+    def get_blob(self, blob_hash: bytes) -> bytes:
+        """Метод возвращает распакованную версию по хешу."""
+        cached = self._cache.get(blob_hash)
+        if cached is not None:
+            return cached
+        row = self.connection.execute(
+            'SELECT base, data FROM blobs WHERE hash = ?',
+            (blob_hash,)
+        ).fetchone()
+        if row is None:
+            raise SnapshotNotFoundError(
+                f'Версия {blob_hash.hex()} не найдена'
+            )
+        base, data = row
+        if base is None:
+            content = zlib.decompress(data)
+        else:
+            decompressor = zlib.decompressobj(zdict=self.get_blob(base))
+            content = decompressor.decompress(data) + decompressor.flush()
+        self._cache[blob_hash] = content
+        return content
+
+    def _put_blob(
+        self,
+        content: bytes,
+        base: bytes | None = None
+    ) -> bytes:
+        """
+        Защищенный метод, сохраняет версию, если ее еще нет, и
+        возвращает хеш. base - хеш прошлой версии для дельты.
+        """
+        blob_hash = hashlib.sha256(content).digest()
+        if self.connection.execute(
+            'SELECT 1 FROM blobs WHERE hash = ?',
+            (blob_hash,)
+        ).fetchone():
+            return blob_hash
+        depth = 0
+        if base is not None:
+            row = self.connection.execute(
+                'SELECT depth FROM blobs WHERE hash = ?',
+                (base,)
+            ).fetchone()
+            if row is None or row[0] >= self.delta_depth:
+                base = None
+            else:
+                depth = row[0] + 1
+        if base is None:
+            data = zlib.compress(content)
+        else:
+            compressor = zlib.compressobj(zdict=self.get_blob(base))
+            data = compressor.compress(content) + compressor.flush()
+        self.connection.execute(
+            'INSERT OR IGNORE INTO blobs (hash, base, depth, data) '
+            'VALUES (?, ?, ?, ?)',
+            (blob_hash, base, depth, data)
+        )
+        REGISTRY.counter(
+            'snapshot_blob_bytes_total',
+            'Байты новых версий офферов в хранилище снимков',
+            kind='raw'
+        ).inc(len(content))
+        REGISTRY.counter(
+            'snapshot_blob_bytes_total',
+            kind='stored'
+        ).inc(len(data))
+        return blob_hash
+
+    def _run(self, seq: int) -> tuple:
+        """Защищенный метод, возвращает строку снимка."""
+        row = self.connection.execute(
+            'SELECT seq, feed, run_id, created, offers, changes, head, '
+            'tail, separator, keys FROM runs WHERE seq = ?',
+            (seq,)
+        ).fetchone()
+        if row is None:
+            raise SnapshotNotFoundError(f'Снимок {seq} не найден')
+        return row
+
+    def _last_seq(self, feed: str) -> int:
+        """Защищенный метод, возвращает номер последнего снимка фида."""
+        row = self.connection.execute(
+            'SELECT MAX(seq) FROM runs WHERE feed = ?',
+            (feed,)
+        ).fetchone()
+        return row[0] or 0
+
+    def state(self, feed: str, seq: int) -> dict[str, bytes]:
+        """Метод возвращает {ключ оффера: хеш} фида на момент снимка."""
+        rows = self.connection.execute(
+            'SELECT offer_key, hash, MAX(seq) FROM changes '
+            'WHERE feed = ? AND seq <= ? GROUP BY offer_key',
+            (feed, seq)
+        )
+        return {key: blob_hash for key, blob_hash, _ in rows if blob_hash}
+
+    def add(self, feed_path: Path, feed: str | None = None) -> int:
+        """
+        Метод сохраняет снимок фида и возвращает его номер.
+
+        В базу попадают только офферы, которых не было в прошлом
+        снимке этого фида или которые изменились, и отметки об
+        удаленных офферах.
+        """
+        feed = feed or feed_path.name
+        index = OfferIndex.for_feed(feed_path)
+        offers = list(index.iter_offer_bytes(feed_path))
+        keys = _offer_keys(offers)
+        with open(feed_path, 'rb') as f:
+            head = f.read(int(index.starts[0])) if offers else f.read()
+            separator = b''
+            if len(offers) > 1:
+                f.seek(int(index.ends[0]))
+                separator = f.read(int(index.starts[1] - index.ends[0]))
+            tail = b''
+            if offers:
+                f.seek(int(index.ends[-1]))
+                tail = f.read()
+        with REGISTRY.timer('snapshot_seconds', feed=feed), self.connection:
+            previous = self.state(feed, self._last_seq(feed))
+            changes = []
+            neighbour = None
+            for key, offer in zip(keys, offers):
+                offer_hash = hashlib.sha256(offer).digest()
+                base = previous.pop(key, None)
+                if base != offer_hash:
+                    self._put_blob(offer, base or neighbour)
+                    changes.append((key, offer_hash))
+                neighbour = offer_hash
+            changes.extend((key, None) for key in previous)
+            now = dt.now()
+            seq = self.connection.execute(
+                'INSERT INTO runs (feed, run_id, created, offers, changes, '
+                'head, tail, separator, keys) '
+                'VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                (
+                    feed,
+                    now.strftime('%Y%m%d%H%M%S'),
+                    now.isoformat(timespec='seconds'),
+                    len(offers),
+                    len(changes),
+                    self._put_blob(head),
+                    self._put_blob(tail),
+                    self._put_blob(separator),
+                    self._put_blob('\n'.join(keys).encode('utf-8'))
+                )
+            ).lastrowid
+            self.connection.executemany(
+                'INSERT INTO changes (feed, offer_key, seq, hash) '
+                'VALUES (?, ?, ?, ?)',
+                [(feed, key, seq, blob_hash) for key, blob_hash in changes]
+            )
+        self._cache.clear()
+        logging.info(
+            'Снимок %s фида %s: %s офферов, изменений %s',
+            seq,
+            feed,
+            len(offers),
+            len(changes)
+        )
+        return seq
+
+    def runs(self, feed: str | None = None) -> list[dict]:
+        """Метод возвращает список снимков, новые в конце."""
+        query = 'SELECT seq, feed, run_id, created, offers, changes FROM runs'
+        params: tuple = ()
+        if feed:
+            query += ' WHERE feed = ?'
+            params = (feed,)
+        return [
+            dict(zip(
+                ('seq', 'feed', 'run_id', 'created', 'offers', 'changes'),
+                row
+            ))
+            for row in self.connection.execute(f'{query} ORDER BY seq', params)
+        ]
+
+    def diff(self, seq_from: int, seq_to: int) -> dict[str, list[str]]:
+        """
+        Метод сравнивает два снимка одного фида.
+
+        Читаются только изменения между снимками, а не полные
+        состояния. Возвращает ключи added, removed и changed.
+        """
+        feed = self._run(seq_from)[1]
+        if self._run(seq_to)[1] != feed:
+            raise SnapshotNotFoundError('Снимки относятся к разным фидам')
+        low, high = sorted((seq_from, seq_to))
+        touched = (
+            'SELECT offer_key, hash, MAX(seq) FROM changes '
+            'WHERE feed = ? AND seq <= ? AND offer_key IN ('
+            'SELECT offer_key FROM changes '
+            'WHERE feed = ? AND seq > ? AND seq <= ?'
+            ') GROUP BY offer_key'
+        )
+        before, after = (
+            {
+                key: blob_hash
+                for key, blob_hash, _ in self.connection.execute(
+                    touched,
+                    (feed, seq, feed, low, high)
+                )
+                if blob_hash
+            }
+            for seq in (seq_from, seq_to)
+        )
+        return {
+            'added': sorted(set(after) - set(before)),
+            'removed': sorted(set(before) - set(after)),
+            'changed': sorted(
+                key for key in set(before) & set(after)
+                if before[key] != after[key]
+            ),
+        }
+
+    def history(self, offer_key: str, feed: str | None = None) -> list[dict]:
+        """Метод возвращает изменения оффера по снимкам."""
+        feeds = (feed,) if feed else tuple(
+            row[0] for row in self.connection.execute(
+                'SELECT DISTINCT feed FROM runs'
+            )
+        )
+        query = (
+            'SELECT changes.seq, changes.feed, runs.created, changes.hash '
+            'FROM changes JOIN runs ON runs.seq = changes.seq '
+            f"WHERE changes.feed IN ({', '.join('?' * len(feeds))}) "
+            'AND changes.offer_key = ?'
+        )
+        params = feeds + (offer_key,)
+        return [
+            {
+                'seq': seq,
+                'feed': feed,
+                'created': created,
+                'sha256': blob_hash.hex() if blob_hash else None,
+            }
+            for seq, feed, created, blob_hash in self.connection.execute(
+                f'{query} ORDER BY changes.seq',
+                params
+            )
+        ]
+
+    def offer(self, seq: int, offer_key: str) -> bytes | None:
+        """Метод возвращает байты оффера в снимке или None."""
+        feed = self._run(seq)[1]
+        row = self.connection.execute(
+            'SELECT hash FROM changes WHERE feed = ? AND offer_key = ? '
+            'AND seq <= ? ORDER BY seq DESC LIMIT 1',
+            (feed, offer_key, seq)
+        ).fetchone()
+        if row is None or row[0] is None:
+            return None
+        return self.get_blob(row[0])
+
+    def restore(self, seq: int, output_path: Path) -> Path:
+        """
+        Метод восстанавливает файл фида из снимка.
+
+        Офферы, обрамление и разделитель между офферами сохраняются
+        байт в байт; если между офферами были разные пробельные
+        промежутки, все они заменяются первым.
+        """
+        row = self._run(seq)
+        feed, head, tail, separator, keys = (
+            row[1], row[6], row[7], row[8], row[9]
+        )
+        state = self.state(feed, seq)
+        offer_keys = self.get_blob(keys).decode('utf-8').split('\n')
+        output_path.parent.mkdir(parents=True, exist_ok=True)
+        temp_path = output_path.with_name(f'.{output_path.name}.tmp')
+        with open(temp_path, 'wb') as f:
+            f.write(self.get_blob(head))
+            join = self.get_blob(separator)
+            for number, key in enumerate(filter(None, offer_keys)):
+                if number:
+                    f.write(join)
+                f.write(self.get_blob(state[key]))
+            f.write(self.get_blob(tail))
+        temp_path.replace(output_path)
+        self._cache.clear()
+        return output_path
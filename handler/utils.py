@@ -1,14 +1,13 @@
 import logging
+import time
 from pathlib import Path
 
+from handler import xml_backend
 from handler.exceptions import DirectoryCreationError, EmptyFeedsListError
-from handler.logging_config import setup_logging
 
 # from handler.feeds_handler import FeedHandler
 # from handler.feeds_save import FeedSaver
 
-setup_logging()
-
 
 def get_filenames_list(folder_name: str) -> list[str]:
     """Функция, возвращает список названий фидов."""
@@ -17,10 +16,104 @@ def get_filenames_list(folder_name: str) -> list[str]:
         logging.error('Папка %s не существует', folder_name)
         raise DirectoryCreationError('Папка %s не найдена', folder_name)
     files_names = [
-        file.name for file in folder_path.iterdir() if file.is_file()
+        file.name for file in folder_path.iterdir()
+        if file.is_file() and not file.name.startswith('.')
     ]
     if not files_names:
         logging.error('В папке нет файлов')
         raise EmptyFeedsListError('Нет скачанных файлов')
     logging.debug('Найдены файлы: %s', files_names)
     return files_names
+
+
+def get_offer_ids(folder_name: str) -> set[str]:
+    """
+    Функция, возвращает множество id офферов из всех фидов директории.
+
+    Фиды читаются потоково, обработанные элементы сразу освобождаются.
+    """
+    offer_ids: set[str] = set()
+    folder_path = Path(__file__).parent.parent / folder_name
+    for filename in get_filenames_list(folder_name):
+        for elem in xml_backend.iter_elements(
+            folder_path / filename,
+            'offer'
+        ):
+            offer_id = elem.get('id')
+            if offer_id:
+                offer_ids.add(offer_id)
+    return offer_ids
+
+
+def remove_orphan_files(
+    folder_name: str,
+    offer_ids: set[str],
+    dry_run: bool = False
+) -> list[str]:
+    """
+    Функция, удаляет файлы офферов, которых больше нет в фидах,
+    и недописанные временные файлы. Возвращает список удаленных имен.
+    """
+    folder_path = Path(__file__).parent.parent / folder_name
+    if not folder_path.exists():
+        return []
+    removed = []
+    for file in folder_path.iterdir():
+        if not file.is_file():
+            continue
+        if file.name.startswith('.'):
+            if not file.name.endswith(('.tmp', '.download')):
+                continue
+        elif file.name.split('.')[0] in offer_ids:
+            continue
+        removed.append(file.name)
+        if not dry_run:
+            file.unlink(missing_ok=True)
+    logging.info(
+        'Из %s удалено %s файлов%s',
+        folder_name,
+        len(removed),
+        ' (пробный запуск)' if dry_run else ''
+    )
+    return removed
+
+
+def remove_stale_versions(
+    folder_name: str,
+    retention_days: int,
+    dry_run: bool = False
+) -> list[str]:
+    """
+    Функция, удаляет устаревшие версии изображений вида
+    {offer_id}.{hash}.{ext}: у каждого оффера остается самая новая
+    версия, остальные удаляются, если они старше retention_days дней.
+    Возвращает список удаленных имен.
+    """
+    folder_path = Path(__file__).parent.parent / folder_name
+    if not folder_path.exists():
+        return []
+    versions: dict[tuple, list] = {}
+    for file in folder_path.iterdir():
+        if not file.is_file() or file.name.startswith('.'):
+            continue
+        offer_id = file.name.split('.')[0]
+        versions.setdefault((offer_id, file.suffix), []).append(
+            (file.stat().st_mtime, file)
+        )
+    deadline = time.time() - retention_days * 24 * 60 * 60
+    removed = []
+    for files in versions.values():
+        files.sort()
+        for mtime, file in files[:-1]:
+            if mtime >= deadline:
+                continue
+            removed.append(file.name)
+            if not dry_run:
+                file.unlink(missing_ok=True)
+    logging.info(
+        'Из %s удалено %s устаревших версий%s',
+        folder_name,
+        len(removed),
+        ' (пробный запуск)' if dry_run else ''
+    )
+    return removed
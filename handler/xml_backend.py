@@ -0,0 +1,109 @@
+"""
+Слой выбора XML-библиотеки.
+
+Если установлен lxml, разбор идет его C-парсером, иначе через
+xml.etree.ElementTree. Сериализация в обоих случаях выполняется
+сериализатором ElementTree: элементы lxml поддерживают тот же
+интерфейс (tag, text, tail, items(), итерация, makeelement), поэтому
+байты на выходе совпадают независимо от бэкенда. Комментарии и
+инструкции обработки lxml отбрасывает при разборе, как ElementTree.
+
+Бэкенд выбирается переменной XML_BACKEND: 'auto' (по умолчанию),
+'lxml' или 'etree'.
+"""
+import logging
+import xml.etree.ElementTree as ET
+from collections.abc import Iterator
+from pathlib import Path
+
+from handler.constants import XML_BACKEND
+
+try:
+    from lxml import etree as lxml_etree
+except ImportError:
+    lxml_etree = None
+
+USE_LXML = lxml_etree is not None and XML_BACKEND in ('auto', 'lxml')
+"""Используется ли lxml для разбора."""
+
+if XML_BACKEND == 'lxml' and lxml_etree is None:
+    logging.warning('XML_BACKEND=lxml, но lxml не установлен, используется ET')
+
+BACKEND_NAME = 'lxml' if USE_LXML else 'etree'
+"""Имя активного бэкенда для логов и бенчмарков."""
+
+PARSE_ERRORS: tuple = (ET.ParseError,)
+"""Исключения синтаксических ошибок XML активного бэкенда."""
+
+if USE_LXML:
+    PARSE_ERRORS += (lxml_etree.XMLSyntaxError,)
+
+
+def _lxml_parser(encoding: str | None = None):
+    """Защищенная функция, создает парсер lxml с поведением как у ET."""
+    return lxml_etree.XMLParser(
+        remove_comments=True,
+        remove_pis=True,
+        huge_tree=True,
+        encoding=encoding
+    )
+
+
+def parse(file_path: Path):
+    """Функция, разбирает XML-файл и возвращает корневой элемент."""
+    if USE_LXML:
+        return lxml_etree.parse(str(file_path), _lxml_parser()).getroot()
+    return ET.parse(file_path).getroot()
+
+
+def fromstring(text: str):
+    """
+    Функция, разбирает уже декодированный XML.
+
+    Как и ET.fromstring для str, объявленная в документе кодировка
+    игнорируется.
+    """
+    if USE_LXML:
+        return lxml_etree.fromstring(
+            text.encode('utf-8'),
+            _lxml_parser('utf-8')
+        )
+    return ET.fromstring(text)
+
+
+def sub_element(parent, tag: str):
+    """
+    Функция, добавляет дочерний элемент, как ET.SubElement.
+
+    C-версия ET.SubElement принимает только элементы ElementTree,
+    поэтому элемент создается через makeelement самого родителя.
+    """
+    child = parent.makeelement(tag, {})
+    parent.append(child)
+    return child
+
+
+def iter_elements(file_path: Path, tag: str) -> Iterator:
+    """
+    Функция, потоково отдает элементы tag из файла.
+
+    После обработки элемент очищается, а в lxml еще и удаляются уже
+    пройденные соседи, поэтому память не растет с размером фида.
+    """
+    if USE_LXML:
+        for _, elem in lxml_etree.iterparse(
+            str(file_path),
+            tag=tag,
+            remove_comments=True,
+            huge_tree=True
+        ):
+            yield elem
+            elem.clear()
+            parent = elem.getparent()
+            while elem.getprevious() is not None:
+                del parent[0]
+        return
+    for _, elem in ET.iterparse(file_path):
+        if elem.tag == tag:
+            yield elem
+            elem.clear()
@@ -0,0 +1,110 @@
+"""
+Потоковая запись XML в однобайтовых кодировках.
+
+ET.tostring(root, encoding='windows-1251') собирает весь документ в
+памяти и кодирует его через TextIOWrapper узел за узлом. Здесь
+документ собирается в список строк, который кодируется крупными
+блоками через str.encode(encoding, 'xmlcharrefreplace') - так же, как
+это делает ElementTree, но одним вызовом на блок - и пишется в файл.
+Экранирование берется из ElementTree, поэтому байты совпадают с
+ET.tostring. Документы с пространствами имен пишутся сериализатором
+ElementTree.
+"""
+import xml.etree.ElementTree as ET
+
+CHUNK_CHARS = 1024 * 1024
+"""Размер блока (в символах), который кодируется и пишется за раз."""
+
+_escape_cdata = ET._escape_cdata
+_escape_attrib = ET._escape_attrib
+
+
+class _NamespacedTreeError(Exception):
+    """В дереве есть пространства имен, нужен сериализатор ET."""
+
+
+def _check_name(name) -> str:
+    """Защищенная функция, пропускает только простые имена."""
+    if not isinstance(name, str) or name.startswith('{'):
+        raise _NamespacedTreeError(name)
+    return name
+
+
+def _serialize(root, flush) -> None:
+    """
+    Защищенная функция, обходит дерево и складывает строки в буфер,
+    отдавая его flush() по достижении CHUNK_CHARS символов.
+    """
+    parts: list[str] = []
+    size = 0
+
+    def write(text: str) -> None:
+        nonlocal size
+        parts.append(text)
+        size += len(text)
+        if size >= CHUNK_CHARS:
+            flush(''.join(parts))
+            parts.clear()
+            size = 0
+
+    def serialize(elem) -> None:
+        tag = elem.tag
+        text = elem.text
+        if tag is ET.Comment:
+            write(f'<!--{text}-->')
+        elif tag is ET.ProcessingInstruction:
+            write(f'<?{text}?>')
+        else:
+            write('<' + _check_name(tag))
+            for key, value in elem.items():
+                write(f' {_check_name(key)}="{_escape_attrib(value)}"')
+            if text or len(elem):
+                write('>')
+                if text:
+                    write(_escape_cdata(text))
+                for child in elem:
+                    serialize(child)
+                write(f'</{tag}>')
+            else:
+                write(' />')
+        if elem.tail:
+            write(_escape_cdata(elem.tail))
+
+    serialize(root)
+    flush(''.join(parts))
+
+
+def write_xml(
+    root,
+    file,
+    encoding: str,
+    xml_declaration: bool | None = None
+) -> None:
+    """
+    Функция, пишет дерево root в бинарный файл file.
+
+    Символы, которых нет в кодировке, заменяются ссылками &#N;.
+    Объявление XML добавляется по тем же правилам, что в ET.tostring:
+    если xml_declaration не задан, то для всех кодировок, кроме
+    utf-8 и us-ascii. Файл должен поддерживать seek/truncate: при
+    откате на сериализатор ElementTree он перезаписывается с начала.
+    """
+    start = file.tell()
+
+    def flush(text: str) -> None:
+        file.write(text.encode(encoding, 'xmlcharrefreplace'))
+
+    if xml_declaration is None:
+        xml_declaration = encoding.lower() not in ('utf-8', 'us-ascii')
+    if xml_declaration:
+        flush(f"<?xml version='1.0' encoding='{encoding}'?>\n")
+    try:
+        _serialize(root, flush)
+    except _NamespacedTreeError:
+        file.seek(start)
+        file.truncate()
+        ET.ElementTree(root).write(
+            file,
+            encoding=encoding,
+            xml_declaration=xml_declaration
+        )